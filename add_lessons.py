@@ -5,10 +5,12 @@ import os
 # Add the current directory to Python path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from db.models import Base, engine, SessionLocal, Lesson, Question
+from db.models import engine, SessionLocal, Lesson, Question, bump_cache_version
+from db.migrations import migrate
+from lesson_context import index_lesson
 
-# Create tables if they don't exist
-Base.metadata.create_all(bind=engine)
+# Create tables if they don't exist and apply pending migrations
+migrate(engine)
 
 # The Q&A data you provided
 qna_data = {
@@ -51,6 +53,7 @@ try:
 
         db.add(lesson)
         db.flush()  # This ensures lesson.id is available
+        index_lesson(db, lesson)
         print(f"Added lesson: {lesson.title}")
 
         # Add questions
@@ -63,6 +66,7 @@ try:
             )
             db.add(question)
 
+        bump_cache_version(db)
         db.commit()
         print(f"Added {len(qna_data)} questions")
         print("Done!")
@@ -1,21 +1,47 @@
-from langchain.prompts import PromptTemplate
-from llm import llm
-from db.models import get_db, get_lesson, get_questions
-from utils import qna_dict_to_string
+import asyncio
+
+from llm import get_llm, llm
+from config import eval_batch_enabled
+from eval_batcher import EvalMicroBatcher
+from llm_cache import CachedChain, LazyPrompt, llm_cache
+from llm_limiter import llm_limiter
+from rate_limiter import FEEDBACK, GENERATION, llm_rate_limiter, priority_scope
+from llm_output import (
+    SCHEMA_HINTS,
+    canonical_json,
+    IncrementalJSONArrayParser,
+    aparse_with_reask,
+    eval_scale,
+    normalize_eval_item,
+    parse_with_reask,
+)
+from singleflight import SingleFlight, normalize_pairs, normalize_text
+from db.models import (
+    SessionLocal,
+    get_reference_answers,
+    session_scope,
+)
+from lesson_cache import lesson_cache
+from lesson_context import build_lesson_context, relevant_passages
+from pregrader import pregrader
+from tracing import set_grade, stage
+from utils import estimate_tokens, qna_dict_to_string
 from schemas import (
     LessonIn,
-    QuestionAnswer,
     QnAList,
     StudentAnswers,
-    EvalResult,
     EvalResultList,
 )
-import json
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
 # q stands for question/questions
 
+# Concurrent identical requests share one in-flight LLM call
+generation_flight = SingleFlight("generation")
+evaluation_flight = SingleFlight("evaluation")
+
 q_gen_template = """
-You are an expert tutor/ question generator. Given the following lesson text and some sample questions, generate 5 new short_answer questions that are similar to the examples provided. Ensure that their answer can be given in 50-100 words by a 8th grade level student. The level of the questions and answers should be such that a 8th grade level student living in rural India can answer it.
+You are an expert tutor/ question generator. Given the following lesson text and some sample questions, generate {num_questions} new short_answer questions that are similar to the examples provided. Ensure that their answer can be given in 50-100 words by a 8th grade level student. The level of the questions and answers should be such that a 8th grade level student living in rural India can answer it.
 
 Give the output as a JSON object with questions as keys and answers as values.
 
@@ -32,55 +58,165 @@ Answers to the sample questions:
 """
 
 
-q_gen_prompt = PromptTemplate(
+q_gen_prompt = LazyPrompt(
+    q_gen_template,
     input_variables=[
         "lesson_title",
         "lesson_content",
         "sample-questions",
         "sample_question_answers",
+        "num_questions",
     ],
-    template=q_gen_template,
 )
 
-q_gen_chain = q_gen_prompt | llm
 
+def _valid_questions(text: str, inputs: dict) -> Optional[str]:
+    return canonical_json(text, "qna")
 
-def generate_q(lesson_title: str) -> QnAList:
-    db = next(get_db())
 
-    lesson = get_lesson(db, title=lesson_title)
-    if not lesson:
-        return QnAList(items=[])
+q_gen_chain = CachedChain(
+    q_gen_prompt,
+    llm,
+    llm_cache,
+    limiter=llm_limiter,
+    rate_limiter=llm_rate_limiter,
+    priority=GENERATION,
+    name="generation",
+    validate=_valid_questions,
+)
 
-    questions = get_questions(db, lesson_id=lesson.id)
-    qna_items = [
-        QuestionAnswer(question=q.question_text, answer=q.correct_answer)
-        for q in questions
-    ]
+
+def _generation_inputs(db, lesson, num_questions: int = 5) -> dict:
+    set_grade(lesson.grade_level)
+    questions = lesson_cache.get_questions(db, lesson_id=lesson.id)
 
     sample_questions = "\n".join([q.question_text for q in questions])
     sample_question_answers = "\n".join([q.correct_answer for q in questions])
 
-    response = q_gen_chain.invoke(
-        {
-            "lesson_title": lesson.title,
-            "lesson_content": lesson.content,
-            "sample_questions": sample_questions,
-            "sample_question_answers": sample_question_answers,
-        }
+    # Only the summary and the chunks closest to the sample QnA, within the token budget
+    fixed_tokens = sum(
+        estimate_tokens(part)
+        for part in (
+            q_gen_template,
+            lesson.title,
+            sample_questions,
+            sample_question_answers,
+        )
+    )
+    lesson_content, _ = build_lesson_context(
+        db,
+        lesson,
+        query=f"{sample_questions}\n{sample_question_answers}",
+        fixed_tokens=fixed_tokens,
     )
 
-    raw_output = response.content
-    try:
-        # Clean the output by removing markdown code fences
-        cleaned_output = raw_output.strip().lstrip("```json").rstrip("```").strip()
-        qna_dict = json.loads(cleaned_output)
-        # Convert dict to QnAList
-        items = [QuestionAnswer(question=k, answer=v) for k, v in qna_dict.items()]
-        return QnAList(items=items)
-    except json.JSONDecodeError:
+    return {
+        "lesson_title": lesson.title,
+        "lesson_content": lesson_content,
+        "sample_questions": sample_questions,
+        "sample_question_answers": sample_question_answers,
+        "num_questions": num_questions,
+    }
+
+
+def _lesson_generation_inputs(lesson_title: str, num_questions: int) -> Optional[dict]:
+    with session_scope() as db:
+        lesson = lesson_cache.get_lesson(db, title=lesson_title)
+        if not lesson:
+            return None
+        return _generation_inputs(db, lesson, num_questions)
+
+
+q_repair_template = """
+The following text was supposed to be {schema}, but it could not be parsed.
+
+Return only the corrected JSON, with no explanation and no code fences. Keep the content the same.
+
+Text:
+{output}
+"""
+
+q_repair_prompt = LazyPrompt(
+    q_repair_template,
+    input_variables=["schema", "output"],
+)
+
+
+def _valid_repair(text: str, inputs: dict) -> Optional[str]:
+    kind = next(k for k, hint in SCHEMA_HINTS.items() if hint == inputs["schema"])
+    return canonical_json(text, kind)
+
+
+# Only used when local repair of a response fails
+# Runs at the priority of the call whose output it repairs (see priority_scope)
+q_repair_chain = CachedChain(
+    q_repair_prompt,
+    llm,
+    llm_cache,
+    limiter=llm_limiter,
+    rate_limiter=llm_rate_limiter,
+    name="repair",
+    validate=_valid_repair,
+)
+
+
+def _reask(raw_output: str, schema: str) -> str:
+    return q_repair_chain.invoke({"schema": schema, "output": raw_output}).content
+
+
+async def _areask(raw_output: str, schema: str) -> str:
+    response = await q_repair_chain.ainvoke({"schema": schema, "output": raw_output})
+    return response.content
+
+
+def _parse_generated(raw_output: str) -> QnAList:
+    with stage("parse", "generation"):
+        return parse_with_reask(raw_output, "qna", _reask) or QnAList(items=[])
+
+
+async def _aparse_generated(raw_output: str) -> QnAList:
+    with stage("parse", "generation"):
+        return await aparse_with_reask(raw_output, "qna", _areask) or QnAList(items=[])
+
+
+def generate_q(
+    lesson_title: str, bypass_cache: bool = False, num_questions: int = 5
+) -> QnAList:
+    inputs = _lesson_generation_inputs(lesson_title, num_questions)
+    if inputs is None:
         return QnAList(items=[])
 
+    response = q_gen_chain.invoke(inputs, bypass_cache=bypass_cache)
+    return _parse_generated(response.content)
+
+
+async def agenerate_q(
+    lesson_title: str, bypass_cache: bool = False, num_questions: int = 5
+) -> QnAList:
+    """
+    Async variant of generate_q; the LLM call runs on the event loop through
+    the adaptive concurrency limiter instead of occupying a worker thread.
+    Concurrent calls for the same lesson are coalesced into one generation.
+    """
+    return await generation_flight.do(
+        ("generate_q", normalize_text(lesson_title), bypass_cache, num_questions),
+        lambda: _agenerate_q(lesson_title, bypass_cache, num_questions),
+    )
+
+
+async def _agenerate_q(
+    lesson_title: str, bypass_cache: bool, num_questions: int
+) -> QnAList:
+    # The lesson lookup and context selection query the DB
+    inputs = await asyncio.to_thread(
+        _lesson_generation_inputs, lesson_title, num_questions
+    )
+    if inputs is None:
+        return QnAList(items=[])
+
+    response = await q_gen_chain.ainvoke(inputs, bypass_cache=bypass_cache)
+    return await _aparse_generated(response.content)
+
 
 q_eval_template = """
 You are an expert evaluator of student answers at the 8th grade level. The students come from rural Indian villages. Keep in mind that English is not their first language. Given the questions and a student's answers, assess the quality of the answers based on the following criteria:
@@ -96,7 +232,7 @@ You should provide constructive feedback. The feedback should be encouraging and
 
 Provide your evaulation in this JSON format:
 {{
-    "score": <marks out of 10>,
+    "score": <marks out of 5>,
     "feedback": "<comment explaining the score (max 100 words)>"
 }}
 
@@ -109,15 +245,31 @@ Student's answers:
 {student_answers}
 """
 
-q_eval_prompt = PromptTemplate(
+q_eval_prompt = LazyPrompt(
+    q_eval_template,
     input_variables=[
         "qna",
         "student_answers",
     ],
-    template=q_eval_template,
 )
 
-q_eval_chain = q_eval_prompt | llm
+
+def _valid_evaluation(text: str, inputs: dict) -> Optional[str]:
+    # One graded element per question in the prompt
+    expected = sum(1 for line in inputs["qna"].splitlines() if line.startswith("Q: "))
+    return canonical_json(text, "eval", expected)
+
+
+q_eval_chain = CachedChain(
+    q_eval_prompt,
+    llm,
+    llm_cache,
+    limiter=llm_limiter,
+    rate_limiter=llm_rate_limiter,
+    priority=FEEDBACK,
+    name="evaluation",
+    validate=_valid_evaluation,
+)
 
 
 def eval_answers(qna: QnAList, student_answers: StudentAnswers) -> EvalResultList:
@@ -133,14 +285,180 @@ def eval_answers(qna: QnAList, student_answers: StudentAnswers) -> EvalResultLis
         }
     )
 
-    raw_output = response.content
+    with stage("parse", "evaluation"):
+        return parse_with_reask(response.content, "eval", _reask) or EvalResultList(
+            results=[]
+        )
+
+
+def _feedback_inputs(items: List[Tuple[str, str, str]]) -> dict:
+    # Format (question, student answer, reference) items for the prompt
+    qna_string = "\n".join([f"Q: {q}\nA: {ref}" for q, _, ref in items])
+    student_answers_string = "\n".join(
+        [f"Q: {q}\nStudent Answer: {a}" for q, a, _ in items]
+    )
+    return {
+        "qna": qna_string,
+        "student_answers": student_answers_string,
+    }
+
+
+def _evaluation_items(
+    lesson_title: str, qna: Dict[str, str]
+) -> Tuple[List[Tuple[str, str, str]], List[bool]]:
+    """
+    Pair each answer with a reference: the stored answer when the question is
+    one of ours, otherwise the closest passage from the lesson index. Also
+    returns which items have a stored answer, since only those can be
+    pre-graded locally.
+    """
+    questions = list(qna.keys())
+    db = SessionLocal()
     try:
-        cleaned_output = raw_output.strip().lstrip("```json").rstrip("```").strip()
-        eval_list = json.loads(cleaned_output)
-        results = [EvalResult(**item) for item in eval_list]
+        lesson = lesson_cache.get_lesson(db, title=lesson_title)
+        if not lesson:
+            references = {}
+            passages = {}
+        else:
+            set_grade(lesson.grade_level)
+            references = get_reference_answers(db, lesson.id, questions)
+            missing = [q for q in questions if q not in references]
+            passages = (
+                dict(zip(missing, relevant_passages(db, lesson, missing)))
+                if missing
+                else {}
+            )
+    finally:
+        db.close()
+    items = [
+        (q, a, references.get(q) or passages.get(q) or "Not available")
+        for q, a in qna.items()
+    ]
+    return items, [bool(references.get(q)) for q in questions]
+
+
+eval_batcher = EvalMicroBatcher(q_eval_chain, _feedback_inputs)
+
+
+async def aevaluate_qna(
+    lesson_title: str, qna: Dict[str, str]
+) -> Optional[EvalResultList]:
+    """
+    Grade a student's question -> answer mapping, one result per question
+    (None for any the model's output didn't grade). Returns None if the
+    output could not be parsed even after repair.
+    Identical submissions (after whitespace normalization) that arrive while
+    one is being graded share its result. With EVAL_BATCH_ENABLED, different
+    submissions arriving together are graded in one packed prompt.
+    """
+    key = ("evaluate", normalize_text(lesson_title), normalize_pairs(qna.items()))
+
+    async def run_evaluation():
+        items, has_reference = await asyncio.to_thread(
+            _evaluation_items, lesson_title, qna
+        )
+        pregraded = pregrader.grade(items, has_reference)
+        escalated = [item for item, r in zip(items, pregraded) if r is None]
+        graded = iter([])
+        if escalated:
+            if eval_batch_enabled:
+                raw_output = await eval_batcher.evaluate(escalated)
+            else:
+                response = await q_eval_chain.ainvoke(_feedback_inputs(escalated))
+                raw_output = response.content
+            with stage("parse", "evaluation"):
+                parsed = await aparse_with_reask(raw_output, "eval", _areask)
+            if parsed is None:
+                return None
+            graded = iter(parsed.results)
+
+        # Put local and model grades back in question order; answers past the
+        # end of the model's array stay ungraded
+        results = [
+            result if result is not None else next(graded, None) for result in pregraded
+        ]
         return EvalResultList(results=results)
-    except json.JSONDecodeError:
-        return EvalResultList(results=[])
+
+    # Repair calls made while grading run at feedback priority too
+    with priority_scope(FEEDBACK):
+        return await evaluation_flight.do(key, run_evaluation)
+
+
+async def astream_evaluation(
+    lesson_title: str, qna: Dict[str, str]
+) -> AsyncIterator[Optional[dict]]:
+    """
+    Grade a submission and yield each answer's evaluation object, in question
+    order, as soon as it is known: locally pre-graded answers straight away,
+    the rest as the model finishes writing them. Scores are put on the 0-5
+    scale the first scored element implies (llm_output.eval_scale), as
+    /feedback does. If the stream yields fewer grades than were asked for
+    (single quotes, prose, a truncated array), the whole response goes
+    through the same repair and re-ask as /feedback for the remaining
+    answers. An answer whose grade still can't be read yields None.
+    """
+    items, has_reference = await asyncio.to_thread(_evaluation_items, lesson_title, qna)
+    pregraded = pregrader.grade(items, has_reference)
+    escalated = [item for item, r in zip(items, pregraded) if r is None]
+
+    position = 0
+
+    def local_grades():
+        nonlocal position
+        while position < len(pregraded) and pregraded[position] is not None:
+            local = pregraded[position]
+            yield {"score": local.score, "feedback": local.feedback}
+            position += 1
+
+    def model_grade(result) -> Optional[dict]:
+        nonlocal position
+        position += 1
+        if result is None:
+            return None
+        return {"score": result.score, "feedback": result.feedback}
+
+    for grade in local_grades():
+        yield grade
+    if not escalated:
+        return
+
+    parser = IncrementalJSONArrayParser()
+    chunks = []
+    scale = None
+    streamed = 0
+    async for chunk in q_eval_chain.astream(_feedback_inputs(escalated)):
+        chunks.append(chunk)
+        with stage("parse", "evaluation"):
+            elements = parser.feed(chunk)
+        for element in elements:
+            if streamed >= len(escalated):
+                break
+            scale = scale or eval_scale(element)
+            streamed += 1
+            yield model_grade(normalize_eval_item(element, scale))
+            for grade in local_grades():
+                yield grade
+
+    if streamed >= len(escalated):
+        return
+    # Repair calls run at feedback priority, as in aevaluate_qna
+    with priority_scope(FEEDBACK), stage("parse", "evaluation"):
+        parsed = await aparse_with_reask("".join(chunks), "eval", _areask)
+    remaining = parsed.results[streamed : len(escalated)] if parsed else []
+    for result in remaining:
+        yield model_grade(result)
+        for grade in local_grades():
+            yield grade
+
+
+def warm_up():
+    """
+    Build what the first LLM request would otherwise wait for: the model
+    client and the prompt templates.
+    """
+    get_llm()
+    for prompt in (q_gen_prompt, q_repair_prompt, q_eval_prompt):
+        prompt.build()
 
 
 if __name__ == "__main__":
@@ -1,16 +1,82 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Dict
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from typing import Any, List, Dict, Optional
+from contextlib import asynccontextmanager
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from db.models import get_db, get_lesson, get_lessons_by_grade, get_questions, Lesson
-from agent import generate_q
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import time
+from sqlalchemy.orm import Session
+from db.models import (
+    get_db,
+    get_lessons_by_grade,
+    session_scope,
+    upsert_questions,
+    engine,
+)
+from db.migrations import migrate
+from lesson_cache import LessonRecord, lesson_cache
+from lesson_content import (
+    body_cache,
+    choose_encoding,
+    compress,
+    iter_chunks,
+    parse_range,
+)
+from agent import aevaluate_qna, astream_evaluation, warm_up
+from config import profiling_admin_token, startup_warmup, tracing_enabled
+from profiling import (
+    FORMATS as PROFILE_FORMATS,
+    ProfilingMiddleware,
+    allocation_profiles,
+    render as render_profile,
+    request_profiler,
+    set_allocation_tracing,
+)
+from question_bank import QuestionBank
+from tracing import (
+    METRICS_CONTENT_TYPE,
+    TracingMiddleware,
+    register_collectors,
+    render_metrics,
+    set_grade,
+)
+
+question_bank = QuestionBank()
+
+
+def _warm_up():
+    start = time.perf_counter()
+    try:
+        with session_scope() as db:
+            lesson_cache.lesson_page(db)
+        warm_up()
+    except Exception as e:
+        print(f"Warm-up failed (the first requests will do it instead): {e}")
+        return
+    print(f"Warm-up done in {time.perf_counter() - start:.2f}s")
 
-app = FastAPI()
 
-# Create thread pool for CPU-bound tasks
-executor = ThreadPoolExecutor(max_workers=4)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Brings an existing database file up to the current schema (tables and indexes)
+    migrate(engine)
+    register_collectors(question_bank)
+    warming = None
+    if startup_warmup:
+        # In a worker thread, so it doesn't hold up the server from listening
+        warming = asyncio.get_running_loop().run_in_executor(None, _warm_up)
+    yield
+    if warming is not None:
+        await warming
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -19,8 +85,16 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Total-Count", "X-Next-Cursor", "Link", "Server-Timing"],
 )
 
+# Does nothing unless a sample rate is set (PROFILING_SAMPLE_RATE or /admin/profile)
+app.add_middleware(ProfilingMiddleware)
+
+if tracing_enabled:
+    # Outermost, so request latency includes every other middleware
+    app.add_middleware(TracingMiddleware)
+
 
 class LessonOut(BaseModel):
     id: str
@@ -42,23 +116,105 @@ class FeedbackRequest(BaseModel):
     qna: Dict[str, str]
 
 
+class QuestionIn(BaseModel):
+    lesson_id: Optional[str] = None
+    lesson_title: Optional[str] = None
+    question_type: str = "short_answer"
+    question_text: str
+    options: Optional[Dict[str, str]] = None  # multiple_choice: {"A": ..., "B": ...}
+    correct_answer: Optional[str] = None
+
+
+class BulkQuestionsRequest(BaseModel):
+    items: List[QuestionIn] = Field(..., max_length=50000)
+
+
+class ProfilingSettings(BaseModel):
+    sample_rate: Optional[float] = Field(None, ge=0, le=1)
+    interval_ms: Optional[float] = Field(None, ge=0.1)
+    allocations: Optional[bool] = None  # start/stop tracemalloc
+    reset: bool = False  # drop the samples collected so far
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so a W/ prefix still matches
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+def _json_with_etag(
+    request: Request, payload: Any, headers: Optional[Dict[str, str]] = None
+) -> Response:
+    """
+    JSON response with a strong ETag over its exact bytes; answers a matching
+    If-None-Match with an empty 304.
+    """
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    # no-cache: the browser may keep the body but must revalidate each time
+    headers = {**(headers or {}), "ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def _encode_cursor(title: str) -> str:
+    return base64.urlsafe_b64encode(title.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> str:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return base64.b64decode(padded, altchars=b"-_", validate=True).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+# Plain-DB endpoints are sync so FastAPI runs them in its threadpool, off the
+# event loop; the get_db dependency closes the session after the response.
+# Lessons and questions come from the read-through lesson_cache.
 @app.get("/lessons", response_model=List[LessonOut])
-async def list_lessons():
-    db = next(get_db())
-    lessons = db.query(Lesson).all()
-    return [
-        LessonOut(id=str(l.id), title=l.title, grade_level=l.grade_level)
-        for l in lessons
-    ]
+def list_lessons(
+    request: Request,
+    grade_level: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=500),
+    db: Session = Depends(get_db),
+):
+    """
+    Lessons ordered by title, ``limit`` at a time. The total number of matching
+    lessons is in X-Total-Count; pass X-Next-Cursor back as ``cursor`` for the
+    next page (absent on the last one).
+    """
+    set_grade(grade_level)
+    after_title = _decode_cursor(cursor) if cursor else None
+    lessons, total = lesson_cache.lesson_page(db, grade_level, after_title, limit)
+
+    headers = {"X-Total-Count": str(total)}
+    if len(lessons) == limit:
+        next_cursor = _encode_cursor(lessons[-1].title)
+        params = {"cursor": next_cursor, "limit": limit}
+        if grade_level is not None:
+            params["grade_level"] = grade_level
+        headers["X-Next-Cursor"] = next_cursor
+        headers["Link"] = f'<{request.url.include_query_params(**params)}>; rel="next"'
+    return _json_with_etag(
+        request,
+        [{"id": str(l.id), "title": l.title, "grade_level": l.grade_level} for l in lessons],
+        headers,
+    )
 
 
 @app.post(
     "/generate-questions"
 )  # TODO: lesson title being used right now, update to use lesson id later.
 async def generate_questions(req: GenerateQuestionsRequest):
-    # Run the AI operation in a thread pool to avoid blocking
-    loop = asyncio.get_event_loop()
-    qna_list = await loop.run_in_executor(executor, generate_q, req.lesson_title)
+    # Served from the generated-question bank; the LLM only runs to refill it
+    qna_list = await question_bank.sample(req.lesson_title)
 
     if not qna_list.items:
         raise HTTPException(
@@ -70,118 +226,261 @@ async def generate_questions(req: GenerateQuestionsRequest):
     return qna_dict
 
 
+@app.post("/questions/bulk")
+def bulk_upsert_questions(req: BulkQuestionsRequest, db: Session = Depends(get_db)):
+    """
+    Import seed questions for any number of lessons in one transaction.
+    Questions already stored for the lesson (same text up to case, spacing
+    and trailing punctuation) are updated in place rather than duplicated.
+    Every item gets a result in ``results``, in request order.
+    """
+    results = upsert_questions(db, [item.model_dump() for item in req.items])
+    counts: Dict[str, int] = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    if counts.get("created") or counts.get("updated"):
+        # upsert_questions bumped the shared version; drop our copies right away
+        lesson_cache.invalidate()
+    return {"counts": counts, "results": results}
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """
+    Prometheus metrics: request and per-stage latency histograms, LLM calls,
+    tokens and estimated cost (see tracing.py).
+    """
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+
+def _require_profiling_admin(request: Request):
+    if not profiling_admin_token:
+        # Profiling routes don't exist unless a token is configured
+        raise HTTPException(status_code=404, detail="Not Found")
+    supplied = request.headers.get("authorization", "").removeprefix("Bearer ").strip()
+    if not hmac.compare_digest(supplied.encode(), profiling_admin_token.encode()):
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid admin token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+@app.get(
+    "/admin/profile",
+    dependencies=[Depends(_require_profiling_admin)],
+    include_in_schema=False,
+)
+def profiling_status():
+    return request_profiler.status()
+
+
+@app.post(
+    "/admin/profile",
+    dependencies=[Depends(_require_profiling_admin)],
+    include_in_schema=False,
+)
+def update_profiling(settings: ProfilingSettings):
+    """
+    Change the sampled fraction of requests or the sampling interval, switch
+    allocation tracing on or off, or clear the collected samples, without a
+    restart. Applies to the worker that serves this request.
+    """
+    if settings.sample_rate is not None:
+        request_profiler.sample_rate = settings.sample_rate
+    if settings.interval_ms is not None:
+        request_profiler.interval_ms = settings.interval_ms
+    if settings.allocations is not None:
+        set_allocation_tracing(settings.allocations)
+    if settings.reset:
+        request_profiler.reset()
+    return request_profiler.status()
+
+
+@app.get(
+    "/admin/profile/{kind}",
+    dependencies=[Depends(_require_profiling_admin)],
+    include_in_schema=False,
+)
+def download_profile(
+    kind: str,
+    format: str = "collapsed",
+    endpoint: Optional[str] = None,
+    limit: int = Query(500, ge=1, le=10000),
+):
+    """
+    ``kind`` is "cpu" (the sampled requests, optionally one ``endpoint``) or
+    "allocations" (live memory allocated since tracing was switched on, by
+    the ``limit`` largest stacks), in ``format`` top, collapsed or
+    speedscope.
+    """
+    if format not in PROFILE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(PROFILE_FORMATS)}")
+    if kind == "cpu":
+        profiles = request_profiler.snapshot()
+        if endpoint is not None:
+            profiles = {endpoint: profiles[endpoint]} if endpoint in profiles else {}
+    elif kind == "allocations":
+        profiles = allocation_profiles(limit=limit)
+    else:
+        raise HTTPException(status_code=404, detail="Unknown profile kind")
+    body, media_type = render_profile(
+        profiles, format, kind == "allocations", request_profiler.interval_ms
+    )
+    extension = "json" if format == "speedscope" else "txt"
+    return Response(
+        body,
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="{kind}-profile.{extension}"'
+        },
+    )
+
+
 @app.post("/submit-answers")
 async def submit_answers(req: SubmitAnswersRequest):
     # For now, just echo back the answers. You can expand this to store in DB.
     return {"received": req.answers}
 
 
-@app.post("/feedback")
-async def get_feedback(req: FeedbackRequest):
-    from agent import q_eval_chain
-    import json
+FALLBACK_FEEDBACK = "Thank you for your response. Your tutor will review this and provide detailed feedback."
+
 
-    db = next(get_db())
-    lesson = get_lesson(db, title=req.lesson_title)
+def _require_lesson(lesson_title: str) -> LessonRecord:
+    # Blocking (a cache miss queries the DB): async routes call it through
+    # asyncio.to_thread. The session is closed before the LLM is awaited.
+    with session_scope() as db:
+        lesson = lesson_cache.get_lesson(db, title=lesson_title)
     if not lesson:
         raise HTTPException(
-            status_code=404, detail=f"Lesson '{req.lesson_title}' not found."
+            status_code=404, detail=f"Lesson '{lesson_title}' not found."
         )
+    set_grade(lesson.grade_level)
+    return lesson
+
+
+def _format_feedback_item(i: int, item: dict, qna: Dict[str, str]) -> dict:
+    questions_list = list(qna.keys())
+    answers_list = list(qna.values())
+    return {
+        "questionId": i + 1,
+        "question": (
+            questions_list[i] if i < len(questions_list) else f"Question {i + 1}"
+        ),
+        "answer": answers_list[i] if i < len(answers_list) else "No answer provided",
+        "feedback": item.get("feedback", "No feedback available"),
+        "score": item.get("score", 0) * 20,  # Convert 0-5 scale to 0-100
+    }
+
+
+def _fallback_feedback_item(i: int, question: str, answer: str) -> dict:
+    return {
+        "questionId": i + 1,
+        "question": question,
+        "answer": answer,
+        "feedback": FALLBACK_FEEDBACK,
+        "score": 70,
+    }
 
-    # Format QnA for the prompt
-    qna_string = "\n".join([f"Q: {q}\nA: {a}" for q, a in req.qna.items()])
-    student_answers_string = "\n".join(
-        [f"Q: {q}\nStudent Answer: {a}" for q, a in req.qna.items()]
-    )
 
-    # Run the AI evaluation in a thread pool to avoid blocking
-    loop = asyncio.get_event_loop()
-
-    def run_evaluation():
-        return q_eval_chain.invoke(
-            {
-                "qna": qna_string,
-                "student_answers": student_answers_string,
-            }
-        )
+@app.post("/feedback")
+async def get_feedback(req: FeedbackRequest):
+    await asyncio.to_thread(_require_lesson, req.lesson_title)
 
-    response = await loop.run_in_executor(executor, run_evaluation)
+    # Parsed, repaired and validated against EvalResultList by the agent
+    evaluation = await aevaluate_qna(req.lesson_title, req.qna)
 
-    try:
-        # Try to parse the JSON response from the LLM
-        cleaned_output = (
-            response.content.strip().lstrip("```json").rstrip("```").strip()
+    if evaluation and any(evaluation.results):
+        formatted_feedback = []
+        for i, (question, answer) in enumerate(req.qna.items()):
+            result = evaluation.results[i] if i < len(evaluation.results) else None
+            if result is None:
+                # Answers the model didn't grade get the fallback on their own
+                formatted_feedback.append(_fallback_feedback_item(i, question, answer))
+            else:
+                item = {"score": result.score, "feedback": result.feedback}
+                formatted_feedback.append(_format_feedback_item(i, item, req.qna))
+
+        # Calculate overall score
+        overall_score = sum(item["score"] for item in formatted_feedback) / len(
+            formatted_feedback
         )
-        feedback_data = json.loads(cleaned_output)
-
-        # Transform the feedback to match frontend format
-        if isinstance(feedback_data, list):
-            # If it's already a list of feedback items
-            questions_list = list(req.qna.keys())
-            formatted_feedback = []
-
-            for i, item in enumerate(feedback_data):
-                formatted_feedback.append(
-                    {
-                        "questionId": i + 1,
-                        "question": (
-                            questions_list[i]
-                            if i < len(questions_list)
-                            else f"Question {i + 1}"
-                        ),
-                        "answer": (
-                            list(req.qna.values())[i]
-                            if i < len(req.qna)
-                            else "No answer provided"
-                        ),
-                        "feedback": item.get("feedback", "No feedback available"),
-                        "score": item.get("score", 0)
-                        * 20,  # Convert 0-5 scale to 0-100
-                    }
-                )
-
-            # Calculate overall score
-            total_score = sum(item.get("score", 0) for item in feedback_data)
-            overall_score = (
-                (total_score / len(feedback_data)) * 20 if feedback_data else 0
-            )
 
-            return {"feedback": formatted_feedback, "score": round(overall_score)}
-        else:
-            # Fallback if not a list
-            raise ValueError("Expected list format")
+        return {"feedback": formatted_feedback, "score": round(overall_score)}
 
-    except (json.JSONDecodeError, ValueError) as e:
-        # Fallback to simple feedback if JSON parsing fails
-        questions_list = list(req.qna.keys())
-        fallback_feedback = []
+    # Fallback to simple feedback if the output could not be recovered
+    fallback_feedback = [
+        _fallback_feedback_item(i, question, answer)
+        for i, (question, answer) in enumerate(req.qna.items())
+    ]
 
+    return {"feedback": fallback_feedback, "score": 70}
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/feedback/stream")
+async def stream_feedback(req: FeedbackRequest):
+    """
+    Server-Sent Events variant of /feedback. Emits a ``feedback`` event for each
+    answer as soon as the model has finished grading it, then a ``done`` event
+    carrying the overall score.
+    """
+    await asyncio.to_thread(_require_lesson, req.lesson_title)
+
+    async def events():
+        scores = []
+        try:
+            questions = list(req.qna.items())
+            async for item in astream_evaluation(req.lesson_title, req.qna):
+                i = len(scores)
+                if i >= len(questions):
+                    break
+                if isinstance(item, dict):
+                    formatted = _format_feedback_item(i, item, req.qna)
+                else:
+                    # Ungraded answer: fallback in its own slot, so later
+                    # grades stay with their questions
+                    formatted = _fallback_feedback_item(i, *questions[i])
+                scores.append(formatted["score"])
+                yield _sse("feedback", formatted)
+        except Exception as e:
+            yield _sse("error", {"detail": f"Error evaluating answers: {str(e)}"})
+
+        # Anything the model didn't grade gets the same fallback as /feedback
         for i, (question, answer) in enumerate(req.qna.items()):
-            fallback_feedback.append(
-                {
-                    "questionId": i + 1,
-                    "question": question,
-                    "answer": answer,
-                    "feedback": "Thank you for your response. Your tutor will review this and provide detailed feedback.",
-                    "score": 70,
-                }
-            )
-
-        return {"feedback": fallback_feedback, "score": 70}
+            if i < len(scores):
+                continue
+            formatted = _fallback_feedback_item(i, question, answer)
+            scores.append(formatted["score"])
+            yield _sse("feedback", formatted)
+
+        overall_score = sum(scores) / len(scores) if scores else 0
+        yield _sse("done", {"score": round(overall_score)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.get("/lessons/{lesson_id}/questions")
-async def get_lesson_questions(lesson_id: str):
+def get_lesson_questions(
+    lesson_id: str, request: Request, db: Session = Depends(get_db)
+):
     """Get all questions for a specific lesson"""
-    db = next(get_db())
     try:
         # First check if lesson exists
-        lesson = get_lesson(db, lesson_id=lesson_id)
+        lesson = lesson_cache.get_lesson(db, lesson_id=lesson_id)
         if not lesson:
             raise HTTPException(status_code=404, detail="Lesson not found")
+        set_grade(lesson.grade_level)
         
         # Get questions for this lesson
-        questions = get_questions(db, lesson_id=lesson_id)
+        questions = lesson_cache.get_questions(db, lesson_id=lesson_id)
         
         # Format questions for frontend
         formatted_questions = []
@@ -192,40 +491,122 @@ async def get_lesson_questions(lesson_id: str):
                 "type": "short" if q.question_type == "short_answer" else "essay"
             })
         
-        return {
+        return _json_with_etag(request, {
             "lesson": {
                 "id": str(lesson.id),
                 "title": lesson.title,
                 "grade_level": lesson.grade_level
             },
             "questions": formatted_questions
-        }
+        })
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching questions: {str(e)}")
-    finally:
-        db.close()
 
 
 @app.get("/lessons/{lesson_id}")
-async def get_lesson_details(lesson_id: str):
+def get_lesson_details(lesson_id: str, request: Request, db: Session = Depends(get_db)):
     """Get lesson details by ID"""
-    db = next(get_db())
     try:
-        lesson = get_lesson(db, lesson_id=lesson_id)
+        lesson = lesson_cache.get_lesson(db, lesson_id=lesson_id)
         if not lesson:
             raise HTTPException(status_code=404, detail="Lesson not found")
+        set_grade(lesson.grade_level)
         
-        return {
+        return _json_with_etag(request, {
             "id": str(lesson.id),
             "title": lesson.title,
             "content": lesson.content,
             "grade_level": lesson.grade_level
-        }
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching lesson: {str(e)}")
-    finally:
-        db.close()
+
+
+@app.get("/lessons/{lesson_id}/content")
+def get_lesson_content(
+    lesson_id: str,
+    request: Request,
+    paragraphs: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    Stream a lesson's text as text/plain in paragraph-aligned chunks.
+    Supports a single byte Range (with If-Range), gzip/brotli for whole
+    responses, and ``?paragraphs=3`` or ``?paragraphs=0-9`` to fetch a
+    paragraph range; X-Paragraph-Count gives the total.
+    """
+    lesson = lesson_cache.get_lesson(db, lesson_id=lesson_id)
+    if not lesson:
+        raise HTTPException(status_code=404, detail="Lesson not found")
+    set_grade(lesson.grade_level)
+    body = body_cache.get(lesson.id, lesson.content)
+    # Only whole (200) responses are compressed; ranges are sent as-is
+    encoding = choose_encoding(request.headers.get("accept-encoding"))
+
+    selected = None
+    if paragraphs is not None:
+        first, _, last = paragraphs.partition("-")
+        try:
+            first, last = int(first), int(last or first)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="paragraphs must be N or N-M")
+        last = min(last, len(body.paragraphs) - 1)
+        if first < 0 or first > last:
+            raise HTTPException(status_code=416, detail="Paragraph range not satisfiable")
+        selected = (first, last)
+
+    headers = {
+        # A paragraph selection is its own representation, with its own tag
+        "ETag": body.etag_for(encoding, selected),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+        "X-Paragraph-Count": str(len(body.paragraphs)),
+    }
+    if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    status_code = 200
+    start, end = 0, len(body)
+    if selected is not None:
+        start, end = body.paragraph_span(*selected)
+    else:
+        # A stale If-Range means the client's partial copy is outdated: send it all
+        if_range = request.headers.get("if-range")
+        range_header = request.headers.get("range")
+        if if_range and if_range != body.etag:
+            range_header = None
+        try:
+            span = parse_range(range_header, len(body))
+        except ValueError:
+            return Response(
+                status_code=416, headers={"Content-Range": f"bytes */{len(body)}"}
+            )
+        if span is not None:
+            start, end = span
+            status_code = 206
+            encoding = None
+            headers["ETag"] = body.etag
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{len(body)}"
+
+    chunks = iter_chunks(body, start, end)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        content = compress(chunks, encoding)
+    else:
+        headers["Content-Length"] = str(end - start)
+        content = chunks
+    return StreamingResponse(
+        content,
+        status_code=status_code,
+        media_type="text/plain; charset=utf-8",
+        headers=headers,
+    )
 
 
 # To run: uvicorn api:app --reload
@@ -235,6 +616,7 @@ async def get_lesson_details(lesson_id: str):
 async def create_test_lesson():
     """Create a test lesson for development purposes"""
     from db.models import Lesson, Question, SessionLocal
+    from lesson_context import index_lesson
     import uuid
 
     db = SessionLocal()
@@ -260,7 +642,8 @@ Shakespeare's writing is renowned for its complex characters, intricate plots, a
         )
         if not existing:
             db.add(lesson)
-            db.commit()
+            index_lesson(db, lesson)
+            db.flush()
 
             # Add some sample questions
             questions = [
@@ -283,6 +666,8 @@ Shakespeare's writing is renowned for its complex characters, intricate plots, a
             for q in questions:
                 db.add(q)
 
+            # One version bump for the whole write, committed with it
+            lesson_cache.invalidate(db)
             db.commit()
             return {
                 "message": "Test lesson created successfully",
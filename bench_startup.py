@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark: how long the main modules take to import and how soon a
+freshly started API server serves its first requests.
+
+    python bench_startup.py [--runs 5] [--settle 1.0] [--lessons 10]
+
+Each import is timed in a fresh interpreter, as is building the Gemini
+client on first use (no request is sent). The server part seeds a temporary
+SQLite database and starts uvicorn on it with the fake model at zero
+latency, with STARTUP_WARMUP on and off, and reports:
+
+- ready: from spawning the process to the first successful GET /lessons;
+- first feedback: latency of the first POST /feedback (the first request
+  that needs the LLM chains), sent ``--settle`` seconds after ready;
+- next feedback: latency of a second one, for comparison.
+
+All figures are medians over ``--runs`` runs.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# (label, statement timed in a fresh interpreter after the setup)
+IMPORTS = [
+    ("import db.models", "", "import db.models"),
+    ("import llm", "", "import llm"),
+    ("import agent", "", "import agent"),
+    ("import api", "", "import api"),
+    ("get_llm() (Gemini client)", "import llm", "llm.get_llm()"),
+]
+
+
+def _median(values: List[float]) -> float:
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+def time_statement(setup: str, statement: str, env: Dict[str, str]) -> float:
+    code = (
+        f"import time\n{setup}\nstart = time.perf_counter()\n{statement}\n"
+        "print(time.perf_counter() - start)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=HERE,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def _feedback(client: httpx.Client, lesson, answer: str) -> float:
+    start = time.perf_counter()
+    response = client.post(
+        "/feedback",
+        json={
+            "lesson_title": lesson.title,
+            "qna": {f"What happens in {lesson.title}?": answer},
+        },
+    )
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+def time_server(
+    env: Dict[str, str], workdir: str, lesson, settle: float, run: int
+) -> Dict[str, float]:
+    from loadtest import _free_port, start_server
+
+    # A fresh response cache, so the feedback calls reach the model
+    env = dict(env, LLM_CACHE_PATH=os.path.join(workdir, f"llm_cache_{run}.db"))
+    port = _free_port()
+    log_path = os.path.join(workdir, "server.log")
+    start = time.perf_counter()
+    server = start_server(port, 1, env, log_path)
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=60) as client:
+            while True:
+                if server.poll() is not None:
+                    with open(log_path) as f:
+                        print(f.read()[-3000:])
+                    raise RuntimeError("server exited during startup")
+                try:
+                    if client.get("/lessons", params={"limit": 1}).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.005)
+            ready = time.perf_counter() - start
+            time.sleep(settle)
+            first = _feedback(client, lesson, f"The first answer of run {run}.")
+            following = _feedback(client, lesson, f"The second answer of run {run}.")
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    return {"ready": ready, "first feedback": first, "next feedback": following}
+
+
+def main(args) -> int:
+    workdir = tempfile.mkdtemp(prefix="bench-startup-")
+    env = dict(os.environ)
+    env.update(
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        LESSON_INDEX_PATH=os.path.join(workdir, "lesson_index"),
+        LLM_CACHE_PATH=os.path.join(workdir, "llm_cache.db"),
+        LLM_FAKE="true",
+        FAKE_LLM_LATENCY_MS="0",
+        LLM_RPM="0",
+        LLM_TPM="0",
+        LLM_CASSETTE_MODE="off",
+    )
+    env.setdefault("GOOGLE_API_KEY", "unused")
+    # The seeding below imports config, which reads these
+    os.environ.update(env)
+
+    try:
+        print(f"Import time (median of {args.runs}, fresh interpreter each):")
+        for label, setup, statement in IMPORTS:
+            import_env = env
+            if "get_llm" in statement:
+                import_env = dict(env, LLM_FAKE="false")
+            seconds = _median(
+                [time_statement(setup, statement, import_env) for _ in range(args.runs)]
+            )
+            print(f"  {label:<28} {seconds * 1000:8.0f} ms")
+
+        from loadtest import seed_database
+
+        lesson = seed_database(args.lessons, random.Random(0))[0]
+        print(f"\nServer startup (median of {args.runs}, fake model at 0 ms):")
+        print(f"  {'':<14}{'ready':>11}{'first feedback':>17}{'next feedback':>16}")
+        for warmup in ("true", "false"):
+            runs = [
+                time_server(
+                    dict(env, STARTUP_WARMUP=warmup), workdir, lesson, args.settle, n
+                )
+                for n in range(args.runs)
+            ]
+            medians = {key: _median([run[key] for run in runs]) for key in runs[0]}
+            label = "warm-up on" if warmup == "true" else "warm-up off"
+            print(
+                f"  {label:<14}{medians['ready'] * 1000:8.0f} ms"
+                f"{medians['first feedback'] * 1000:14.0f} ms"
+                f"{medians['next feedback'] * 1000:13.0f} ms"
+            )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=1.0,
+        help="seconds between ready and the first /feedback",
+    )
+    parser.add_argument("--lessons", type=int, default=10)
+    sys.exit(main(parser.parse_args()))
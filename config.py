@@ -10,3 +10,115 @@ llm_model_name = os.getenv("LLM_MODEL_NAME")
 database_url = os.getenv("DATABASE_URL")
 # embedding_model_name = os.getenv("EMBEDDING_MODEL_NAME")
 llm_temperature = os.getenv("LLM_TEMPERATURE")
+
+# Local fake chat model instead of Gemini (offline runs and benchmarks)
+llm_fake = os.getenv("LLM_FAKE", "false").lower() in ("1", "true", "yes")
+fake_llm_latency_ms = float(os.getenv("FAKE_LLM_LATENCY_MS", "50"))
+fake_llm_latency_dist = os.getenv("FAKE_LLM_LATENCY_DIST", "fixed")
+fake_llm_latency_sigma = float(os.getenv("FAKE_LLM_LATENCY_SIGMA", "0.5"))
+fake_llm_ms_per_token = float(os.getenv("FAKE_LLM_MS_PER_TOKEN", "0"))
+fake_llm_error_rate = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+fake_llm_rate_limit_rate = float(os.getenv("FAKE_LLM_RATE_LIMIT_RATE", "0"))
+fake_llm_malformed_rate = float(os.getenv("FAKE_LLM_MALFORMED_RATE", "0"))
+fake_llm_seed = int(os.getenv("FAKE_LLM_SEED", "0"))
+
+# Record/replay of raw LLM exchanges: off, record or replay (see llm_cassette.py)
+llm_cassette_mode = os.getenv("LLM_CASSETTE_MODE", "off").lower()
+llm_cassette_path = os.getenv("LLM_CASSETTE_PATH", "llm_cassette.jsonl.gz")
+llm_cassette_time_scale = float(os.getenv("LLM_CASSETTE_TIME_SCALE", "1.0"))
+
+# LLM response cache: in-process LRU in front of a SQLite file
+llm_cache_enabled = os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+llm_cache_path = os.getenv("LLM_CACHE_PATH", "llm_cache.db")
+llm_cache_ttl_seconds = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+llm_cache_memory_entries = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "256"))
+llm_cache_max_entries = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+llm_cache_max_bytes = int(os.getenv("LLM_CACHE_MAX_BYTES", str(100 * 1024 * 1024)))
+
+# Generated-question bank served by /generate-questions
+question_bank_sample_size = int(os.getenv("QUESTION_BANK_SAMPLE_SIZE", "5"))
+question_bank_low_water = int(os.getenv("QUESTION_BANK_LOW_WATER", "20"))
+question_bank_max_refill_rounds = int(os.getenv("QUESTION_BANK_MAX_REFILL_ROUNDS", "3"))
+question_generation_max = int(os.getenv("QUESTION_GENERATION_MAX", "10"))
+
+# Adaptive concurrency limit for async LLM calls
+llm_concurrency_initial = int(os.getenv("LLM_CONCURRENCY_INITIAL", "16"))
+llm_concurrency_min = int(os.getenv("LLM_CONCURRENCY_MIN", "2"))
+llm_concurrency_max = int(os.getenv("LLM_CONCURRENCY_MAX", "256"))
+llm_latency_target_seconds = float(os.getenv("LLM_LATENCY_TARGET_SECONDS", "15"))
+
+# Outbound Gemini quota shared by all chains (per minute; 0 = no limit)
+llm_rpm = int(os.getenv("LLM_RPM", "1000"))
+llm_tpm = int(os.getenv("LLM_TPM", "1000000"))
+llm_rate_batch_reserve = float(os.getenv("LLM_RATE_BATCH_RESERVE", "0.2"))
+llm_rate_max_retries = int(os.getenv("LLM_RATE_MAX_RETRIES", "3"))
+llm_rate_completion_tokens = int(os.getenv("LLM_RATE_COMPLETION_TOKENS", "500"))
+
+# Request tracing: per-stage timings and LLM usage on /metrics (see tracing.py)
+tracing_enabled = os.getenv("TRACING_ENABLED", "true").lower() in ("1", "true", "yes")
+tracing_server_timing = os.getenv("TRACING_SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+# USD per million tokens, for the cost estimate (Gemini 2.5 Flash list prices)
+llm_input_price_per_mtok = float(os.getenv("LLM_INPUT_PRICE_PER_MTOK", "0.30"))
+llm_output_price_per_mtok = float(os.getenv("LLM_OUTPUT_PRICE_PER_MTOK", "2.50"))
+
+# Sampling profiler (see profiling.py); the /admin/profile routes are off without a token
+profiling_sample_rate = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+profiling_interval_ms = float(os.getenv("PROFILING_INTERVAL_MS", "5"))
+profiling_max_stacks = int(os.getenv("PROFILING_MAX_STACKS", "20000"))
+# 0 leaves the GIL switch interval alone. A small value (e.g. 100) samples
+# pure-Python hot spots more evenly, but while any profiled request is in
+# flight every thread in the process hands over the GIL that often, which
+# slows all requests, not just the sampled ones.
+profiling_switch_interval_us = float(os.getenv("PROFILING_SWITCH_INTERVAL_US", "0"))
+profiling_admin_token = os.getenv("PROFILING_ADMIN_TOKEN", "")
+
+# Build the LLM client and prompts in the background once the server is up,
+# instead of on the first request that needs them
+startup_warmup = os.getenv("STARTUP_WARMUP", "true").lower() in ("1", "true", "yes")
+
+# Cross-request micro-batching of /feedback evaluations
+eval_batch_enabled = os.getenv("EVAL_BATCH_ENABLED", "false").lower() in ("1", "true", "yes")
+eval_batch_window_ms = int(os.getenv("EVAL_BATCH_WINDOW_MS", "30"))
+eval_batch_max_tokens = int(os.getenv("EVAL_BATCH_MAX_TOKENS", "6000"))
+eval_batch_max_items = int(os.getenv("EVAL_BATCH_MAX_ITEMS", "40"))
+
+# Token-budgeted lesson context for question generation
+lesson_chunk_tokens = int(os.getenv("LESSON_CHUNK_TOKENS", "200"))
+lesson_summary_tokens = int(os.getenv("LESSON_SUMMARY_TOKENS", "150"))
+generation_prompt_token_budget = int(os.getenv("GENERATION_PROMPT_TOKEN_BUDGET", "1500"))
+
+# Offline lesson retrieval index (hashed vectors in a memory-mapped matrix)
+lesson_index_path = os.getenv("LESSON_INDEX_PATH", "lesson_index")
+lesson_index_dim = int(os.getenv("LESSON_INDEX_DIM", "1024"))
+
+# Local pre-grading of clear-cut answers before escalating to the LLM
+pregrade_enabled = os.getenv("PREGRADE_ENABLED", "true").lower() in ("1", "true", "yes")
+pregrade_confidence_threshold = float(os.getenv("PREGRADE_CONFIDENCE_THRESHOLD", "0.85"))
+
+# Near-duplicate detection for generated questions (MinHash + LSH)
+dedupe_num_perm = int(os.getenv("DEDUPE_NUM_PERM", "128"))
+dedupe_bands = int(os.getenv("DEDUPE_BANDS", "32"))
+dedupe_threshold = float(os.getenv("DEDUPE_THRESHOLD", "0.6"))
+
+# Database connection pool and SQLite tuning
+db_pool_size = int(os.getenv("DB_POOL_SIZE", "20"))
+db_max_overflow = int(os.getenv("DB_MAX_OVERFLOW", "40"))
+db_pool_timeout = int(os.getenv("DB_POOL_TIMEOUT", "10"))
+db_pool_recycle = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+sqlite_busy_timeout_ms = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+sqlite_mmap_size = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+# In-process read-through cache for lessons and their seed questions
+lesson_cache_enabled = os.getenv("LESSON_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+lesson_cache_max_lessons = int(os.getenv("LESSON_CACHE_MAX_LESSONS", "512"))
+lesson_cache_check_seconds = float(os.getenv("LESSON_CACHE_CHECK_SECONDS", "1.0"))
+
+# Streamed lesson content (GET /lessons/{id}/content)
+lesson_content_chunk_bytes = int(os.getenv("LESSON_CONTENT_CHUNK_BYTES", "16384"))
+lesson_content_cache_bytes = int(os.getenv("LESSON_CONTENT_CACHE_BYTES", str(64 * 1024 * 1024)))
+lesson_content_gzip_level = int(os.getenv("LESSON_CONTENT_GZIP_LEVEL", "6"))
+
+# Offline question pre-generation (pregenerate.py)
+pregenerate_concurrency = int(os.getenv("PREGENERATE_CONCURRENCY", "8"))
+pregenerate_max_rpm = int(os.getenv("PREGENERATE_MAX_RPM", "60"))
+pregenerate_checkpoint_path = os.getenv("PREGENERATE_CHECKPOINT_PATH", "pregenerate.checkpoint.json")
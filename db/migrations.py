@@ -0,0 +1,372 @@
+"""
+Versioned schema migrations for the SQLite and Postgres databases.
+
+Each migration runs once, in its own transaction, and is recorded in the
+``schema_migrations`` table, so existing database files are upgraded in place.
+Processes migrating at the same time (e.g. several API workers starting) take
+turns: a Postgres advisory lock, or a file lock next to the SQLite file.
+Statements are written to be safe on a database whose tables were just created
+from the current models (``IF NOT EXISTS`` everywhere). Migrations never read
+the live models, so what a version creates can't change after it ships.
+
+    python -m db.migrations upgrade   # apply pending migrations
+    python -m db.migrations status    # show applied/pending versions
+    python -m db.migrations check     # verify hot queries use their indexes
+"""
+
+import os
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock for SQLite
+    fcntl = None
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    ForeignKey,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    text,
+)
+from sqlalchemy.engine import Connection, Engine
+
+from db.models import engine as default_engine
+
+# Arbitrary key for pg_advisory_lock, shared by every process migrating
+ADVISORY_LOCK_KEY = 0x7475746F72  # "tutor"
+
+
+class MigrationError(Exception):
+    pass
+
+
+# The tables as migration 1 first created them. A frozen copy, not the live
+# models: later model changes need a migration of their own, so a fresh
+# database and an upgraded one end up with the same schema.
+_baseline_metadata = MetaData()
+Table(
+    "lessons",
+    _baseline_metadata,
+    Column("id", String(36), primary_key=True),
+    Column("title", String(200), nullable=False, unique=True, index=True),
+    Column("content", Text, nullable=False),
+    Column("grade_level", Integer, nullable=False, index=True),
+)
+Table(
+    "questions",
+    _baseline_metadata,
+    Column("id", String(36), primary_key=True),
+    Column(
+        "lesson_id", String(36), ForeignKey("lessons.id"), nullable=False, index=True
+    ),
+    Column("question_type", String(20), nullable=False, index=True),
+    Column("question_text", Text, nullable=False),
+    Column("options", Text),
+    Column("correct_answer", Text),
+)
+Table(
+    "generated_questions",
+    _baseline_metadata,
+    Column("id", String(36), primary_key=True),
+    Column(
+        "lesson_id", String(36), ForeignKey("lessons.id"), nullable=False, index=True
+    ),
+    Column("question_type", String(20), nullable=False),
+    Column("question_text", Text, nullable=False),
+    Column("correct_answer", Text),
+    Column("times_served", Integer, nullable=False),
+    Column("created_at", DateTime, nullable=False),
+)
+Table(
+    "lesson_chunks",
+    _baseline_metadata,
+    Column("id", String(36), primary_key=True),
+    Column(
+        "lesson_id", String(36), ForeignKey("lessons.id"), nullable=False, index=True
+    ),
+    Column("kind", String(10), nullable=False),
+    Column("position", Integer, nullable=False),
+    Column("text", Text, nullable=False),
+    Column("token_count", Integer, nullable=False),
+)
+
+
+def _baseline(conn: Connection):
+    # Tables not yet in the database (generated_questions, lesson_chunks, or
+    # everything on a fresh file)
+    _baseline_metadata.create_all(bind=conn)
+
+
+def _lesson_question_indexes(conn: Connection):
+    # The indexes doc/schema.sql declares; the models never created them
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_questions_lesson_id ON questions (lesson_id)"
+        )
+    )
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_questions_question_type "
+            "ON questions (question_type)"
+        )
+    )
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_lessons_grade_level ON lessons (grade_level)"
+        )
+    )
+
+
+def _unique_lesson_titles(conn: Connection):
+    duplicates = conn.execute(
+        text("SELECT title FROM lessons GROUP BY title HAVING COUNT(*) > 1")
+    ).fetchall()
+    if duplicates:
+        titles = ", ".join(repr(row[0]) for row in duplicates)
+        raise MigrationError(
+            f"Cannot add a unique index on lessons.title; duplicate titles: {titles}"
+        )
+    conn.execute(
+        text("CREATE UNIQUE INDEX IF NOT EXISTS ix_lessons_title ON lessons (title)")
+    )
+
+
+def _cache_versions(conn: Connection):
+    conn.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS cache_versions ("
+            "name VARCHAR(50) PRIMARY KEY, "
+            "version INTEGER NOT NULL DEFAULT 0)"
+        )
+    )
+
+
+def _lesson_listing_index(conn: Connection):
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_lessons_grade_level_title "
+            "ON lessons (grade_level, title)"
+        )
+    )
+
+
+def _chunk_existing_lessons(conn: Connection):
+    # Lessons stored before chunking existed; newer ones are chunked when
+    # they are written, so request paths never have to
+    from lesson_context import chunk_rows
+    from lesson_index import lesson_index
+
+    lessons = conn.execute(
+        text(
+            "SELECT id, content FROM lessons WHERE id NOT IN "
+            "(SELECT lesson_id FROM lesson_chunks)"
+        )
+    ).fetchall()
+    to_index = []
+    for lesson_id, content in lessons:
+        rows = chunk_rows(lesson_id, content)
+        conn.execute(
+            text(
+                "INSERT INTO lesson_chunks "
+                "(id, lesson_id, kind, position, text, token_count) "
+                "VALUES (:id, :lesson_id, :kind, :position, :text, :token_count)"
+            ),
+            rows,
+        )
+        to_index.append(
+            (lesson_id, [(r["id"], r["text"]) for r in rows if r["kind"] == "body"])
+        )
+    if to_index:
+        lesson_index.add_lessons(to_index)
+
+
+# (version, name, upgrade) in order; append new migrations, never edit old ones
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "baseline tables", _baseline),
+    (2, "lesson and question indexes", _lesson_question_indexes),
+    (3, "unique lesson titles", _unique_lesson_titles),
+    (4, "cache version counters", _cache_versions),
+    (5, "lesson listing index", _lesson_listing_index),
+    (6, "chunk lessons that predate chunking", _chunk_existing_lessons),
+]
+
+
+def _ensure_version_table(engine: Engine):
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                "version INTEGER PRIMARY KEY, "
+                "name VARCHAR(200) NOT NULL, "
+                "applied_at VARCHAR(32) NOT NULL)"
+            )
+        )
+
+
+def applied_versions(engine: Engine = default_engine) -> Dict[int, str]:
+    _ensure_version_table(engine)
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT version, applied_at FROM schema_migrations"))
+        return {version: applied_at for version, applied_at in rows}
+
+
+@contextmanager
+def _migration_lock(engine: Engine) -> Iterator[None]:
+    """
+    Hold a lock that only one migrating process at a time can have.
+    """
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as conn:
+            conn.execute(
+                text("SELECT pg_advisory_lock(:key)"), {"key": ADVISORY_LOCK_KEY}
+            )
+            conn.commit()
+            try:
+                yield
+            finally:
+                conn.execute(
+                    text("SELECT pg_advisory_unlock(:key)"), {"key": ADVISORY_LOCK_KEY}
+                )
+                conn.commit()
+        return
+    path = engine.url.database
+    if (
+        engine.dialect.name != "sqlite"
+        or fcntl is None
+        or path in (None, "", ":memory:")
+    ):
+        yield
+        return
+    with open(os.path.abspath(path) + ".migrate.lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def migrate(engine: Engine = default_engine, verbose: bool = False) -> List[int]:
+    """
+    Apply pending migrations in order. Returns the versions applied.
+    """
+    with _migration_lock(engine):
+        # Read under the lock: another process may just have applied them
+        done = applied_versions(engine)
+        applied = []
+        for version, name, upgrade in MIGRATIONS:
+            if version in done:
+                continue
+            with engine.begin() as conn:
+                upgrade(conn)
+                conn.execute(
+                    text(
+                        "INSERT INTO schema_migrations (version, name, applied_at) "
+                        "VALUES (:version, :name, :applied_at)"
+                    ),
+                    {
+                        "version": version,
+                        "name": name,
+                        "applied_at": datetime.utcnow().isoformat(timespec="seconds"),
+                    },
+                )
+            applied.append(version)
+            if verbose:
+                print(f"Applied migration {version}: {name}")
+    return applied
+
+
+# Hot queries and the index each one should use
+PLAN_CHECKS = [
+    (
+        "get_lesson by title",
+        "SELECT * FROM lessons WHERE title = :p",
+        "ix_lessons_title",
+    ),
+    (
+        "get_lesson_page",
+        "SELECT id, title, grade_level FROM lessons WHERE title > :p "
+        "ORDER BY title LIMIT 100",
+        "ix_lessons_title",
+    ),
+    (
+        "get_lesson_page by grade",
+        "SELECT id, title, grade_level FROM lessons WHERE grade_level = 4 "
+        "AND title > :p ORDER BY title LIMIT 100",
+        "ix_lessons_grade_level_title",
+    ),
+    (
+        "get_lessons_by_grade",
+        "SELECT * FROM lessons WHERE grade_level = :p",
+        "ix_lessons_grade_level",
+    ),
+    (
+        "get_questions",
+        "SELECT * FROM questions WHERE lesson_id = :p",
+        "ix_questions_lesson_id",
+    ),
+    (
+        "get_questions_by_type",
+        "SELECT * FROM questions WHERE question_type = :p",
+        "ix_questions_question_type",
+    ),
+]
+
+
+def query_plan(conn: Connection, sql: str) -> str:
+    if conn.dialect.name == "sqlite":
+        rows = conn.execute(text("EXPLAIN QUERY PLAN " + sql), {"p": "x"})
+        return "\n".join(str(row[-1]) for row in rows)
+    # Small tables would always get a seq scan on Postgres; ask what the
+    # planner does once scans are ruled out
+    conn.execute(text("SET LOCAL enable_seqscan = off"))
+    rows = conn.execute(text("EXPLAIN " + sql), {"p": "x"})
+    return "\n".join(str(row[0]) for row in rows)
+
+
+def check_query_plans(engine: Engine = default_engine) -> List[str]:
+    """
+    Return a failure message for each hot query whose plan does not use its
+    index; an empty list means every plan is as expected.
+    """
+    failures = []
+    with engine.connect() as conn:
+        for name, sql, index in PLAN_CHECKS:
+            with conn.begin():
+                plan = query_plan(conn, sql)
+            if index not in plan:
+                failures.append(f"{name}: expected {index}, got: {plan}")
+    return failures
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "upgrade"
+    if command == "upgrade":
+        applied = migrate(verbose=True)
+        print(
+            f"{len(applied)} migration(s) applied."
+            if applied
+            else "Schema is up to date."
+        )
+    elif command == "status":
+        done = applied_versions()
+        for version, name, _ in MIGRATIONS:
+            state = f"applied {done[version]}" if version in done else "pending"
+            print(f"{version:>3}  {name:<32} {state}")
+    elif command == "check":
+        failures = check_query_plans()
+        for failure in failures:
+            print(f"FAIL {failure}")
+        if failures:
+            sys.exit(1)
+        print(f"All {len(PLAN_CHECKS)} query plans use their indexes.")
+    else:
+        print(__doc__)
+        sys.exit(2)
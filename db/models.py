@@ -1,14 +1,97 @@
+import json
 import os
+import re
+import time
 import uuid
-from typing import Generator, List, Optional, Dict
+from contextlib import contextmanager
+from typing import Any, Generator, Iterator, List, Optional, Dict, Tuple
 
-from sqlalchemy import create_engine, Column, String, Integer, Text, ForeignKey
-from sqlalchemy.orm import sessionmaker, relationship, declarative_base, Session
+from datetime import datetime
 
-from config import database_url
+from sqlalchemy import (
+    create_engine,
+    event,
+    func,
+    Column,
+    DateTime,
+    Index,
+    String,
+    Integer,
+    Text,
+    ForeignKey,
+    insert,
+    update,
+)
+from sqlalchemy.orm import sessionmaker, relationship, declarative_base, Query, Session
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from config import (
+    database_url,
+    db_max_overflow,
+    db_pool_recycle,
+    db_pool_size,
+    db_pool_timeout,
+    sqlite_busy_timeout_ms,
+    sqlite_mmap_size,
+    tracing_enabled,
+)
+from tracing import record_stage
+
+
+def _engine_options(url: str) -> dict:
+    options = {
+        "echo": False,
+        "pool_timeout": db_pool_timeout,
+        "pool_size": db_pool_size,
+        "max_overflow": db_max_overflow,
+        "poolclass": QueuePool,
+    }
+    if not url.startswith("sqlite"):
+        options.update(pool_pre_ping=True, pool_recycle=db_pool_recycle)
+        return options
+
+    options["connect_args"] = {
+        "check_same_thread": False,
+        "timeout": sqlite_busy_timeout_ms / 1000,
+    }
+    if url in ("sqlite://", "sqlite:///:memory:"):
+        # Every new connection would be a fresh, empty in-memory database
+        options["poolclass"] = StaticPool
+        for key in ("pool_timeout", "pool_size", "max_overflow"):
+            del options[key]
+    return options
+
+
+engine = create_engine(database_url, **_engine_options(database_url))
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if engine.dialect.name != "sqlite":
+        return
+    # WAL lets readers run alongside a writer instead of queueing on the
+    # database lock; NORMAL sync is safe in WAL mode and skips an fsync per commit
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={sqlite_busy_timeout_ms}")
+    cursor.execute(f"PRAGMA mmap_size={sqlite_mmap_size}")
+    cursor.close()
+
+
+if tracing_enabled:
+    # Statement time counts toward the current request's "db" stage
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _statement_started(conn, cursor, statement, parameters, context, executemany):
+        conn.info["statement_started"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _statement_finished(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop("statement_started", None)
+        if started is not None:
+            record_stage("db", time.perf_counter() - started)
 
-# Create the SQLAlchemy engine with SQLite-specific settings
-engine = create_engine(database_url, echo=False, connect_args={"check_same_thread": False})
 
 # Create a configured "Session" class
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -21,19 +104,22 @@ class Lesson(Base):
     __tablename__ = "lessons"
 
     id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    title = Column(String(200), nullable=False)
+    title = Column(String(200), nullable=False, unique=True, index=True)
     content = Column(Text, nullable=False)
-    grade_level = Column(Integer, nullable=False)
+    grade_level = Column(Integer, nullable=False, index=True)
 
     questions = relationship("Question", back_populates="lesson")
 
+    # Serves the grade-filtered, title-ordered /lessons pages
+    __table_args__ = (Index("ix_lessons_grade_level_title", "grade_level", "title"),)
+
 
 class Question(Base):
     __tablename__ = "questions"
 
     id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    lesson_id = Column(String(36), ForeignKey("lessons.id"), nullable=False)
-    question_type = Column(String(20), nullable=False)
+    lesson_id = Column(String(36), ForeignKey("lessons.id"), nullable=False, index=True)
+    question_type = Column(String(20), nullable=False, index=True)
     question_text = Column(Text, nullable=False)
     options = Column(Text)  # JSON stored as text for SQLite
     correct_answer = Column(Text)
@@ -41,8 +127,85 @@ class Question(Base):
     lesson = relationship("Lesson", back_populates="questions")
 
 
+class GeneratedQuestion(Base):
+    """
+    Question/answer pairs produced by the LLM, kept as a per-lesson pool so that
+    /generate-questions can serve them without a fresh generation.
+    """
+
+    __tablename__ = "generated_questions"
+
+    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    lesson_id = Column(String(36), ForeignKey("lessons.id"), nullable=False, index=True)
+    question_type = Column(String(20), nullable=False, default="short_answer")
+    question_text = Column(Text, nullable=False)
+    correct_answer = Column(Text)
+    times_served = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    lesson = relationship("Lesson")
+
+
+class LessonChunk(Base):
+    """
+    A lesson split into token-counted pieces at ingest time, plus one
+    extractive summary row, so prompts can include only what fits a budget.
+    """
+
+    __tablename__ = "lesson_chunks"
+
+    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    lesson_id = Column(String(36), ForeignKey("lessons.id"), nullable=False, index=True)
+    kind = Column(String(10), nullable=False, default="body")  # body, summary
+    position = Column(Integer, nullable=False)
+    text = Column(Text, nullable=False)
+    token_count = Column(Integer, nullable=False)
+
+
+class CacheVersion(Base):
+    """
+    Counter bumped by every write to cached tables, so API processes can tell
+    their in-memory copies are stale (see lesson_cache).
+    """
+
+    __tablename__ = "cache_versions"
+
+    name = Column(String(50), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+def bump_cache_version(db: Session, name: str = "lessons"):
+    """
+    Mark cached ``name`` data as changed; commits with the caller's write.
+    """
+    row = db.get(CacheVersion, name)
+    if row is None:
+        db.add(CacheVersion(name=name, version=1))
+    else:
+        row.version += 1
+
+
+def get_cache_version(db: Session, name: str = "lessons") -> int:
+    row = db.get(CacheVersion, name)
+    return row.version if row else 0
+
+
 def get_db() -> Generator[Session, None, None]:
-    """Generator function to get a database session."""
+    """
+    Generator function to get a database session. Use it as a FastAPI
+    dependency (``Depends(get_db)``) so the session is closed after the
+    request; outside requests use ``session_scope``.
+    """
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    """Session for scripts and background work, closed on exit."""
     db = SessionLocal()
     try:
         yield db
@@ -63,11 +226,53 @@ def get_lesson(
     return None
 
 
+def get_lesson_chunks(db: Session, lesson_id: str) -> List[LessonChunk]:
+    """
+    Get a lesson's chunks (summary first, then body in reading order).
+    """
+    return (
+        db.query(LessonChunk)
+        .filter(LessonChunk.lesson_id == lesson_id)
+        .order_by(LessonChunk.kind.desc(), LessonChunk.position)
+        .all()
+    )
+
+
+def lessons_by_grade_query(db: Session, grade_level: int, *columns) -> Query:
+    """
+    Query for the lessons of a grade level, selecting only ``columns`` if given.
+    """
+    return db.query(*(columns or (Lesson,))).filter(Lesson.grade_level == grade_level)
+
+
 def get_lessons_by_grade(db: Session, grade_level: int) -> List[Lesson]:
     """
     Get a list of lessons for a specific grade level.
     """
-    return db.query(Lesson).filter(Lesson.grade_level == grade_level).all()
+    return lessons_by_grade_query(db, grade_level).all()
+
+
+def get_lesson_page(
+    db: Session,
+    grade_level: Optional[int] = None,
+    after_title: Optional[str] = None,
+    limit: int = 100,
+) -> Tuple[list, int]:
+    """
+    One page of (id, title, grade_level) rows ordered by title, starting after
+    ``after_title`` (keyset pagination), plus the total number of matching
+    lessons. Lesson content is never loaded.
+    """
+    columns = (Lesson.id, Lesson.title, Lesson.grade_level)
+    if grade_level is None:
+        query = db.query(*columns)
+        total = db.query(func.count(Lesson.id)).scalar()
+    else:
+        query = lessons_by_grade_query(db, grade_level, *columns)
+        total = lessons_by_grade_query(db, grade_level, func.count(Lesson.id)).scalar()
+    if after_title is not None:
+        query = query.filter(Lesson.title > after_title)
+    return query.order_by(Lesson.title).limit(limit).all(), total
 
 
 def get_questions(db: Session, lesson_id: str) -> List[Question]:
@@ -77,6 +282,48 @@ def get_questions(db: Session, lesson_id: str) -> List[Question]:
     return db.query(Question).filter(Question.lesson_id == lesson_id).all()
 
 
+def get_reference_answers(
+    db: Session, lesson_id: str, question_texts: List[str]
+) -> Dict[str, str]:
+    """
+    Stored answers (seed or generated) for the given question texts of a lesson.
+    """
+    answers = {}
+    for model in (GeneratedQuestion, Question):
+        rows = db.query(model.question_text, model.correct_answer).filter(
+            model.lesson_id == lesson_id, model.question_text.in_(question_texts)
+        )
+        for question_text, correct_answer in rows:
+            if correct_answer:
+                answers[question_text] = correct_answer
+    return answers
+
+
+def get_question_texts(db: Session, lesson_id: str) -> List[str]:
+    """
+    Texts of every question known for a lesson, seed and generated.
+    """
+    texts = []
+    for model in (Question, GeneratedQuestion):
+        texts += [
+            text
+            for (text,) in db.query(model.question_text).filter(
+                model.lesson_id == lesson_id
+            )
+        ]
+    return texts
+
+
+def count_question_texts(db: Session, lesson_id: str) -> int:
+    """
+    Count the questions get_question_texts returns for a lesson.
+    """
+    return sum(
+        db.query(func.count(model.id)).filter(model.lesson_id == lesson_id).scalar()
+        for model in (Question, GeneratedQuestion)
+    )
+
+
 def get_questions_by_type(
     db: Session, lesson_id: str, question_type: str
 ) -> List[Question]:
@@ -92,6 +339,142 @@ def get_questions_by_type(
     )
 
 
+QUESTION_TYPES = ("multiple_choice", "short_answer", "long_answer")
+
+
+def normalize_question(text: str) -> str:
+    """
+    Dedupe key for a question: case-folded, whitespace collapsed, trailing
+    punctuation dropped.
+    """
+    return re.sub(r"\s+", " ", text or "").strip().rstrip("?.! ").casefold()
+
+
+def _question_error(item: Dict[str, Any]) -> Optional[str]:
+    if not (item.get("question_text") or "").strip():
+        return "question_text is empty"
+    question_type = item.get("question_type") or "short_answer"
+    if question_type not in QUESTION_TYPES:
+        return f"unknown question_type {question_type!r}"
+    options = item.get("options")
+    if question_type == "multiple_choice":
+        if not options:
+            return "multiple_choice questions need options"
+        if item.get("correct_answer") not in (None, "") and (
+            item["correct_answer"] not in options
+        ):
+            return f"correct_answer {item['correct_answer']!r} is not an option key"
+    elif options:
+        return f"{question_type} questions take no options"
+    return None
+
+
+def upsert_questions(
+    db: Session, items: List[Dict[str, Any]], batch_size: int = 1000
+) -> List[Dict[str, Any]]:
+    """
+    Insert or update seed questions for any number of lessons in one
+    transaction.
+
+    Each item has ``lesson_id`` or ``lesson_title``, ``question_text``, and
+    optionally ``question_type`` (default short_answer), ``options`` (a
+    {"A": ...} dict, multiple choice only) and ``correct_answer``. Questions
+    are matched on (lesson, normalize_question(text)): a match has its type,
+    options and answer updated, later repeats within ``items`` are reported
+    as duplicates. Returns one ``{"index", "status", "id", "detail"}`` per
+    item, status being created, updated, unchanged, duplicate or error.
+    """
+    ids = {item["lesson_id"] for item in items if item.get("lesson_id")}
+    titles = {item["lesson_title"] for item in items if item.get("lesson_title")}
+    lesson_ids = set()
+    ids_by_title = {}
+    for chunk in _chunks(list(ids), batch_size):
+        lesson_ids.update(
+            lesson_id
+            for (lesson_id,) in db.query(Lesson.id).filter(Lesson.id.in_(chunk))
+        )
+    for chunk in _chunks(list(titles), batch_size):
+        ids_by_title.update(
+            (title, lesson_id)
+            for lesson_id, title in db.query(Lesson.id, Lesson.title).filter(
+                Lesson.title.in_(chunk)
+            )
+        )
+    lesson_ids.update(ids_by_title.values())
+
+    existing: Dict[Tuple[str, str], Question] = {}
+    for chunk in _chunks(list(lesson_ids), batch_size):
+        for question in db.query(Question).filter(Question.lesson_id.in_(chunk)):
+            key = (question.lesson_id, normalize_question(question.question_text))
+            existing.setdefault(key, question)
+
+    results = []
+    inserts, updates = [], []
+    seen = {}
+    for index, item in enumerate(items):
+        result = {"index": index, "status": "error", "id": None, "detail": None}
+        results.append(result)
+        lesson_id = item.get("lesson_id") or ids_by_title.get(item.get("lesson_title"))
+        if lesson_id not in lesson_ids:
+            result["detail"] = (
+                f"lesson {item.get('lesson_id') or item.get('lesson_title')!r} not found"
+            )
+            continue
+        error = _question_error(item)
+        if error:
+            result["detail"] = error
+            continue
+
+        key = (lesson_id, normalize_question(item["question_text"]))
+        if key in seen:
+            result.update(
+                status="duplicate", id=seen[key], detail="repeated in request"
+            )
+            continue
+        row = {
+            "lesson_id": lesson_id,
+            "question_type": item.get("question_type") or "short_answer",
+            "question_text": item["question_text"].strip(),
+            "options": json.dumps(item["options"]) if item.get("options") else None,
+            "correct_answer": item.get("correct_answer"),
+        }
+        question = existing.get(key)
+        if question is None:
+            row["id"] = str(uuid.uuid4())
+            inserts.append(row)
+            result["status"] = "created"
+        elif (question.question_type, question.options, question.correct_answer) != (
+            row["question_type"],
+            row["options"],
+            row["correct_answer"],
+        ):
+            row["id"] = question.id
+            del row["lesson_id"], row["question_text"]
+            updates.append(row)
+            result["status"] = "updated"
+        else:
+            row["id"] = question.id
+            result["status"] = "unchanged"
+        result["id"] = seen[key] = row["id"]
+
+    # executemany batches; loaded rows are expired so the session never
+    # flushes stale attributes over the bulk UPDATE
+    db.expire_all()
+    for chunk in _chunks(inserts, batch_size):
+        db.execute(insert(Question), chunk)
+    for chunk in _chunks(updates, batch_size):
+        db.execute(update(Question), chunk)
+    if inserts or updates:
+        bump_cache_version(db)
+    db.commit()
+    return results
+
+
+def _chunks(rows: list, size: int) -> Iterator[list]:
+    for start in range(0, len(rows), size):
+        yield rows[start : start + size]
+
+
 def add_questions_from_dict(db: Session, qna_dict: Dict[str, str], lesson_title: str):
     """
     Parses a dictionary of questions and answers and adds them to the Question table.
@@ -106,18 +489,93 @@ def add_questions_from_dict(db: Session, qna_dict: Dict[str, str], lesson_title:
         print(f"Error: Lesson with title '{lesson_title}' not found.")
         return
 
+    results = upsert_questions(
+        db,
+        [
+            {
+                "lesson_id": lesson.id,
+                "question_type": "short_answer",
+                "question_text": question_text,
+                "correct_answer": correct_answer,
+            }
+            for question_text, correct_answer in qna_dict.items()
+        ],
+    )
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    summary = ", ".join(f"{n} {status}" for status, n in counts.items())
+    print(f"\nQuestions for lesson '{lesson_title}': {summary or 'none given'}.")
+
+
+def count_generated_questions(db: Session, lesson_id: str) -> int:
+    """
+    Count the generated questions banked for a lesson.
+    """
+    return (
+        db.query(func.count(GeneratedQuestion.id))
+        .filter(GeneratedQuestion.lesson_id == lesson_id)
+        .scalar()
+    )
+
+
+def add_generated_questions(
+    db: Session, lesson_id: str, qna_dict: Dict[str, str]
+) -> int:
+    """
+    Bank generated question/answer pairs for a lesson, skipping questions that
+    are already in the pool. Returns the number of rows added. Near-duplicate
+    filtering is the caller's job (see question_dedupe).
+    """
+    existing = {
+        text
+        for (text,) in db.query(GeneratedQuestion.question_text).filter(
+            GeneratedQuestion.lesson_id == lesson_id
+        )
+    }
+    added = 0
     for question_text, correct_answer in qna_dict.items():
-        new_question = Question(
-            lesson_id=lesson.id,
-            question_type="short_answer",
-            question_text=question_text,
-            correct_answer=correct_answer,
-            options=None,  # No options for short_answer questions
+        if question_text in existing:
+            continue
+        db.add(
+            GeneratedQuestion(
+                lesson_id=lesson_id,
+                question_text=question_text,
+                correct_answer=correct_answer,
+            )
         )
-        db.add(new_question)
-        print(f"Staging question for addition: {question_text}")
-
+        existing.add(question_text)
+        added += 1
     db.commit()
-    print(
-        f"\nSuccessfully added {len(qna_dict)} questions for lesson '{lesson_title}' to the database."
+    return added
+
+
+def sample_generated_questions(
+    db: Session, lesson_id: str, limit: int
+) -> List[GeneratedQuestion]:
+    """
+    Pick ``limit`` banked questions for a lesson, preferring the least served
+    ones so consecutive students see different sets.
+    """
+    questions = (
+        db.query(GeneratedQuestion)
+        .filter(GeneratedQuestion.lesson_id == lesson_id)
+        .order_by(GeneratedQuestion.times_served, func.random())
+        .limit(limit)
+        .all()
     )
+    if questions:
+        # One relative UPDATE: concurrent samplers don't overwrite each other's
+        # counts, and a row deleted meanwhile is simply skipped
+        db.execute(
+            update(GeneratedQuestion)
+            .where(GeneratedQuestion.id.in_([q.id for q in questions]))
+            .values(times_served=GeneratedQuestion.times_served + 1)
+            .execution_options(synchronize_session=False)
+        )
+        # Detached, the loaded rows stay readable after the commit even if
+        # another writer deletes them
+        for q in questions:
+            db.expunge(q)
+        db.commit()
+    return questions
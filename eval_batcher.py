@@ -0,0 +1,160 @@
+"""
+Cross-request micro-batching for answer evaluation.
+
+q_eval_prompt already grades a list of answers and returns a JSON array, so
+evaluation items from concurrent /feedback requests are collected for a short
+window (or until a token budget is reached), packed into one prompt, and the
+returned array is split back to each waiting request in order.
+"""
+
+import asyncio
+import json
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import eval_batch_max_items, eval_batch_max_tokens, eval_batch_window_ms
+from llm_output import load_json
+from utils import estimate_tokens
+
+# (question, student answer, reference) as built by agent._feedback_inputs
+Item = Tuple[str, ...]
+
+
+class _Group:
+    """The evaluation items of one request, waiting for their grades."""
+
+    def __init__(self, items: List[Item], future: asyncio.Future):
+        self.items = items
+        self.future = future
+        self.tokens = sum(estimate_tokens(part) for item in items for part in item)
+
+
+def _parse_array(raw_output: str) -> Optional[list]:
+    data, _ = load_json(raw_output)
+    return data if isinstance(data, list) else None
+
+
+class EvalMicroBatcher:
+    def __init__(
+        self,
+        chain,
+        build_inputs: Callable[[List[Item]], dict],
+        window_ms: int = eval_batch_window_ms,
+        max_tokens: int = eval_batch_max_tokens,
+        max_items: int = eval_batch_max_items,
+    ):
+        self.chain = chain
+        self.build_inputs = build_inputs
+        self.window = window_ms / 1000.0
+        self.max_tokens = max_tokens
+        self.max_items = max_items
+
+        self._pending: List[_Group] = []
+        self._pending_tokens = 0
+        self._pending_items = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+
+        self.batches = 0
+        self.items = 0
+        self.requests = 0
+        self.fallbacks = 0
+
+    async def evaluate(self, items: List[Item]) -> str:
+        """
+        Queue one request's items and wait for the batch containing them.
+        Returns the request's slice of the evaluation as a JSON array string,
+        i.e. the same shape a direct q_eval_chain call would produce.
+        """
+        loop = asyncio.get_running_loop()
+        group = _Group(list(items), loop.create_future())
+
+        # A request that would overflow the current batch starts the next one
+        if self._pending and (
+            self._pending_tokens + group.tokens > self.max_tokens
+            or self._pending_items + len(group.items) > self.max_items
+        ):
+            self._flush()
+
+        self._pending.append(group)
+        self._pending_tokens += group.tokens
+        self._pending_items += len(group.items)
+        self.requests += 1
+
+        if (
+            self._pending_tokens >= self.max_tokens
+            or self._pending_items >= self.max_items
+        ):
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        return await group.future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        batch = self._pending
+        self._pending = []
+        self._pending_tokens = 0
+        self._pending_items = 0
+
+        task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: List[_Group]):
+        items = [item for group in batch for item in group.items]
+        self.batches += 1
+        self.items += len(items)
+
+        try:
+            response = await self.chain.ainvoke(self.build_inputs(items))
+            results = _parse_array(response.content)
+        except Exception as e:
+            for group in batch:
+                if not group.future.done():
+                    group.future.set_exception(e)
+            return
+
+        if len(batch) == 1:
+            self._resolve(batch[0], response.content)
+            return
+
+        if results is None or len(results) != len(items):
+            # The model lost track of the alignment; grade each request on its own
+            self.fallbacks += 1
+            await asyncio.gather(*(self._run_single(group) for group in batch))
+            return
+
+        offset = 0
+        for group in batch:
+            chunk = results[offset : offset + len(group.items)]
+            offset += len(group.items)
+            self._resolve(group, json.dumps(chunk))
+
+    async def _run_single(self, group: _Group):
+        try:
+            response = await self.chain.ainvoke(self.build_inputs(group.items))
+        except Exception as e:
+            if not group.future.done():
+                group.future.set_exception(e)
+            return
+        self._resolve(group, response.content)
+
+    @staticmethod
+    def _resolve(group: _Group, raw_output: str):
+        if not group.future.done():
+            group.future.set_result(raw_output)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "items": self.items,
+            "fallbacks": self.fallbacks,
+            "mean_batch_items": (self.items / self.batches) if self.batches else 0.0,
+        }
@@ -0,0 +1,240 @@
+"""
+Local stand-in for the Gemini chat model, selected with ``LLM_FAKE=true``
+(see llm.py).
+
+It recognizes the prompts in agent.py and answers each with JSON in the
+shape the real model is asked for: question generation gets the requested
+number of questions built from the lesson's own words, evaluation one score
+per question, and a repair prompt an empty object or array. Output is
+reproducible for a given ``FAKE_LLM_SEED`` and call order, which is enough to
+run batch jobs and benchmarks without network access or quota.
+
+Realism knobs (all ``FAKE_LLM_*`` in config.py):
+
+- latency: ``LATENCY_MS`` is the median, shaped by ``LATENCY_DIST`` (fixed,
+  uniform, exponential or lognormal, with ``LATENCY_SIGMA``), plus
+  ``MS_PER_TOKEN`` for each output token;
+- ``ERROR_RATE`` / ``RATE_LIMIT_RATE``: fraction of calls that fail with a
+  server error / a 429 carrying a retry-after;
+- ``MALFORMED_RATE``: fraction of responses with one of the defects
+  llm_output has to repair (prose around the JSON, single quotes, trailing
+  commas, truncation, or no JSON at all).
+"""
+
+import asyncio
+import json
+import math
+import random
+import re
+import threading
+import time
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Tuple
+
+from config import (
+    fake_llm_error_rate,
+    fake_llm_latency_dist,
+    fake_llm_latency_ms,
+    fake_llm_latency_sigma,
+    fake_llm_malformed_rate,
+    fake_llm_ms_per_token,
+    fake_llm_rate_limit_rate,
+    fake_llm_seed,
+)
+from utils import content_words, estimate_tokens
+
+if TYPE_CHECKING:
+    from langchain_core.messages import AIMessage, AIMessageChunk
+
+NUM_QUESTIONS_RE = re.compile(r"generate (\d+) new")
+STREAM_PIECE_CHARS = 40
+LATENCY_DISTS = ("fixed", "uniform", "exponential", "lognormal")
+MALFORMATIONS = ("prose", "single_quotes", "trailing_comma", "truncated", "refusal")
+
+# Padding vocabulary for lessons too short to draw distinct questions from
+FILLER_WORDS = (
+    "river village market teacher festival letter journey garden harvest "
+    "monsoon bridge train school friend mother father grandmother doctor "
+    "farmer kite lamp rain forest mountain temple bicycle story song "
+    "courage kindness promise secret lesson gift soldier war peace"
+).split()
+
+
+def prompt_kind(prompt: str) -> str:
+    """
+    Which agent.py prompt this is: "generation", "evaluation" or "repair".
+    """
+    if "could not be parsed" in prompt:
+        return "repair"
+    if "Student's answers:" in prompt:
+        return "evaluation"
+    return "generation"
+
+
+class FakeLLMError(Exception):
+    def __init__(self, message: str, code: int):
+        super().__init__(message)
+        self.code = code
+
+
+class FakeChatModel:
+    # Keeps fake responses apart from real ones in the LLM response cache
+    cache_namespace = "fake"
+
+    def __init__(
+        self,
+        latency_ms: float = fake_llm_latency_ms,
+        seed: int = fake_llm_seed,
+        latency_dist: str = fake_llm_latency_dist,
+        latency_sigma: float = fake_llm_latency_sigma,
+        ms_per_token: float = fake_llm_ms_per_token,
+        error_rate: float = fake_llm_error_rate,
+        rate_limit_rate: float = fake_llm_rate_limit_rate,
+        malformed_rate: float = fake_llm_malformed_rate,
+    ):
+        if latency_dist not in LATENCY_DISTS:
+            raise ValueError(
+                f"FAKE_LLM_LATENCY_DIST must be one of {', '.join(LATENCY_DISTS)}"
+            )
+        self.latency_ms = latency_ms
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.ms_per_token = ms_per_token
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.malformed_rate = malformed_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        self.calls = 0
+        self.errors = 0
+        self.malformed = 0
+
+    def respond(self, prompt: str) -> str:
+        """
+        Response text for a rendered agent.py prompt.
+        """
+        return self._respond(prompt, self._call_rng())[0]
+
+    def _call_rng(self) -> random.Random:
+        with self._lock:
+            self.calls += 1
+            return random.Random(self._random.random())
+
+    def _respond(self, prompt: str, rng: random.Random) -> Tuple[str, float]:
+        """
+        Response text and how long it takes, in seconds; raises the injected
+        errors.
+        """
+        roll = rng.random()
+        if roll < self.rate_limit_rate:
+            self.errors += 1
+            raise FakeLLMError("429 RESOURCE_EXHAUSTED. Please retry in 1s.", 429)
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.errors += 1
+            raise FakeLLMError("503 The model is overloaded.", 503)
+
+        kind = prompt_kind(prompt)
+        if kind == "repair":
+            text = "[]" if "JSON array" in prompt else "{}"
+        elif kind == "evaluation":
+            text = self._evaluation(prompt, rng)
+        else:
+            text = self._questions(prompt, rng)
+        if rng.random() < self.malformed_rate:
+            self.malformed += 1
+            text = self._malform(text, rng)
+        return text, self._latency(text, rng)
+
+    def _latency(self, text: str, rng: random.Random) -> float:
+        median = self.latency_ms
+        if not median:
+            ms = 0.0
+        elif self.latency_dist == "uniform":
+            spread = median * min(self.latency_sigma, 1.0)
+            ms = rng.uniform(median - spread, median + spread)
+        elif self.latency_dist == "exponential":
+            ms = rng.expovariate(math.log(2) / median)
+        elif self.latency_dist == "lognormal":
+            ms = rng.lognormvariate(math.log(median), self.latency_sigma)
+        else:
+            ms = median
+        return (ms + self.ms_per_token * estimate_tokens(text)) / 1000
+
+    def _questions(self, prompt: str, rng: random.Random) -> str:
+        match = NUM_QUESTIONS_RE.search(prompt)
+        count = int(match.group(1)) if match else 5
+        lesson = prompt.partition("Lesson content:")[2].partition(
+            "Lesson sample questions:"
+        )[0]
+        vocabulary = sorted(set(content_words(lesson)) | set(FILLER_WORDS))
+        qna = {}
+        while len(qna) < count:
+            # Mostly drawn words, so questions are not near-duplicates of each other
+            first, second, third = rng.sample(vocabulary, 3)
+            question = f"How are the {first}, the {second} and the {third} connected?"
+            qna[question] = (
+                f"The {first} and the {second} come together through the {third}, "
+                "which shows what the characters care about."
+            )
+        return "```json\n" + json.dumps(qna, indent=2) + "\n```"
+
+    def _evaluation(self, prompt: str, rng: random.Random) -> str:
+        section = prompt.partition("Questions and sample answers:")[2].partition(
+            "Student's answers:"
+        )[0]
+        count = sum(1 for line in section.splitlines() if line.startswith("Q: "))
+        results = [
+            {
+                "score": rng.randint(2, 5),
+                "feedback": "Good effort! You covered the main idea; add one "
+                "more detail from the lesson and check your verb tenses.",
+            }
+            for _ in range(count)
+        ]
+        return "```json\n" + json.dumps(results, indent=2) + "\n```"
+
+    def _malform(self, text: str, rng: random.Random) -> str:
+        kind = rng.choice(MALFORMATIONS)
+        body = text.removeprefix("```json\n").removesuffix("\n```")
+        if kind == "prose":
+            return f"Sure! Here is the result:\n{body}\nLet me know if you need more."
+        if kind == "single_quotes":
+            return body.replace('"', "'")
+        if kind == "trailing_comma":
+            return body[:-1].rstrip() + ",\n" + body[-1]
+        if kind == "truncated":
+            return text[: max(1, int(len(text) * 0.8))]
+        return "I'm sorry, I can't evaluate this right now."
+
+    def _pieces(self, text: str) -> List[str]:
+        return [
+            text[i : i + STREAM_PIECE_CHARS]
+            for i in range(0, len(text), STREAM_PIECE_CHARS)
+        ] or [""]
+
+    def invoke(self, prompt: str) -> "AIMessage":
+        from langchain_core.messages import AIMessage
+
+        text, latency = self._respond(prompt, self._call_rng())
+        if latency:
+            time.sleep(latency)
+        return AIMessage(content=text)
+
+    async def ainvoke(self, prompt: str) -> "AIMessage":
+        from langchain_core.messages import AIMessage
+
+        text, latency = self._respond(prompt, self._call_rng())
+        await asyncio.sleep(latency)
+        return AIMessage(content=text)
+
+    async def astream(self, prompt: str) -> AsyncIterator["AIMessageChunk"]:
+        from langchain_core.messages import AIMessageChunk
+
+        text, latency = self._respond(prompt, self._call_rng())
+        pieces = self._pieces(text)
+        for piece in pieces:
+            await asyncio.sleep(latency / len(pieces))
+            yield AIMessageChunk(content=piece)
+
+    def stats(self) -> Dict[str, int]:
+        return {"calls": self.calls, "errors": self.errors, "malformed": self.malformed}
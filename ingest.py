@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Bulk lesson ingestion from a directory tree of PDFs and text files.
+
+    python ingest.py lessons/ [--grade 4] [--workers 4] [--batch-size 50] [--dry-run]
+
+Every ``*.pdf`` / ``*.txt`` file becomes one lesson. Extraction (page by page
+for PDFs, line by line for text), normalization and chunking run in a process
+pool; lessons are written in batched transactions.
+
+- Title: the PDF's metadata title or file name; for text files a short first
+  line (as in lesson_text.txt), else the file name.
+- Grade: a ``grade4`` / ``grade_4`` / ``Grade 4`` directory in the path, else
+  ``--grade``.
+- Questions: an optional sidecar ``<name>.qna.json`` ({"question": "answer"})
+  or ``<name>.qna.txt`` (question line, answer lines, blank line between
+  pairs, as in qna.txt).
+
+Re-running is idempotent: lessons are matched on title, unchanged ones are
+skipped, changed ones are updated and re-chunked. Questions go through
+upsert_questions, so one already stored for the lesson (same text up to case,
+spacing and trailing punctuation) is updated rather than added again. PDF
+support needs the ``pypdf`` package.
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import unicodedata
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+GRADE_DIR_RE = re.compile(r"^grade[\s_-]*(\d+)$", re.IGNORECASE)
+PAGE_NUMBER_RE = re.compile(r"^\s*(page\s*)?\d+\s*$", re.IGNORECASE)
+SOURCE_SUFFIXES = (".pdf", ".txt")
+QNA_SUFFIXES = (".qna.json", ".qna.txt")
+
+
+class Extracted(NamedTuple):
+    path: str
+    title: str
+    grade_level: Optional[int]
+    content: str
+    chunks: List[str]
+    qna: Dict[str, str]
+    error: Optional[str] = None
+
+
+def find_sources(root: str) -> List[str]:
+    sources = []
+    for directory, _, files in os.walk(root):
+        for name in sorted(files):
+            lower = name.lower()
+            if lower.endswith(SOURCE_SUFFIXES) and not lower.endswith(QNA_SUFFIXES):
+                sources.append(os.path.join(directory, name))
+    return sorted(sources)
+
+
+def _pdf_pages(path: str) -> Iterator[str]:
+    from pypdf import PdfReader
+
+    # PdfReader parses pages lazily from the open file
+    with open(path, "rb") as f:
+        reader = PdfReader(f)
+        for page in reader.pages:
+            yield page.extract_text() or ""
+
+
+def _pdf_title(path: str) -> Optional[str]:
+    from pypdf import PdfReader
+
+    with open(path, "rb") as f:
+        metadata = PdfReader(f).metadata
+        return (metadata.title or "").strip() if metadata else None
+
+
+def _text_pages(path: str) -> Iterator[str]:
+    # Stream the file in paragraph-sized pieces instead of reading it whole
+    lines = []
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            lines.append(line)
+            if not line.strip() and len(lines) > 1:
+                yield "".join(lines)
+                lines = []
+    if lines:
+        yield "".join(lines)
+
+
+def normalize_page(text: str) -> List[str]:
+    """
+    Paragraphs of one page: Unicode-normalized, hyphenated line breaks joined,
+    wrapped lines unwrapped, page-number lines dropped.
+    """
+    text = unicodedata.normalize("NFKC", text).replace("\r\n", "\n").replace("\r", "\n")
+    text = re.sub(r"(\w)-\n(\w)", r"\1\2", text)
+    paragraphs = []
+    for block in re.split(r"\n\s*\n", text):
+        lines = [
+            line.strip()
+            for line in block.split("\n")
+            if line.strip() and not PAGE_NUMBER_RE.match(line)
+        ]
+        if lines:
+            paragraphs.append(re.sub(r"\s+", " ", " ".join(lines)))
+    return paragraphs
+
+
+def _grade_from_path(path: str) -> Optional[int]:
+    for part in reversed(os.path.normpath(path).split(os.sep)[:-1]):
+        match = GRADE_DIR_RE.match(part)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def _title_from_name(path: str) -> str:
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return re.sub(r"[_\s]+", " ", stem).strip()
+
+
+def read_qna(path: str) -> Dict[str, str]:
+    base = os.path.splitext(path)[0]
+    if os.path.exists(base + ".qna.json"):
+        with open(base + ".qna.json", encoding="utf-8") as f:
+            data = json.load(f)
+        return {str(q).strip(): str(a).strip() for q, a in data.items()}
+    qna = {}
+    if os.path.exists(base + ".qna.txt"):
+        with open(base + ".qna.txt", encoding="utf-8") as f:
+            for block in re.split(r"\n\s*\n", f.read()):
+                lines = [line.strip() for line in block.strip().split("\n")]
+                if len(lines) >= 2 and lines[0]:
+                    qna[lines[0]] = " ".join(lines[1:]).strip()
+    return qna
+
+
+def extract(path: str) -> Extracted:
+    """
+    Worker: turn one source file into normalized lesson text, chunks and QnA.
+    """
+    from lesson_context import chunk_text
+
+    try:
+        is_pdf = path.lower().endswith(".pdf")
+        paragraphs = []
+        for page in _pdf_pages(path) if is_pdf else _text_pages(path):
+            paragraphs.extend(normalize_page(page))
+        if not paragraphs:
+            raise ValueError("no text could be extracted")
+
+        title = None
+        if is_pdf:
+            title = _pdf_title(path)
+        elif len(paragraphs[0]) <= 100 and not paragraphs[0].endswith("."):
+            title = paragraphs.pop(0)
+        content = "\n\n".join(paragraphs)
+        return Extracted(
+            path=path,
+            title=title or _title_from_name(path),
+            grade_level=_grade_from_path(path),
+            content=content,
+            chunks=chunk_text(content),
+            qna=read_qna(path),
+        )
+    except Exception as e:
+        return Extracted(path, "", None, "", [], {}, error=f"{type(e).__name__}: {e}")
+
+
+def store_batch(batch: List[Extracted], stats: Dict[str, int]):
+    """
+    Insert or update one batch of lessons and their questions in a single
+    transaction.
+    """
+    from db.models import Lesson, bump_cache_version, session_scope, upsert_questions
+    from lesson_context import index_lesson
+    from lesson_index import lesson_index
+
+    titles = [item.title for item in batch]
+    to_index = []
+    questions, sources = [], []
+    changed = False
+    with session_scope() as db:
+        existing = {
+            lesson.title: lesson
+            for lesson in db.query(Lesson).filter(Lesson.title.in_(titles))
+        }
+
+        for item in batch:
+            lesson = existing.get(item.title)
+            if lesson is None:
+                lesson = Lesson(
+                    id=str(uuid.uuid4()),
+                    title=item.title,
+                    content=item.content,
+                    grade_level=item.grade_level,
+                )
+                db.add(lesson)
+                existing[item.title] = lesson
+                stats["lessons_added"] += 1
+                changed = True
+            elif (
+                lesson.content != item.content or lesson.grade_level != item.grade_level
+            ):
+                lesson.content = item.content
+                lesson.grade_level = item.grade_level
+                stats["lessons_updated"] += 1
+                changed = True
+            else:
+                lesson = None
+                stats["lessons_unchanged"] += 1
+
+            if lesson is not None:
+                rows = index_lesson(db, lesson, bodies=item.chunks, update_index=False)
+                to_index.append(
+                    (lesson.id, [(c.id, c.text) for c in rows if c.kind == "body"])
+                )
+
+            lesson_id = existing[item.title].id
+            for question_text, answer in item.qna.items():
+                questions.append(
+                    {
+                        "lesson_id": lesson_id,
+                        "question_text": question_text,
+                        "correct_answer": answer,
+                    }
+                )
+                sources.append(item.path)
+
+        if changed:
+            bump_cache_version(db)
+        # upsert_questions looks the lessons up and commits the whole batch
+        db.flush()
+        results = upsert_questions(db, questions)
+
+    for source, result in zip(sources, results):
+        if result["status"] == "created":
+            stats["questions_added"] += 1
+        elif result["status"] == "updated":
+            stats["questions_updated"] += 1
+        elif result["status"] == "error":
+            stats["errors"] += 1
+            print(f"SKIP question in {source}: {result['detail']}")
+
+    # Only after the rows are committed, so the index never points at chunks
+    # that a failed batch rolled back
+    if to_index:
+        lesson_index.add_lessons(to_index)
+
+
+def main(args) -> int:
+    from db.migrations import migrate
+
+    sources = find_sources(args.source)
+    if not sources:
+        print(f"No .pdf or .txt files under {args.source}")
+        return 1
+    if not args.dry_run:
+        migrate()
+
+    stats = {
+        "files": len(sources),
+        "errors": 0,
+        "lessons_added": 0,
+        "lessons_updated": 0,
+        "lessons_unchanged": 0,
+        "questions_added": 0,
+        "questions_updated": 0,
+    }
+    start = time.perf_counter()
+    batch: List[Extracted] = []
+    seen_titles = set()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for item in pool.map(extract, sources, chunksize=4):
+            if item.error is None and item.grade_level is None:
+                item = item._replace(grade_level=args.grade)
+            if item.error is None and item.grade_level is None:
+                item = item._replace(error="no grade directory and no --grade given")
+            if item.error is None and item.title in seen_titles:
+                item = item._replace(error=f"duplicate title {item.title!r}")
+            if item.error:
+                stats["errors"] += 1
+                print(f"SKIP {item.path}: {item.error}")
+                continue
+
+            seen_titles.add(item.title)
+            print(
+                f"{item.path}: {item.title!r} grade {item.grade_level}, "
+                f"{len(item.chunks)} chunks, {len(item.qna)} questions"
+            )
+            if args.dry_run:
+                continue
+            batch.append(item)
+            if len(batch) >= args.batch_size:
+                store_batch(batch, stats)
+                batch = []
+        if batch:
+            store_batch(batch, stats)
+
+    elapsed = time.perf_counter() - start
+    summary = ", ".join(f"{k.replace('_', ' ')}: {v}" for k, v in stats.items())
+    print(f"{summary} in {elapsed:.2f}s")
+    return 1 if stats["errors"] else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Ingest a directory of PDF/text lessons into the database."
+    )
+    parser.add_argument("source", help="directory (searched recursively)")
+    parser.add_argument("--grade", type=int, help="grade level when the path has none")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="extract and report only"
+    )
+    sys.exit(main(parser.parse_args()))
@@ -4,13 +4,15 @@ Initialize SQLite database with the same schema as PostgreSQL.
 This script creates all the tables and ensures the database is ready to use.
 """
 
-from db.models import Base, engine, SessionLocal, Lesson, Question
+from db.models import engine, SessionLocal, Lesson, Question, bump_cache_version
+from db.migrations import migrate
+from lesson_context import index_lesson
 import json
 
 def create_tables():
     """Create all tables in the database."""
     print("Creating database tables...")
-    Base.metadata.create_all(bind=engine)
+    migrate(engine)
     print("✅ Database tables created successfully!")
 
 def add_sample_lesson():
@@ -31,6 +33,7 @@ def add_sample_lesson():
         )
         db.add(lesson)
         db.flush()  # Get the ID
+        index_lesson(db, lesson)
         
         # Add sample questions
         questions_data = [
@@ -61,6 +64,7 @@ def add_sample_lesson():
             )
             db.add(question)
         
+        bump_cache_version(db)
         db.commit()
         print("✅ Sample lesson and questions added successfully!")
         
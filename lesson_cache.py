@@ -0,0 +1,237 @@
+"""
+In-process read-through cache for lessons and their seed questions.
+
+Rows are copied into immutable records, so they can be shared across
+requests and threads after the session that loaded them is closed. Every write
+path bumps the ``cache_versions`` counter in the same transaction as its
+change (``invalidate`` or ``bump_cache_version``). Each process compares that
+counter with its own copy at most once every ``LESSON_CACHE_CHECK_SECONDS``
+and drops everything when it has moved, so writes made by ingestion scripts
+in another process are also picked up.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from config import (
+    lesson_cache_check_seconds,
+    lesson_cache_enabled,
+    lesson_cache_max_lessons,
+)
+from db.models import (
+    Lesson,
+    Question,
+    bump_cache_version,
+    get_cache_version,
+    get_lesson_page,
+)
+
+# Distinct /lessons pages (grade, cursor, limit) kept at once
+MAX_PAGES = 256
+
+
+class LessonRecord(NamedTuple):
+    id: str
+    title: str
+    content: str
+    grade_level: int
+
+
+class LessonSummary(NamedTuple):
+    id: str
+    title: str
+    grade_level: int
+
+
+class QuestionRecord(NamedTuple):
+    id: str
+    lesson_id: str
+    question_type: str
+    question_text: str
+    options: Optional[str]
+    correct_answer: Optional[str]
+
+
+def _lesson_record(lesson: Lesson) -> LessonRecord:
+    return LessonRecord(lesson.id, lesson.title, lesson.content, lesson.grade_level)
+
+
+def _question_record(q: Question) -> QuestionRecord:
+    return QuestionRecord(
+        q.id, q.lesson_id, q.question_type, q.question_text, q.options, q.correct_answer
+    )
+
+
+class LessonCache:
+    def __init__(
+        self,
+        max_lessons: int = lesson_cache_max_lessons,
+        check_seconds: float = lesson_cache_check_seconds,
+        enabled: bool = lesson_cache_enabled,
+    ):
+        self.max_lessons = max_lessons
+        self.check_seconds = check_seconds
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._lessons: "OrderedDict[str, LessonRecord]" = OrderedDict()
+        self._ids_by_title: Dict[str, str] = {}
+        self._questions: Dict[str, List[QuestionRecord]] = {}
+        self._pages: "OrderedDict[tuple, Tuple[List[LessonSummary], int]]" = (
+            OrderedDict()
+        )
+        self._version: Optional[int] = None
+        self._checked_at = 0.0
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _clear(self):
+        self._lessons.clear()
+        self._ids_by_title.clear()
+        self._questions.clear()
+        self._pages.clear()
+
+    def _sync(self, db: Session):
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < self.check_seconds:
+            return
+        version = get_cache_version(db)
+        with self._lock:
+            if version != self._version:
+                if self._version is not None:
+                    self.invalidations += 1
+                self._clear()
+                self._version = version
+            self._checked_at = now
+
+    def _remember(self, record: LessonRecord):
+        self._lessons[record.id] = record
+        self._lessons.move_to_end(record.id)
+        self._ids_by_title[record.title] = record.id
+        while len(self._lessons) > self.max_lessons:
+            _, evicted = self._lessons.popitem(last=False)
+            self._ids_by_title.pop(evicted.title, None)
+            self._questions.pop(evicted.id, None)
+
+    def get_lesson(
+        self, db: Session, lesson_id: Optional[str] = None, title: Optional[str] = None
+    ) -> Optional[LessonRecord]:
+        """
+        A lesson by id or title, loaded from the database only on a miss.
+        """
+        if not self.enabled:
+            query = db.query(Lesson)
+            lesson = (
+                query.filter(Lesson.id == lesson_id).first()
+                if lesson_id
+                else query.filter(Lesson.title == title).first()
+            )
+            return _lesson_record(lesson) if lesson else None
+
+        self._sync(db)
+        with self._lock:
+            key = lesson_id if lesson_id else self._ids_by_title.get(title)
+            record = self._lessons.get(key) if key else None
+            if record is not None:
+                self._lessons.move_to_end(key)
+                self.hits += 1
+                return record
+            self.misses += 1
+
+        query = db.query(Lesson)
+        if lesson_id:
+            lesson = query.filter(Lesson.id == lesson_id).first()
+        else:
+            lesson = query.filter(Lesson.title == title).first()
+        if not lesson:
+            return None
+        record = _lesson_record(lesson)
+        with self._lock:
+            self._remember(record)
+        return record
+
+    def get_questions(self, db: Session, lesson_id: str) -> List[QuestionRecord]:
+        """
+        The seed questions of a lesson.
+        """
+        if self.enabled:
+            self._sync(db)
+            with self._lock:
+                questions = self._questions.get(lesson_id)
+                if questions is not None:
+                    self.hits += 1
+                    return questions
+                self.misses += 1
+
+        questions = [
+            _question_record(q)
+            for q in db.query(Question).filter(Question.lesson_id == lesson_id)
+        ]
+        if self.enabled:
+            with self._lock:
+                # Only kept alongside a cached lesson so eviction stays bounded
+                if lesson_id in self._lessons:
+                    self._questions[lesson_id] = questions
+        return questions
+
+    def lesson_page(
+        self,
+        db: Session,
+        grade_level: Optional[int] = None,
+        after_title: Optional[str] = None,
+        limit: int = 100,
+    ) -> Tuple[List[LessonSummary], int]:
+        """
+        A title-ordered page of lesson summaries and the total match count
+        (see get_lesson_page).
+        """
+        key = (grade_level, after_title, limit)
+        if self.enabled:
+            self._sync(db)
+            with self._lock:
+                page = self._pages.get(key)
+                if page is not None:
+                    self._pages.move_to_end(key)
+                    self.hits += 1
+                    return page
+                self.misses += 1
+
+        rows, total = get_lesson_page(db, grade_level, after_title, limit)
+        page = ([LessonSummary(*row) for row in rows], total)
+        if self.enabled:
+            with self._lock:
+                self._pages[key] = page
+                while len(self._pages) > MAX_PAGES:
+                    self._pages.popitem(last=False)
+        return page
+
+    def invalidate(self, db: Optional[Session] = None):
+        """
+        Drop this process's cached rows. With ``db``, also bump the shared
+        version so other processes follow; the caller commits.
+        """
+        if db is not None:
+            bump_cache_version(db)
+        with self._lock:
+            self._clear()
+            self._version = None
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "lessons": len(self._lessons),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+
+lesson_cache = LessonCache()
@@ -0,0 +1,205 @@
+"""
+Chunked delivery of lesson text for GET /lessons/{id}/content.
+
+A lesson's text is encoded to UTF-8 once and kept (within a byte budget)
+together with its strong ETag and paragraph offsets. Responses stream
+zero-copy slices of that buffer, cut at paragraph boundaries where possible,
+so a slow client starts reading after the first chunk and no per-request copy
+of the lesson is built. Byte ranges are served as-is; whole-body responses can
+be gzip- or (if the ``brotli`` package is installed) brotli-compressed on the
+fly.
+"""
+
+import hashlib
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Iterator, List, Optional, Tuple
+
+from config import (
+    lesson_content_cache_bytes,
+    lesson_content_chunk_bytes,
+    lesson_content_gzip_level,
+)
+
+try:
+    import brotli
+except ImportError:  # optional: gzip is always available
+    brotli = None
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+PARAGRAPH_BREAK = b"\n\n"
+
+
+class LessonBody:
+    def __init__(self, content: str):
+        self.content = content
+        self.data = content.encode("utf-8")
+        self.etag = '"' + hashlib.sha256(self.data).hexdigest()[:32] + '"'
+        # Byte offset where each paragraph starts
+        self.paragraphs: List[int] = [0]
+        position = self.data.find(PARAGRAPH_BREAK)
+        while position != -1:
+            start = position + len(PARAGRAPH_BREAK)
+            while self.data[start : start + 1] == b"\n":
+                start += 1
+            if start < len(self.data):
+                self.paragraphs.append(start)
+            position = self.data.find(PARAGRAPH_BREAK, start)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def etag_for(
+        self, encoding: Optional[str], paragraphs: Optional[Tuple[int, int]] = None
+    ) -> str:
+        """
+        Strong ETag of the body as sent with Content-Encoding ``encoding``
+        (None for identity), or of just the ``(first, last)`` paragraphs; each
+        encoding and selection is a different byte sequence.
+        """
+        tag = self.etag[:-1]
+        if paragraphs is not None:
+            tag += f"-p{paragraphs[0]}-{paragraphs[1]}"
+        if encoding:
+            tag += f"-{encoding}"
+        return tag + '"'
+
+    def paragraph_span(self, first: int, last: int) -> Tuple[int, int]:
+        """
+        Byte span covering paragraphs ``first``..``last`` (inclusive).
+        """
+        start = self.paragraphs[first]
+        end = (
+            self.paragraphs[last + 1] if last + 1 < len(self.paragraphs) else len(self)
+        )
+        return start, end
+
+
+class LessonBodyCache:
+    """
+    Encoded lesson bodies, LRU within ``max_bytes``. An entry is reused only
+    while the lesson record it was built from still carries the same text, so
+    lesson_cache invalidation carries over.
+    """
+
+    def __init__(self, max_bytes: int = lesson_content_cache_bytes):
+        self.max_bytes = max_bytes
+        self._bodies: "OrderedDict[str, LessonBody]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, lesson_id: str, content: str) -> LessonBody:
+        with self._lock:
+            body = self._bodies.get(lesson_id)
+            if body is not None and (
+                body.content is content or body.content == content
+            ):
+                self._bodies.move_to_end(lesson_id)
+                return body
+
+        body = LessonBody(content)
+        with self._lock:
+            old = self._bodies.pop(lesson_id, None)
+            if old is not None:
+                self._bytes -= len(old)
+            if len(body) <= self.max_bytes:
+                self._bodies[lesson_id] = body
+                self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._bodies.popitem(last=False)
+                self._bytes -= len(evicted)
+        return body
+
+
+body_cache = LessonBodyCache()
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single ``bytes=`` range into a half-open ``(start, end)`` span.
+    Returns None for no/unsupported (e.g. multi-part) ranges, so the whole
+    body is sent; raises ValueError for an unsatisfiable one.
+    """
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - length), size
+    start = int(first)
+    end = min(int(last) + 1, size) if last else size
+    if start >= size or end <= start:
+        raise ValueError("range not satisfiable")
+    return start, end
+
+
+def iter_chunks(
+    body: LessonBody,
+    start: int,
+    end: int,
+    chunk_bytes: int = lesson_content_chunk_bytes,
+) -> Iterator[memoryview]:
+    """
+    Slices of ``body`` covering ``start``..``end``, each ending at a
+    paragraph break when one falls in the second half of the chunk.
+    """
+    view = memoryview(body.data)
+    position = start
+    while position < end:
+        stop = min(position + chunk_bytes, end)
+        if stop < end:
+            cut = body.data.rfind(PARAGRAPH_BREAK, position + chunk_bytes // 2, stop)
+            if cut != -1:
+                stop = cut + len(PARAGRAPH_BREAK)
+        yield view[position:stop]
+        position = stop
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    The best content coding the client accepts: "br", "gzip" or None.
+    """
+    accepted = {}
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name] = quality
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def compress(chunks: Iterator[memoryview], encoding: str) -> Iterator[bytes]:
+    """
+    Compress a chunk stream incrementally, flushing after each chunk so the
+    client can decode and show it straight away.
+    """
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=5)
+        for chunk in chunks:
+            yield compressor.process(bytes(chunk)) + compressor.flush()
+        yield compressor.finish()
+        return
+
+    compressor = zlib.compressobj(lesson_content_gzip_level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
@@ -0,0 +1,272 @@
+"""
+Token-budgeted lesson context for question generation.
+
+Lessons are split into token-counted chunks (plus a short extractive summary)
+once, when they are ingested, and the chunks are added to the offline lesson
+index. Generation prompts then carry the summary and as many of the most
+relevant chunks as fit the budget instead of the full lesson.
+
+Run ``python lesson_context.py`` to compare full and budgeted prompt sizes.
+"""
+
+import re
+import sys
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from config import (
+    generation_prompt_token_budget,
+    lesson_chunk_tokens,
+    lesson_summary_tokens,
+)
+from db.models import LessonChunk, get_lesson_chunks
+from lesson_index import lesson_index
+from utils import estimate_tokens
+
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def _paragraphs(text: str) -> List[str]:
+    return [p.strip() for p in re.split(r"\n\s*\n", text) if p.strip()]
+
+
+def chunk_text(text: str, max_tokens: int = lesson_chunk_tokens) -> List[str]:
+    """
+    Split lesson text into chunks of at most ``max_tokens``, keeping paragraphs
+    together where possible and falling back to sentence boundaries.
+    """
+    pieces = []
+    for paragraph in _paragraphs(text):
+        if estimate_tokens(paragraph) <= max_tokens:
+            pieces.append(paragraph)
+        else:
+            pieces.extend(SENTENCE_RE.split(paragraph))
+
+    chunks, current, current_tokens = [], [], 0
+    for piece in pieces:
+        tokens = estimate_tokens(piece)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("\n\n".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def summarize(chunks: List[str], max_tokens: int = lesson_summary_tokens) -> str:
+    """
+    Extractive summary: the lead sentence of each chunk, in order, until the
+    token budget is used up.
+    """
+    sentences, used = [], 0
+    for chunk in chunks:
+        lead = SENTENCE_RE.split(chunk.strip(), maxsplit=1)[0].replace("\n", " ")
+        tokens = estimate_tokens(lead)
+        if used + tokens > max_tokens:
+            break
+        sentences.append(lead)
+        used += tokens
+    return " ".join(sentences)
+
+
+def chunk_rows(
+    lesson_id: str, content: str, bodies: Optional[List[str]] = None
+) -> List[Dict]:
+    """
+    Column values of a lesson's chunk rows: the summary, then the body chunks
+    in reading order. ``bodies`` are precomputed chunks.
+    """
+    if bodies is None:
+        bodies = chunk_text(content)
+    summary = summarize(bodies)
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "lesson_id": lesson_id,
+            "kind": kind,
+            "position": position,
+            "text": text,
+            "token_count": estimate_tokens(text),
+        }
+        for kind, position, text in [("summary", 0, summary)]
+        + [("body", i, body) for i, body in enumerate(bodies)]
+    ]
+
+
+def index_lesson(
+    db, lesson, bodies: Optional[List[str]] = None, update_index: bool = True
+) -> List[LessonChunk]:
+    """
+    (Re)build the stored chunks and summary for a lesson. Call this whenever a
+    lesson's content is written; the caller commits. ``bodies`` are
+    precomputed chunks; with ``update_index=False`` the caller adds the body
+    chunks to lesson_index itself (e.g. once per batch).
+    """
+    db.query(LessonChunk).filter(LessonChunk.lesson_id == lesson.id).delete()
+
+    rows = [LessonChunk(**row) for row in chunk_rows(lesson.id, lesson.content, bodies)]
+    db.add_all(rows)
+    if update_index:
+        lesson_index.add_lesson(
+            lesson.id, [(c.id, c.text) for c in rows if c.kind == "body"]
+        )
+    return rows
+
+
+def lesson_chunks(db, lesson) -> List[LessonChunk]:
+    """
+    Stored chunks for a lesson. Read-only: chunks are written when a lesson
+    is (index_lesson) and by migration 6 for lessons that predate chunking.
+    A lesson stored some other way gets unsaved chunks built on the fly; they
+    have no index rows, so they are used in reading order.
+    """
+    chunks = get_lesson_chunks(db, lesson.id)
+    if not chunks:
+        print(f"Lesson {lesson.id} has no stored chunks; chunking it per request.")
+        return [LessonChunk(**row) for row in chunk_rows(lesson.id, lesson.content)]
+    if lesson.id not in lesson_index:
+        # Index files missing or rebuilt without it; the stored chunks are
+        # still the source of truth
+        lesson_index.add_lesson(
+            lesson.id, [(c.id, c.text) for c in chunks if c.kind == "body"]
+        )
+    return chunks
+
+
+def rank_chunks(
+    chunks: List[LessonChunk], query: str, lesson_id: str
+) -> List[LessonChunk]:
+    """
+    Order body chunks by cosine similarity to the query in the lesson index.
+    """
+    by_id = {chunk.id: chunk for chunk in chunks}
+    hits = lesson_index.search(query, k=len(chunks), lesson_id=lesson_id)
+    ranked = [by_id[chunk_id] for chunk_id, _ in hits if chunk_id in by_id]
+    seen = {chunk.id for chunk in ranked}
+    return ranked + [chunk for chunk in chunks if chunk.id not in seen]
+
+
+def relevant_passages(db, lesson, queries: List[str], k: int = 1) -> List[str]:
+    """
+    The ``k`` lesson chunks closest to each query, joined per query.
+    """
+    chunks = {c.id: c for c in lesson_chunks(db, lesson) if c.kind == "body"}
+    passages = []
+    for hits in lesson_index.search_batch(queries, k=k, lesson_id=lesson.id):
+        passages.append(
+            "\n".join(
+                chunks[chunk_id].text for chunk_id, _ in hits if chunk_id in chunks
+            )
+        )
+    return passages
+
+
+class ContextStats:
+    def __init__(self):
+        self.prompts = 0
+        self.full_tokens = 0
+        self.budgeted_tokens = 0
+
+    def record(self, full_tokens: int, budgeted_tokens: int):
+        self.prompts += 1
+        self.full_tokens += full_tokens
+        self.budgeted_tokens += budgeted_tokens
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "prompts": self.prompts,
+            "full_prompt_tokens": self.full_tokens,
+            "budgeted_prompt_tokens": self.budgeted_tokens,
+            "saved_ratio": (
+                1 - self.budgeted_tokens / self.full_tokens if self.full_tokens else 0.0
+            ),
+        }
+
+
+context_stats = ContextStats()
+
+
+def build_lesson_context(
+    db,
+    lesson,
+    query: str,
+    fixed_tokens: int,
+    budget: int = generation_prompt_token_budget,
+) -> Tuple[str, Dict[str, int]]:
+    """
+    Assemble the lesson text for a prompt whose other parts (template, sample
+    QnA) take ``fixed_tokens``: summary plus the chunks most relevant to
+    ``query``, in reading order, within ``budget``. The full lesson is used
+    as-is when it already fits.
+    """
+    full_content_tokens = estimate_tokens(lesson.content)
+    full_tokens = fixed_tokens + full_content_tokens
+    if full_tokens <= budget:
+        context_stats.record(full_tokens, full_tokens)
+        return lesson.content, {
+            "full_tokens": full_tokens,
+            "prompt_tokens": full_tokens,
+        }
+
+    chunks = lesson_chunks(db, lesson)
+    summary = next((c for c in chunks if c.kind == "summary"), None)
+    bodies = [c for c in chunks if c.kind == "body"]
+
+    remaining = budget - fixed_tokens
+    sections = []
+    if summary is not None and summary.token_count <= remaining:
+        remaining -= summary.token_count
+        sections.append("Summary: " + summary.text)
+
+    selected = []
+    for chunk in rank_chunks(bodies, query, lesson.id):
+        if chunk.token_count <= remaining:
+            remaining -= chunk.token_count
+            selected.append(chunk)
+    if selected:
+        sections.append("Excerpts:")
+        sections += [chunk.text for chunk in sorted(selected, key=lambda c: c.position)]
+    context = "\n\n".join(sections)
+
+    prompt_tokens = fixed_tokens + estimate_tokens(context)
+    context_stats.record(full_tokens, prompt_tokens)
+    return context, {"full_tokens": full_tokens, "prompt_tokens": prompt_tokens}
+
+
+if __name__ == "__main__":
+    # Report full vs budgeted lesson size, for a text file or every lesson in the DB
+    from types import SimpleNamespace
+
+    from db.models import Lesson, SessionLocal
+
+    db = SessionLocal()
+    try:
+        if len(sys.argv) > 1:
+            with open(sys.argv[1], encoding="utf-8") as f:
+                content = f.read()
+            lessons = [SimpleNamespace(id=None, title=sys.argv[1], content=content)]
+        else:
+            lessons = db.query(Lesson).all()
+
+        for lesson in lessons:
+            bodies = chunk_text(lesson.content)
+            summary = summarize(bodies)
+            full = estimate_tokens(lesson.content)
+            kept, remaining = [], generation_prompt_token_budget - estimate_tokens(
+                summary
+            )
+            for body in bodies:
+                if estimate_tokens(body) <= remaining:
+                    kept.append(body)
+                    remaining -= estimate_tokens(body)
+            budgeted = min(
+                full, estimate_tokens(summary) + sum(map(estimate_tokens, kept))
+            )
+            print(
+                f"{lesson.title}: {full} lesson tokens in {len(bodies)} chunks -> "
+                f"{budgeted} tokens within a {generation_prompt_token_budget}-token budget"
+            )
+    finally:
+        db.close()
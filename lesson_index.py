@@ -0,0 +1,364 @@
+"""
+Offline retrieval index over lesson chunks.
+
+Chunks are turned into hashed bag-of-words vectors (unigrams and bigrams,
+signed feature hashing, sublinear tf, L2-normalized), so there is no
+vocabulary to fit and no network call. Vectors live in a flat float32 file
+that is memory-mapped for queries and appended to as lessons are indexed.
+
+Several processes (API workers, the ingest scripts) may share the files.
+Writers hold an exclusive lock on ``index.lock`` and re-read the metadata
+before changing anything; the vectors file only ever grows in place (a
+rebuild writes a new file and swaps it in), so another process's memory map
+stays valid. Readers pick up new metadata when its mtime changes.
+
+    python lesson_index.py rebuild
+    python lesson_index.py query "Who was Hans?" [lesson_id]
+"""
+
+import json
+import math
+import os
+import sys
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process use only
+    fcntl = None
+
+import numpy as np
+
+from config import lesson_index_dim, lesson_index_path
+from utils import content_words
+
+
+class HashingVectorizer:
+    def __init__(self, dim: int = lesson_index_dim):
+        self.dim = dim
+
+    def _features(self, text: str) -> List[str]:
+        words = content_words(text)
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def transform(self, texts: Sequence[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts: Dict[int, float] = {}
+            for feature in self._features(text):
+                h = zlib.crc32(feature.encode("utf-8"))
+                index = h % self.dim
+                sign = 1.0 if (h >> 31) & 1 else -1.0
+                counts[index] = counts.get(index, 0.0) + sign
+            for index, value in counts.items():
+                matrix[row, index] = (
+                    math.copysign(1 + math.log(abs(value)), value) if value else 0.0
+                )
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        return matrix
+
+
+class _IndexState:
+    """
+    One consistent view of the index: the row metadata and a memory map of
+    exactly that many rows. Never changed once built; writers build a new one
+    and swap it in, so a search always sees rows and vectors that agree.
+    """
+
+    def __init__(
+        self,
+        chunk_ids: List[Optional[str]],
+        lesson_ids: List[Optional[str]],
+        matrix: np.ndarray,
+        meta_mtime: Optional[int],
+    ):
+        self.chunk_ids = chunk_ids
+        self.lesson_ids = lesson_ids
+        self.matrix = matrix
+        self.meta_mtime = meta_mtime
+
+        rows: Dict[str, List[int]] = {}
+        for row, lesson_id in enumerate(lesson_ids):
+            if lesson_id is not None:
+                rows.setdefault(lesson_id, []).append(row)
+        self.rows_by_lesson = {
+            k: np.asarray(v, dtype=np.int64) for k, v in rows.items()
+        }
+        self.live_rows = np.asarray(
+            [i for i, c in enumerate(chunk_ids) if c is not None], dtype=np.int64
+        )
+
+
+class LessonIndex:
+    """
+    Append-only vector store for lesson chunks. Re-indexing a lesson tombstones
+    its old rows; ``rebuild`` compacts the files.
+    """
+
+    def __init__(self, path: str = lesson_index_path, dim: int = lesson_index_dim):
+        self.path = path
+        self.vectorizer = HashingVectorizer(dim)
+        self.dim = dim
+        self._vectors_path = os.path.join(path, "vectors.f32")
+        self._meta_path = os.path.join(path, "meta.json")
+        self._lock_path = os.path.join(path, "index.lock")
+        # Serializes writers and reloads; searches only read self._state
+        self._lock = threading.Lock()
+        self._state: Optional[_IndexState] = None
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool) -> Iterator[None]:
+        """
+        Cross-process lock on the index files (shared for reading metadata).
+        """
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _meta_stamp(self) -> Optional[int]:
+        try:
+            return os.stat(self._meta_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load(self) -> _IndexState:
+        # A stat per call, so writes by other processes are seen
+        state = self._state
+        if state is not None and self._meta_stamp() == state.meta_mtime:
+            return state
+        with self._lock:
+            with self._file_lock(exclusive=False):
+                return self._reload()
+
+    def _reload(self) -> _IndexState:
+        """
+        Read the metadata on disk. Called with the locks held.
+        """
+        stamp = self._meta_stamp()
+        if self._state is not None and stamp == self._state.meta_mtime:
+            return self._state
+        chunk_ids: List[Optional[str]] = []
+        lesson_ids: List[Optional[str]] = []
+        if stamp is not None:
+            with open(self._meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("dim") == self.dim:
+                chunk_ids, lesson_ids = meta["chunk_ids"], meta["lesson_ids"]
+            else:
+                print(
+                    f"Lesson index at {self.path} has a different dimension; ignoring it."
+                )
+        return self._install(chunk_ids, lesson_ids, stamp)
+
+    def _install(
+        self,
+        chunk_ids: List[Optional[str]],
+        lesson_ids: List[Optional[str]],
+        meta_mtime: Optional[int],
+    ) -> _IndexState:
+        """
+        Swap in a state for this metadata. Called with the locks held.
+        """
+        # Mapped now, while the file lock pins the vectors file to this metadata
+        if chunk_ids:
+            matrix = np.memmap(
+                self._vectors_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(len(chunk_ids), self.dim),
+            )
+        else:
+            matrix = np.zeros((0, self.dim), dtype=np.float32)
+        self._state = _IndexState(chunk_ids, lesson_ids, matrix, meta_mtime)
+        return self._state
+
+    def _write_meta(
+        self, chunk_ids: List[Optional[str]], lesson_ids: List[Optional[str]]
+    ) -> Optional[int]:
+        tmp_path = f"{self._meta_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"dim": self.dim, "chunk_ids": chunk_ids, "lesson_ids": lesson_ids},
+                f,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._meta_path)
+        return self._meta_stamp()
+
+    def __contains__(self, lesson_id: str) -> bool:
+        return lesson_id in self._load().rows_by_lesson
+
+    def add_lesson(self, lesson_id: str, chunks: Sequence[Tuple[str, str]]):
+        """
+        Index ``(chunk_id, text)`` pairs for a lesson, replacing any rows it
+        already had.
+        """
+        self.add_lessons([(lesson_id, chunks)])
+
+    def add_lessons(self, lessons: Sequence[Tuple[str, Sequence[Tuple[str, str]]]]):
+        """
+        Index several ``(lesson_id, chunks)`` entries with a single append and
+        metadata write.
+        """
+        vectors = [
+            self.vectorizer.transform([text for _, text in chunks])
+            for _, chunks in lessons
+        ]
+        with self._lock, self._file_lock(exclusive=True):
+            # Another process may have appended since we last looked
+            state = self._reload()
+            # Changes go to copies; searches keep the old state until the
+            # new one is installed
+            chunk_ids, lesson_ids = list(state.chunk_ids), list(state.lesson_ids)
+
+            # Tombstone the lessons' previous rows; their vectors stay on disk
+            # until the next rebuild but are never scored again
+            for lesson_id, _ in lessons:
+                for row in state.rows_by_lesson.get(lesson_id, ()):
+                    lesson_ids[row] = None
+                    chunk_ids[row] = None
+
+            row_bytes = self.dim * 4
+            with open(self._vectors_path, "ab") as f:
+                # Never shrink the file: other processes may have it mapped.
+                # Rows a crashed writer appended without recording them are
+                # kept as tombstones (padded out if the last one was torn).
+                size = f.tell()
+                rows_on_disk = -(-size // row_bytes)
+                if rows_on_disk * row_bytes > size:
+                    f.write(b"\0" * (rows_on_disk * row_bytes - size))
+                unrecorded = max(0, rows_on_disk - len(chunk_ids))
+                chunk_ids.extend([None] * unrecorded)
+                lesson_ids.extend([None] * unrecorded)
+                for (lesson_id, chunks), matrix in zip(lessons, vectors):
+                    f.write(matrix.tobytes())
+                    chunk_ids.extend(chunk_id for chunk_id, _ in chunks)
+                    lesson_ids.extend([lesson_id] * len(chunks))
+                f.flush()
+                os.fsync(f.fileno())
+            self._install(
+                chunk_ids, lesson_ids, self._write_meta(chunk_ids, lesson_ids)
+            )
+
+    def rebuild(self, lessons: Sequence[Tuple[str, Sequence[Tuple[str, str]]]]):
+        """
+        Replace the whole index with ``(lesson_id, chunks)`` entries.
+        """
+        with self._lock, self._file_lock(exclusive=True):
+            chunk_ids, lesson_ids = [], []
+            # A new file swapped in, so existing memory maps keep the old one
+            tmp_path = f"{self._vectors_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                for lesson_id, chunks in lessons:
+                    if not chunks:
+                        continue
+                    f.write(self.vectorizer.transform([t for _, t in chunks]).tobytes())
+                    chunk_ids.extend(chunk_id for chunk_id, _ in chunks)
+                    lesson_ids.extend([lesson_id] * len(chunks))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._vectors_path)
+            self._install(
+                chunk_ids, lesson_ids, self._write_meta(chunk_ids, lesson_ids)
+            )
+
+    def search_batch(
+        self, queries: Sequence[str], k: int = 3, lesson_id: Optional[str] = None
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Cosine top-``k`` chunks for each query, optionally restricted to one
+        lesson. Returns ``(chunk_id, score)`` lists, best first.
+        """
+        # One state throughout, whatever writers install meanwhile
+        state = self._load()
+        if lesson_id is not None:
+            rows = state.rows_by_lesson.get(lesson_id)
+        else:
+            rows = state.live_rows
+        if rows is None or not len(rows):
+            return [[] for _ in queries]
+
+        query_vectors = self.vectorizer.transform(queries).T
+        if lesson_id is None:
+            # Score the whole mapped matrix in place (no gather copy), then
+            # keep the live rows
+            scores = np.asarray(state.matrix @ query_vectors)
+            if len(rows) != len(scores):
+                scores = scores[rows]
+        else:
+            scores = state.matrix[rows] @ query_vectors
+        k = min(k, len(rows))
+        results = []
+        for column in scores.T:
+            top = (
+                np.argpartition(-column, k - 1)[:k]
+                if k < len(column)
+                else np.arange(len(column))
+            )
+            top = top[np.argsort(-column[top])]
+            results.append([(state.chunk_ids[rows[i]], float(column[i])) for i in top])
+        return results
+
+    def search(
+        self, query: str, k: int = 3, lesson_id: Optional[str] = None
+    ) -> List[Tuple[str, float]]:
+        return self.search_batch([query], k=k, lesson_id=lesson_id)[0]
+
+    def stats(self) -> Dict[str, int]:
+        state = self._load()
+        return {
+            "rows": len(state.chunk_ids),
+            "live_rows": len(state.live_rows),
+            "lessons": len(state.rows_by_lesson),
+        }
+
+
+lesson_index = LessonIndex()
+
+
+if __name__ == "__main__":
+    from db.models import Lesson, LessonChunk, SessionLocal
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "rebuild"
+    if command == "rebuild":
+        db = SessionLocal()
+        try:
+            entries = []
+            for lesson in db.query(Lesson).all():
+                chunks = (
+                    db.query(LessonChunk.id, LessonChunk.text)
+                    .filter(
+                        LessonChunk.lesson_id == lesson.id, LessonChunk.kind == "body"
+                    )
+                    .order_by(LessonChunk.position)
+                    .all()
+                )
+                entries.append((lesson.id, [(c.id, c.text) for c in chunks]))
+        finally:
+            db.close()
+        start = time.perf_counter()
+        lesson_index.rebuild(entries)
+        print(f"Indexed {lesson_index.stats()} in {time.perf_counter() - start:.3f}s")
+    elif command == "query":
+        query = sys.argv[2]
+        lesson_id = sys.argv[3] if len(sys.argv) > 3 else None
+        lesson_index.search(query, lesson_id=lesson_id)  # warm the memmap
+        start = time.perf_counter()
+        hits = lesson_index.search(query, lesson_id=lesson_id)
+        elapsed = (time.perf_counter() - start) * 1000
+        for chunk_id, score in hits:
+            print(f"{score:.3f}  {chunk_id}")
+        print(f"{elapsed:.3f} ms")
@@ -1,10 +1,67 @@
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
-from config import google_api_key, llm_model_name, llm_temperature
+import threading
 
-llm = ChatGoogleGenerativeAI(
-    model=llm_model_name, google_api_key=google_api_key, temperature=llm_temperature
+from config import (
+    google_api_key,
+    llm_cassette_mode,
+    llm_fake,
+    llm_model_name,
+    llm_temperature,
 )
 
+_llm = None
+_llm_lock = threading.Lock()
+
+
+def _build_llm():
+    if llm_cassette_mode == "replay":
+        from llm_cassette import CassettePlayer
+
+        model = CassettePlayer()
+    elif llm_fake:
+        from fake_llm import FakeChatModel
+
+        model = FakeChatModel()
+    else:
+        # Slow to import (the Google API client), so only done when needed
+        from langchain_google_genai import ChatGoogleGenerativeAI
+
+        model = ChatGoogleGenerativeAI(
+            model=llm_model_name,
+            google_api_key=google_api_key,
+            temperature=llm_temperature,
+        )
+
+    if llm_cassette_mode == "record":
+        from llm_cassette import CassetteRecorder
+
+        model = CassetteRecorder(model)
+    return model
+
+
+def get_llm():
+    """
+    The configured chat model, built on first use.
+    """
+    global _llm
+    if _llm is None:
+        with _llm_lock:
+            if _llm is None:
+                _llm = _build_llm()
+    return _llm
+
+
+class _LazyLLM:
+    """
+    Stands in for the chat model until something is called on it, so that
+    importing the chains doesn't construct (or import) the client.
+    """
+
+    def __getattr__(self, name: str):
+        return getattr(get_llm(), name)
+
+
+llm = _LazyLLM()
+
 if __name__ == "__main__":
     try:
         print("Testing connection to Gemini...")
@@ -0,0 +1,540 @@
+"""
+Content-addressed cache for LLM chain responses.
+
+Responses are keyed on a hash of the rendered prompt, the model name and the
+temperature, so a prompt that is byte-for-byte the same as an earlier one is
+answered without another round trip to Gemini. There are two tiers: a small
+in-process LRU and a SQLite file that survives restarts.
+"""
+
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable, Dict, List, Optional
+
+from config import (
+    llm_cache_enabled,
+    llm_cache_max_bytes,
+    llm_cache_max_entries,
+    llm_cache_memory_entries,
+    llm_cache_path,
+    llm_cache_ttl_seconds,
+    llm_model_name,
+    llm_temperature,
+)
+from rate_limiter import GENERATION, current_priority, usage_tokens
+from tracing import (
+    llm_usage,
+    record_llm_call,
+    record_stage,
+    stage,
+)
+
+if TYPE_CHECKING:
+    from langchain_core.messages import AIMessage
+
+
+def make_cache_key(prompt: str, model: Optional[str], temperature: Any) -> str:
+    """
+    Hash the rendered prompt together with the model settings that affect the output.
+    """
+    digest = hashlib.sha256()
+    for part in (model or "", str(temperature), prompt):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Two-tier (memory LRU + SQLite) store of LLM response text.
+
+    Entries older than ``ttl_seconds`` are treated as misses. The disk tier is
+    trimmed to ``max_entries`` rows and ``max_bytes`` of response text, dropping
+    the least recently used entries first. Disk hits only note their access
+    time in memory; the notes are written in batches, with the next ``set`` or
+    every ``TOUCH_BATCH`` hits. ``aget`` / ``aset`` keep the memory tier inline
+    and run the disk tier in a worker thread, off the event loop.
+    """
+
+    TOUCH_BATCH = 64
+
+    def __init__(
+        self,
+        path: str,
+        ttl_seconds: int,
+        memory_entries: int,
+        max_entries: int,
+        max_bytes: int,
+        enabled: bool = True,
+    ):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.memory_entries = memory_entries
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+
+        # _lock guards the memory tier and counters and is never held during
+        # disk I/O, which _disk_lock serializes
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._touched: Dict[str, float] = {}
+        self._conn: Optional[sqlite3.Connection] = None
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.rejected = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_responses (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_llm_responses_accessed_at "
+                "ON llm_responses (accessed_at)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _remember(self, key: str, created_at: float, text: str):
+        with self._lock:
+            self._memory[key] = (created_at, text)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def _get_memory(self, key: str, now: float) -> Optional[str]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            created_at, text = entry
+            if now - created_at < self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return text
+            del self._memory[key]
+            return None
+
+    def _get_disk(self, key: str, now: float) -> Optional[str]:
+        with self._disk_lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT response, created_at FROM llm_responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] >= self.ttl_seconds:
+                with self._lock:
+                    self.misses += 1
+                return None
+            self._touched[key] = now
+            if len(self._touched) >= self.TOUCH_BATCH:
+                self._flush_touched(conn)
+                conn.commit()
+        self._remember(key, row[1], row[0])
+        with self._lock:
+            self.disk_hits += 1
+        return row[0]
+
+    def _flush_touched(self, conn: sqlite3.Connection):
+        # Called with _disk_lock held
+        if self._touched:
+            conn.executemany(
+                "UPDATE llm_responses SET accessed_at = ? WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self._touched.items()],
+            )
+            self._touched.clear()
+
+    def _set_disk(self, key: str, text: str, now: float):
+        size = len(text.encode("utf-8"))
+        with self._disk_lock:
+            conn = self._connect()
+            self._flush_touched(conn)
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_responses "
+                "(key, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, text, size, now, now),
+            )
+            self._evict(conn, now)
+            conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Return the cached response text for ``key``, or None on a miss.
+        """
+        if not self.enabled:
+            return None
+        now = time.time()
+        text = self._get_memory(key, now)
+        if text is not None:
+            return text
+        return self._get_disk(key, now)
+
+    async def aget(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        text = self._get_memory(key, now)
+        if text is not None:
+            return text
+        return await asyncio.to_thread(self._get_disk, key, now)
+
+    def set(self, key: str, text: str):
+        """
+        Store ``text`` under ``key`` in both tiers and trim the disk tier.
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        self._remember(key, now, text)
+        self._set_disk(key, text, now)
+
+    async def aset(self, key: str, text: str):
+        if not self.enabled:
+            return
+        now = time.time()
+        self._remember(key, now, text)
+        await asyncio.to_thread(self._set_disk, key, text, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        conn.execute(
+            "DELETE FROM llm_responses WHERE created_at <= ?", (now - self.ttl_seconds,)
+        )
+        count, total = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_responses"
+        ).fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+
+        # Walk from least recently used and collect keys until we are under both limits
+        doomed = []
+        for key, size in conn.execute(
+            "SELECT key, size FROM llm_responses ORDER BY accessed_at ASC"
+        ):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            count -= 1
+            total -= size
+        conn.executemany("DELETE FROM llm_responses WHERE key = ?", doomed)
+        with self._lock:
+            for (key,) in doomed:
+                self._memory.pop(key, None)
+
+    def clear(self):
+        with self._disk_lock:
+            with self._lock:
+                self._memory.clear()
+            self._touched.clear()
+            conn = self._connect()
+            conn.execute("DELETE FROM llm_responses")
+            conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        hits = self.memory_hits + self.disk_hits
+        return {
+            "hits": hits,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "rejected": self.rejected,
+            "memory_entries": len(self._memory),
+        }
+
+
+class LazyPrompt:
+    """
+    A PromptTemplate that is built the first time it is formatted, so that
+    defining chains doesn't import langchain's prompt machinery.
+    """
+
+    def __init__(self, template: str, input_variables: List[str]):
+        self.template = template
+        self.input_variables = input_variables
+        self._prompt = None
+
+    def build(self):
+        if self._prompt is None:
+            from langchain_core.prompts import PromptTemplate
+
+            self._prompt = PromptTemplate(
+                input_variables=self.input_variables, template=self.template
+            )
+        return self._prompt
+
+    def format(self, **kwargs: Any) -> str:
+        return self.build().format(**kwargs)
+
+
+class CachedChain:
+    """
+    Drop-in replacement for ``prompt | llm`` that consults the response cache.
+
+    ``invoke`` renders the prompt, looks the hash up in the cache and only calls
+    the model on a miss. Pass ``bypass_cache=True`` to force a fresh call; the
+    fresh response still replaces whatever was cached. ``ainvoke`` is the
+    native async path and ``astream`` its token-streaming form; when a limiter
+    is given, each model call holds one of its slots. When a rate limiter is
+    given, each model call first takes its share of the quota at ``priority``
+    (unless a priority_scope overrides it) and is retried after a 429.
+    Rendering, queueing and the model call are timed under ``name`` (see
+    tracing.py).
+
+    A response is only cached once ``validate(text, inputs)`` accepts it;
+    whatever it returns (e.g. the repaired JSON) is what gets stored, and None
+    keeps the response out of the cache so the next call asks the model again.
+    """
+
+    def __init__(
+        self,
+        prompt,
+        llm,
+        cache: LLMResponseCache,
+        limiter=None,
+        rate_limiter=None,
+        priority: Optional[int] = None,
+        name: str = "llm",
+        validate: Optional[Callable[[str, Dict[str, Any]], Optional[str]]] = None,
+    ):
+        self.name = name
+        self.validate = validate
+        self.prompt = prompt
+        self.llm = llm
+        self.cache = cache
+        self.limiter = limiter
+        self.rate_limiter = rate_limiter
+        self.priority = priority
+
+    def cache_key(self, rendered_prompt: str) -> str:
+        # A stand-in model (fake_llm) gets its own namespace so its responses
+        # are never served for the real one
+        model = getattr(self.llm, "cache_namespace", llm_model_name)
+        return make_cache_key(rendered_prompt, model, llm_temperature)
+
+    def _hit(self, cached: Optional[str]) -> Optional["AIMessage"]:
+        if cached is None:
+            return None
+        # Imported here so importing the chains doesn't load langchain
+        from langchain_core.messages import AIMessage
+
+        record_llm_call(self.name, "cached")
+        return AIMessage(content=cached)
+
+    def _lookup(self, key: str, bypass_cache: bool) -> Optional["AIMessage"]:
+        if bypass_cache:
+            self.cache.bypasses += 1
+            return None
+        return self._hit(self.cache.get(key))
+
+    async def _alookup(self, key: str, bypass_cache: bool) -> Optional["AIMessage"]:
+        if bypass_cache:
+            self.cache.bypasses += 1
+            return None
+        return self._hit(await self.cache.aget(key))
+
+    def _cacheable(self, text: str, inputs: Dict[str, Any]) -> Optional[str]:
+        if self.validate is None:
+            return text
+        text = self.validate(text, inputs)
+        if text is None:
+            self.cache.rejected += 1
+        return text
+
+    def _store(self, key: str, text: str, inputs: Dict[str, Any]):
+        text = self._cacheable(text, inputs)
+        if text is not None:
+            self.cache.set(key, text)
+
+    async def _astore(self, key: str, text: str, inputs: Dict[str, Any]):
+        text = self._cacheable(text, inputs)
+        if text is not None:
+            await self.cache.aset(key, text)
+
+    def _current_priority(self) -> int:
+        return current_priority(GENERATION if self.priority is None else self.priority)
+
+    def _should_retry(self, exc: BaseException, attempt: int) -> bool:
+        return (
+            self.rate_limiter is not None
+            and self.rate_limiter.retry_delay(exc, attempt) is not None
+        )
+
+    def _settle(self, estimated: int, response, rendered_prompt: str):
+        if self.rate_limiter is not None:
+            self.rate_limiter.settle(estimated, usage_tokens(response, rendered_prompt))
+        record_llm_call(self.name, "ok", *llm_usage(response, rendered_prompt))
+
+    def _failed(self, exc: BaseException, attempt: int) -> bool:
+        """
+        Count a failed model call; True if it should be retried.
+        """
+        record_llm_call(self.name, "error")
+        return self._should_retry(exc, attempt)
+
+    def _render(self, inputs: Dict[str, Any]) -> str:
+        with stage("render", self.name):
+            return self.prompt.format(**inputs)
+
+    def _queued(self, since: float):
+        record_stage("queue", time.perf_counter() - since, self.name)
+
+    def _call(self, rendered_prompt: str) -> "AIMessage":
+        attempt = 0
+        while True:
+            estimated = 0
+            queued_at = time.perf_counter()
+            if self.rate_limiter is not None:
+                estimated = self.rate_limiter.estimate(rendered_prompt)
+                self.rate_limiter.acquire_sync(self._current_priority(), estimated)
+            self._queued(queued_at)
+            try:
+                with stage("llm", self.name):
+                    response = self.llm.invoke(rendered_prompt)
+            except Exception as e:
+                if not self._failed(e, attempt):
+                    raise
+                attempt += 1
+                continue
+            self._settle(estimated, response, rendered_prompt)
+            return response
+
+    async def _acall(self, rendered_prompt: str) -> "AIMessage":
+        attempt = 0
+        while True:
+            estimated = 0
+            queued_at = time.perf_counter()
+            if self.rate_limiter is not None:
+                estimated = self.rate_limiter.estimate(rendered_prompt)
+                await self.rate_limiter.acquire(self._current_priority(), estimated)
+            try:
+                if self.limiter is None:
+                    response = await self._ainvoke_llm(rendered_prompt, queued_at)
+                else:
+                    async with self.limiter.slot():
+                        response = await self._ainvoke_llm(rendered_prompt, queued_at)
+            except Exception as e:
+                if not self._failed(e, attempt):
+                    raise
+                attempt += 1
+                continue
+            self._settle(estimated, response, rendered_prompt)
+            return response
+
+    async def _ainvoke_llm(self, rendered_prompt: str, queued_at: float) -> "AIMessage":
+        self._queued(queued_at)
+        with stage("llm", self.name):
+            return await self.llm.ainvoke(rendered_prompt)
+
+    async def _astream_llm(
+        self, rendered_prompt: str, queued_at: float
+    ) -> AsyncIterator[str]:
+        self._queued(queued_at)
+        with stage("llm", self.name):
+            async for chunk in self.llm.astream(rendered_prompt):
+                yield chunk.content
+
+    async def _astream_once(
+        self, rendered_prompt: str, queued_at: float
+    ) -> AsyncIterator[str]:
+        if self.limiter is None:
+            async for text in self._astream_llm(rendered_prompt, queued_at):
+                yield text
+        else:
+            async with self.limiter.slot():
+                async for text in self._astream_llm(rendered_prompt, queued_at):
+                    yield text
+
+    def invoke(self, inputs: Dict[str, Any], bypass_cache: bool = False) -> "AIMessage":
+        rendered_prompt = self._render(inputs)
+        key = self.cache_key(rendered_prompt)
+
+        cached = self._lookup(key, bypass_cache)
+        if cached is not None:
+            return cached
+
+        response = self._call(rendered_prompt)
+        self._store(key, response.content, inputs)
+        return response
+
+    async def ainvoke(
+        self, inputs: Dict[str, Any], bypass_cache: bool = False
+    ) -> "AIMessage":
+        rendered_prompt = self._render(inputs)
+        key = self.cache_key(rendered_prompt)
+
+        cached = await self._alookup(key, bypass_cache)
+        if cached is not None:
+            return cached
+
+        response = await self._acall(rendered_prompt)
+        await self._astore(key, response.content, inputs)
+        return response
+
+    async def astream(
+        self, inputs: Dict[str, Any], bypass_cache: bool = False
+    ) -> AsyncIterator[str]:
+        """
+        Yield the response text as it arrives. A cache hit is yielded in one
+        piece; a fresh response is cached (if valid) once the stream completes. A 429 is
+        retried only if nothing has been yielded yet.
+        """
+        rendered_prompt = self._render(inputs)
+        key = self.cache_key(rendered_prompt)
+
+        cached = await self._alookup(key, bypass_cache)
+        if cached is not None:
+            yield cached.content
+            return
+
+        parts = []
+        attempt = 0
+        while True:
+            estimated = 0
+            queued_at = time.perf_counter()
+            if self.rate_limiter is not None:
+                estimated = self.rate_limiter.estimate(rendered_prompt)
+                await self.rate_limiter.acquire(self._current_priority(), estimated)
+            try:
+                async for text in self._astream_once(rendered_prompt, queued_at):
+                    parts.append(text)
+                    yield text
+            except Exception as e:
+                if parts:
+                    record_llm_call(self.name, "error")
+                    raise
+                if not self._failed(e, attempt):
+                    raise
+                attempt += 1
+                continue
+            break
+        from langchain_core.messages import AIMessage
+
+        text = "".join(parts)
+        self._settle(estimated, AIMessage(content=text), rendered_prompt)
+        await self._astore(key, text, inputs)
+
+
+llm_cache = LLMResponseCache(
+    path=llm_cache_path,
+    ttl_seconds=llm_cache_ttl_seconds,
+    memory_entries=llm_cache_memory_entries,
+    max_entries=llm_cache_max_entries,
+    max_bytes=llm_cache_max_bytes,
+    enabled=llm_cache_enabled,
+)
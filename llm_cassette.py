@@ -0,0 +1,246 @@
+"""
+Record and replay raw LLM exchanges, selected with ``LLM_CASSETTE_MODE``.
+
+``record`` wraps the real model (see llm.py) and appends every call to a
+gzip-compressed JSON-lines cassette (``LLM_CASSETTE_PATH``): the kind of
+prompt, the rendered prompt, the raw response text, prompt and completion
+token counts, and the observed latency (and time to first chunk for streamed
+calls).
+
+``replay`` answers from a cassette with no network access. A prompt that was
+recorded gets its recorded response; any other prompt (for instance after a
+change to prompt assembly) gets the next recorded response of the same kind,
+so the run still sees the real distribution of response sizes and shapes.
+Each response is delayed by its recorded latency times
+``LLM_CASSETTE_TIME_SCALE`` (0 for no delay).
+
+    python llm_cassette.py [cassette.jsonl.gz]   # summarize a cassette
+"""
+
+import asyncio
+import atexit
+import gzip
+import hashlib
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import TYPE_CHECKING, Any, AsyncIterator, Dict, List
+
+from config import llm_cassette_path, llm_cassette_time_scale
+from fake_llm import STREAM_PIECE_CHARS, prompt_kind
+from utils import estimate_tokens, percentile
+
+if TYPE_CHECKING:
+    from langchain_core.messages import AIMessage, AIMessageChunk
+
+
+class CassetteMiss(LookupError):
+    pass
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:32]
+
+
+def read_cassette(path: str) -> List[Dict[str, Any]]:
+    records = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+        except EOFError:
+            # A recorder that was killed never wrote the gzip trailer; every
+            # record before that was sync-flushed and is complete
+            pass
+    return records
+
+
+def _token_counts(response: Any, prompt: str, text: str) -> Dict[str, int]:
+    usage = getattr(response, "usage_metadata", None) or {}
+    return {
+        "prompt_tokens": usage.get("input_tokens") or estimate_tokens(prompt),
+        "completion_tokens": usage.get("output_tokens") or estimate_tokens(text),
+    }
+
+
+class CassetteRecorder:
+    """
+    Passes every call through to ``llm`` and records it.
+    """
+
+    def __init__(self, llm, path: str = llm_cassette_path):
+        self.llm = llm
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self.recorded = 0
+
+    def __getattr__(self, name: str):
+        # Anything else (model name, cache namespace, ...) is the wrapped model's
+        return getattr(self.llm, name)
+
+    def _write(self, prompt: str, text: str, response: Any, latency: float, **extra):
+        record = {
+            "kind": prompt_kind(prompt),
+            "prompt_hash": prompt_hash(prompt),
+            "prompt": prompt,
+            "response": text,
+            **_token_counts(response, prompt, text),
+            "latency": round(latency, 4),
+            "recorded_at": round(time.time(), 3),
+            **extra,
+        }
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = gzip.open(self.path, "at", encoding="utf-8")
+                atexit.register(self.close)
+            self._file.write(line)
+            # Sync-flushed so the cassette is readable even if the process dies
+            self._file.flush()
+            self.recorded += 1
+
+    def invoke(self, prompt: str) -> "AIMessage":
+        start = time.perf_counter()
+        response = self.llm.invoke(prompt)
+        self._write(prompt, response.content, response, time.perf_counter() - start)
+        return response
+
+    async def ainvoke(self, prompt: str) -> "AIMessage":
+        start = time.perf_counter()
+        response = await self.llm.ainvoke(prompt)
+        self._write(prompt, response.content, response, time.perf_counter() - start)
+        return response
+
+    async def astream(self, prompt: str) -> AsyncIterator[Any]:
+        start = time.perf_counter()
+        first_chunk = None
+        parts = []
+        last = None
+        async for chunk in self.llm.astream(prompt):
+            if first_chunk is None:
+                first_chunk = time.perf_counter() - start
+            parts.append(chunk.content)
+            last = chunk
+            yield chunk
+        self._write(
+            prompt,
+            "".join(parts),
+            last,
+            time.perf_counter() - start,
+            first_chunk=round(first_chunk or 0.0, 4),
+        )
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class CassettePlayer:
+    # Replayed responses stay out of the real model's cache entries
+    cache_namespace = "cassette"
+
+    def __init__(
+        self, path: str = llm_cassette_path, time_scale: float = llm_cassette_time_scale
+    ):
+        self.path = path
+        self.time_scale = time_scale
+        self._by_hash: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._by_kind: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for record in read_cassette(path):
+            self._by_hash[record["prompt_hash"]].append(record)
+            self._by_kind[record["kind"]].append(record)
+        self._next: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+        self.exact = 0
+        self.substituted = 0
+
+    def _take(self, records: List[Dict[str, Any]], key: str) -> Dict[str, Any]:
+        # Cycles through the candidates, so repeated prompts see each recording
+        with self._lock:
+            record = records[self._next[key] % len(records)]
+            self._next[key] += 1
+            return record
+
+    def lookup(self, prompt: str) -> Dict[str, Any]:
+        """
+        The recording to answer ``prompt`` with.
+        """
+        key = prompt_hash(prompt)
+        if key in self._by_hash:
+            self.exact += 1
+            return self._take(self._by_hash[key], key)
+        kind = prompt_kind(prompt)
+        if not self._by_kind.get(kind):
+            raise CassetteMiss(f"{self.path} has no recorded {kind} calls")
+        self.substituted += 1
+        return self._take(self._by_kind[kind], "kind:" + kind)
+
+    def _message(self, record: Dict[str, Any]) -> "AIMessage":
+        from langchain_core.messages import AIMessage
+
+        return AIMessage(
+            content=record["response"],
+            usage_metadata={
+                "input_tokens": record["prompt_tokens"],
+                "output_tokens": record["completion_tokens"],
+                "total_tokens": record["prompt_tokens"] + record["completion_tokens"],
+            },
+        )
+
+    def invoke(self, prompt: str) -> "AIMessage":
+        record = self.lookup(prompt)
+        time.sleep(record["latency"] * self.time_scale)
+        return self._message(record)
+
+    async def ainvoke(self, prompt: str) -> "AIMessage":
+        record = self.lookup(prompt)
+        await asyncio.sleep(record["latency"] * self.time_scale)
+        return self._message(record)
+
+    async def astream(self, prompt: str) -> AsyncIterator["AIMessageChunk"]:
+        from langchain_core.messages import AIMessageChunk
+
+        record = self.lookup(prompt)
+        text = record["response"]
+        pieces = [
+            text[i : i + STREAM_PIECE_CHARS]
+            for i in range(0, len(text), STREAM_PIECE_CHARS)
+        ] or [""]
+        # Recorded time to first chunk, then the rest spread over the pieces
+        first = record.get("first_chunk", record["latency"] / len(pieces))
+        rest = max(0.0, record["latency"] - first) / max(1, len(pieces) - 1)
+        for n, piece in enumerate(pieces):
+            await asyncio.sleep((first if n == 0 else rest) * self.time_scale)
+            yield AIMessageChunk(content=piece)
+
+    def stats(self) -> Dict[str, int]:
+        return {"exact": self.exact, "substituted": self.substituted}
+
+
+def summarize(path: str) -> str:
+    by_kind: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for record in read_cassette(path):
+        by_kind[record["kind"]].append(record)
+    lines = [f"{path}: {sum(len(r) for r in by_kind.values())} calls"]
+    for kind, records in sorted(by_kind.items()):
+        latencies = [r["latency"] for r in records]
+        completion = [r["completion_tokens"] for r in records]
+        lines.append(
+            f"  {kind:<11} {len(records):>5} calls, latency p50 "
+            f"{percentile(latencies, 50):.2f}s p95 {percentile(latencies, 95):.2f}s, "
+            f"prompt tokens p50 {percentile([r['prompt_tokens'] for r in records], 50):.0f}, "
+            f"completion tokens p50 {percentile(completion, 50):.0f} "
+            f"max {max(completion)}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    print(summarize(sys.argv[1] if len(sys.argv) > 1 else llm_cassette_path))
@@ -0,0 +1,128 @@
+"""
+Adaptive concurrency limit for async LLM calls.
+
+The limit follows additive-increase / multiplicative-decrease: every call that
+finishes under the latency target nudges it up (by about one slot per window of
+``limit`` calls), a slow call trims it a little, and an error or a 429 halves it.
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+from config import (
+    llm_concurrency_initial,
+    llm_concurrency_max,
+    llm_concurrency_min,
+    llm_latency_target_seconds,
+)
+
+
+def is_rate_limit_error(exc: BaseException) -> bool:
+    """
+    Best-effort check for a quota/429 error from the Gemini client.
+    """
+    for attr in ("code", "status_code"):
+        value = getattr(exc, attr, None)
+        if value == 429 or getattr(value, "value", None) == 429:
+            return True
+    response = getattr(exc, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        return True
+    if type(exc).__name__ in ("ResourceExhausted", "RateLimitError"):
+        return True
+    return "429" in str(exc) or "RESOURCE_EXHAUSTED" in str(exc)
+
+
+class AdaptiveConcurrencyLimiter:
+    def __init__(
+        self,
+        initial: int = llm_concurrency_initial,
+        minimum: int = llm_concurrency_min,
+        maximum: int = llm_concurrency_max,
+        latency_target: float = llm_latency_target_seconds,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self._limit = float(min(max(initial, minimum), maximum))
+        self._in_flight = 0
+        # Created on first use in each event loop: asyncio primitives bind to
+        # the loop they first wait in, and scripts/tests run several in turn
+        self._condition: Optional[asyncio.Condition] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        self.successes = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _get_condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+        return self._condition
+
+    async def acquire(self):
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+    async def release(self):
+        condition = self._get_condition()
+        async with condition:
+            self._in_flight -= 1
+            condition.notify_all()
+
+    def record_success(self, latency: float):
+        self.successes += 1
+        if latency <= self.latency_target:
+            self._limit = min(self.maximum, self._limit + 1.0 / self._limit)
+        else:
+            self._limit = max(self.minimum, self._limit * 0.9)
+
+    def record_error(self, exc: BaseException):
+        self.errors += 1
+        if is_rate_limit_error(exc):
+            self.rate_limited += 1
+        self._limit = max(self.minimum, self._limit * 0.5)
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Hold one concurrency slot for the duration of an LLM call and feed its
+        outcome back into the limit.
+        """
+        await self.acquire()
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.record_error(e)
+            raise
+        else:
+            self.record_success(time.perf_counter() - start)
+        finally:
+            await self.release()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "limit": self.limit,
+            "in_flight": self._in_flight,
+            "successes": self.successes,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+        }
+
+
+llm_limiter = AdaptiveConcurrencyLimiter()
@@ -0,0 +1,404 @@
+"""
+Parsing helpers for raw LLM output.
+
+Model output is validated against the schemas.py models. Common defects
+(code fences, trailing prose, single quotes, trailing commas, truncated
+arrays, scores on a 0-10 scale) are repaired locally; only when that fails is
+the model asked once, with a short targeted prompt, to fix its own output.
+"""
+
+import json
+import re
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from schemas import EvalResult, EvalResultList, QnAList, QuestionAnswer
+
+FENCE_RE = re.compile(r"```(?:json)?", re.IGNORECASE)
+PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+SCORE_RE = re.compile(r"(-?\d+(?:\.\d+)?)\s*(?:/\s*(\d+(?:\.\d+)?))?")
+
+SCHEMA_HINTS = {
+    "qna": 'a JSON object whose keys are questions and whose values are their answers, e.g. {"<question>": "<answer>"}',
+    "eval": 'a JSON array with one object per answer, e.g. [{"score": <integer 0-5>, "feedback": "<comment>"}]',
+}
+
+
+class ParseStats:
+    """
+    Per-kind counts of how each LLM response was turned into structured data:
+    ``clean`` (parsed as-is), ``repaired`` (fixed locally), ``reasked`` (fixed
+    by one follow-up call) or ``failed``.
+    """
+
+    OUTCOMES = ("clean", "repaired", "reasked", "failed")
+
+    def __init__(self):
+        self.counts: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: {outcome: 0 for outcome in self.OUTCOMES}
+        )
+
+    def record(self, kind: str, outcome: str):
+        self.counts[kind][outcome] += 1
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        report = {}
+        for kind, counts in self.counts.items():
+            total = sum(counts.values())
+            report[kind] = dict(counts)
+            report[kind]["repair_rate"] = counts["repaired"] / total if total else 0.0
+            report[kind]["retry_rate"] = (
+                (counts["reasked"] + counts["failed"]) / total if total else 0.0
+            )
+        return report
+
+
+parse_stats = ParseStats()
+
+
+class IncrementalJSONArrayParser:
+    """
+    Pull complete elements out of a JSON array while its text is still streaming in.
+
+    Text before the opening ``[`` (e.g. a ```json fence) is ignored. ``feed``
+    returns the object/array elements that were completed by the new chunk, so
+    each one can be handed on before the model has finished the whole array.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._started = False
+        self._finished = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._element_start: Optional[int] = None
+
+    @property
+    def finished(self) -> bool:
+        return self._finished
+
+    def feed(self, chunk: str) -> List[Any]:
+        self._buffer += chunk
+        elements = []
+        buffer = self._buffer
+
+        while self._pos < len(buffer) and not self._finished:
+            ch = buffer[self._pos]
+
+            if not self._started:
+                if ch == "[":
+                    self._started = True
+                    self._depth = 1
+                self._pos += 1
+                continue
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                if self._depth == 1:
+                    self._element_start = self._pos
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 1 and self._element_start is not None:
+                    text = buffer[self._element_start : self._pos + 1]
+                    self._element_start = None
+                    try:
+                        elements.append(json.loads(text))
+                    except json.JSONDecodeError:
+                        pass
+                elif self._depth == 0:
+                    self._finished = True
+            self._pos += 1
+
+        # Drop text we will never look at again so long streams stay cheap
+        keep_from = (
+            self._element_start if self._element_start is not None else self._pos
+        )
+        if keep_from > 0:
+            self._buffer = self._buffer[keep_from:]
+            self._pos -= keep_from
+            if self._element_start is not None:
+                self._element_start = 0
+        return elements
+
+
+def _strip_to_json(raw: str) -> str:
+    text = FENCE_RE.sub("", raw or "")
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        return text.strip()
+    return text[min(starts) :].strip()
+
+
+def _balance(text: str) -> Optional[str]:
+    """
+    Cut ``text`` down to its first complete top-level value, dropping trailing
+    prose. If the value was truncated, keep the complete elements and close it.
+    """
+    stack = []
+    quote = None
+    escaped = False
+    last_safe = None
+
+    for i, ch in enumerate(text):
+        if quote:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == quote:
+                quote = None
+            continue
+
+        if ch in "\"'":
+            quote = ch
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if not stack:
+                return None
+            stack.pop()
+            if not stack:
+                return text[: i + 1]
+            if len(stack) == 1:
+                last_safe = i + 1
+        elif ch == "," and len(stack) == 1:
+            last_safe = i
+
+    if not stack or last_safe is None:
+        return None
+    return text[:last_safe].rstrip().rstrip(",") + stack[0]
+
+
+def _to_strict_json(text: str) -> str:
+    """
+    Rewrite single-quoted strings, Python literals and trailing commas into
+    strict JSON. Double-quoted strings are copied through untouched.
+    """
+    out = []
+    i, n = 0, len(text)
+    while i < n:
+        ch = text[i]
+        if ch == '"':
+            j = i + 1
+            while j < n and text[j] != '"':
+                j += 2 if text[j] == "\\" else 1
+            out.append(text[i : j + 1])
+            i = j + 1
+        elif ch == "'":
+            j = i + 1
+            buf = []
+            while j < n and text[j] != "'":
+                if text[j] == "\\" and j + 1 < n:
+                    buf.append("'" if text[j + 1] == "'" else text[j : j + 2])
+                    j += 2
+                    continue
+                buf.append('\\"' if text[j] == '"' else text[j])
+                j += 1
+            out.append('"' + "".join(buf) + '"')
+            i = j + 1
+        elif ch == ",":
+            rest = text[i + 1 :].lstrip()
+            if not rest or rest[0] not in "}]":
+                out.append(ch)
+            i += 1
+        elif ch.isalpha():
+            j = i
+            while j < n and text[j].isalpha():
+                j += 1
+            word = text[i:j]
+            out.append(PY_LITERALS.get(word, word))
+            i = j
+        else:
+            out.append(ch)
+            i += 1
+    return "".join(out)
+
+
+def load_json(raw: str) -> Tuple[Any, bool]:
+    """
+    Parse JSON out of a raw LLM response. Returns ``(data, repaired)``; ``data``
+    is None if the text could not be recovered.
+    """
+    text = _strip_to_json(raw)
+    try:
+        return json.loads(text), False
+    except json.JSONDecodeError:
+        pass
+
+    balanced = _balance(text)
+    for candidate in filter(None, (balanced, text)):
+        try:
+            return json.loads(_to_strict_json(candidate)), True
+        except json.JSONDecodeError:
+            continue
+    return None, True
+
+
+def _to_qna_list(data: Any) -> Optional[QnAList]:
+    items = []
+    if isinstance(data, dict):
+        data = data.get("questions", data) if len(data) == 1 else data
+    if isinstance(data, dict):
+        for question, answer in data.items():
+            if isinstance(question, str) and isinstance(answer, str):
+                items.append(QuestionAnswer(question=question, answer=answer))
+    elif isinstance(data, list):
+        for entry in data:
+            if isinstance(entry, dict) and "question" in entry:
+                items.append(
+                    QuestionAnswer(
+                        question=str(entry["question"]),
+                        answer=str(entry.get("answer", "")),
+                    )
+                )
+    return QnAList(items=items) if items else None
+
+
+def _read_score(value: Any) -> Tuple[Optional[float], Optional[float]]:
+    if isinstance(value, bool):
+        return None, None
+    if isinstance(value, (int, float)):
+        return float(value), None
+    match = SCORE_RE.search(str(value or ""))
+    if not match:
+        return None, None
+    out_of = float(match.group(2)) if match.group(2) else None
+    return float(match.group(1)), out_of
+
+
+def eval_scale(item: Any) -> Optional[float]:
+    """
+    The scale of an evaluation array, judged from its first scored element
+    ``item``: the score's own denominator ("8/10"), else 10 if the score is
+    above 5, else 5. None if ``item`` has no score, so the next one decides.
+    Streamed and whole responses use the same rule, so they grade alike.
+    """
+    if not isinstance(item, dict):
+        return None
+    score, out_of = _read_score(item.get("score"))
+    if score is None:
+        return None
+    return out_of or (10.0 if score > 5 else 5.0)
+
+
+def normalize_eval_item(
+    item: Any, scale: Optional[float] = None
+) -> Optional[EvalResult]:
+    """
+    Turn one evaluation object into an EvalResult on the 0-5 scale. Scores
+    written as "8/10" use their own denominator; otherwise ``scale`` (see
+    eval_scale) is assumed.
+    """
+    if not isinstance(item, dict):
+        return None
+    score, out_of = _read_score(item.get("score"))
+    if score is None:
+        return None
+    out_of = out_of or scale or (10.0 if score > 5 else 5.0)
+    score = round(score * 5 / out_of) if out_of else 0
+    feedback = item.get("feedback")
+    return EvalResult(
+        score=min(5, max(0, int(score))),
+        feedback=str(feedback) if feedback is not None else "No feedback available",
+    )
+
+
+def _to_eval_results(data: Any) -> Optional[EvalResultList]:
+    if isinstance(data, dict):
+        data = data.get("results", [data])
+    if not isinstance(data, list):
+        return None
+
+    # One scale for the whole array, so one 8 doesn't flip a neighbouring 4
+    # into a different scale
+    scale = next(filter(None, map(eval_scale, data)), None)
+
+    # One slot per element, so a bad element doesn't shift the rest onto
+    # the wrong answers
+    results = [normalize_eval_item(item, scale) for item in data]
+    return EvalResultList(results=results) if any(results) else None
+
+
+VALIDATORS = {"qna": _to_qna_list, "eval": _to_eval_results}
+
+
+def parse_structured(raw: str, kind: str) -> Tuple[Any, bool]:
+    """
+    Parse and validate ``raw`` as ``kind`` ("qna" or "eval") without calling
+    the model. Returns ``(result, repaired)``; ``result`` is None on failure.
+    """
+    data, repaired = load_json(raw)
+    if data is None:
+        return None, repaired
+    return VALIDATORS[kind](data), repaired
+
+
+def canonical_json(
+    raw: str, kind: str, expected: Optional[int] = None
+) -> Optional[str]:
+    """
+    ``raw`` re-serialized as clean JSON of ``kind`` if it parses without the
+    model's help and nothing in it is unusable (for "eval": every element has
+    a score and, when ``expected`` is given, there are that many), else None.
+    This is what is worth caching.
+    """
+    result, _ = parse_structured(raw, kind)
+    if result is None:
+        return None
+    if kind == "qna":
+        return json.dumps({item.question: item.answer for item in result.items})
+    if not all(result.results) or (
+        expected is not None and len(result.results) != expected
+    ):
+        return None
+    return json.dumps([r.model_dump() for r in result.results])
+
+
+def parse_with_reask(
+    raw: str, kind: str, reask: Optional[Callable[[str, str], str]] = None
+):
+    """
+    Parse ``raw`` as ``kind``, repairing locally and, if that fails, calling
+    ``reask(raw, schema_hint)`` once for a corrected response.
+    """
+    result, repaired = parse_structured(raw, kind)
+    if result is not None:
+        parse_stats.record(kind, "repaired" if repaired else "clean")
+        return result
+    if reask is not None:
+        result, _ = parse_structured(reask(raw, SCHEMA_HINTS[kind]), kind)
+        if result is not None:
+            parse_stats.record(kind, "reasked")
+            return result
+    parse_stats.record(kind, "failed")
+    return None
+
+
+async def aparse_with_reask(
+    raw: str, kind: str, reask: Optional[Callable[[str, str], Awaitable[str]]] = None
+):
+    """
+    Async counterpart of parse_with_reask.
+    """
+    result, repaired = parse_structured(raw, kind)
+    if result is not None:
+        parse_stats.record(kind, "repaired" if repaired else "clean")
+        return result
+    if reask is not None:
+        result, _ = parse_structured(await reask(raw, SCHEMA_HINTS[kind]), kind)
+        if result is not None:
+            parse_stats.record(kind, "reasked")
+            return result
+    parse_stats.record(kind, "failed")
+    return None
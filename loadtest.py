@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test of the API with the fake model standing in for Gemini.
+
+    python loadtest.py [--classes 3] [--students 25] [--duration 30] [--think 1.0]
+                       [--lessons 40] [--workers 1] [--seed 0]
+                       [--baseline loadtest_baseline.json] [--save-baseline]
+
+Seeds a fresh SQLite database with ``--lessons`` lessons (grades 4-8, five
+seed questions each), starts uvicorn on it with LLM_FAKE=true and drives it
+with classroom traffic: every class works through one lesson of its grade,
+and each student lists the grade's lessons, opens the lesson's questions,
+asks /generate-questions for a set, answers it and posts the answers to
+/feedback, with exponentially distributed think time (mean ``--think``
+seconds) between steps. Students join over the first ``--ramp`` seconds.
+
+Prints requests, errors, throughput and p50/p95/p99 latency per endpoint.
+The run is compared with the baseline file when it exists: a p95 more than
+``--tolerance`` slower, throughput more than ``--tolerance`` lower or a higher
+error rate on any endpoint is a regression and exits with status 1.
+``--save-baseline`` stores this run as the new baseline.
+
+The fake model defaults to a lognormal latency around 1s here; override it
+and its error / malformed-output rates with the FAKE_LLM_* variables (see
+fake_llm.py). With LLM_CASSETTE_MODE=replay the server answers from a
+recorded cassette instead, at the recorded latencies (see llm_cassette.py).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, NamedTuple, Optional
+
+import httpx
+
+# Absolute slack on latency comparisons, so millisecond jitter on fast
+# endpoints is not reported as a regression
+LATENCY_SLACK_SECONDS = 0.005
+ERROR_RATE_SLACK = 0.01
+
+SENTENCES = [
+    "The {a} stood near the {b} while the {c} waited for the morning train.",
+    "Every evening the children carried the {a} across the {b} to the {c}.",
+    "Nobody in the village had seen a {a} as bright as the one by the {b}.",
+    "When the {a} broke, the {b} and the {c} worked together to fix it.",
+    "Grandmother told a story about the {a}, the {b} and a lost {c}.",
+]
+WORDS = (
+    "river village market teacher festival letter journey garden harvest "
+    "monsoon bridge train school friend mother father doctor farmer kite "
+    "lamp rain forest mountain temple bicycle song soldier postman well "
+    "buffalo mango banyan drum bullock cart lantern notebook pencil"
+).split()
+
+
+class SeededLesson(NamedTuple):
+    id: str
+    title: str
+    grade_level: int
+
+
+def _paragraph(rng: random.Random, sentences: int) -> str:
+    return " ".join(
+        rng.choice(SENTENCES).format(
+            a=rng.choice(WORDS), b=rng.choice(WORDS), c=rng.choice(WORDS)
+        )
+        for _ in range(sentences)
+    )
+
+
+def seed_database(count: int, rng: random.Random) -> List[SeededLesson]:
+    """
+    Fill the (empty) database DATABASE_URL points at with lessons, their
+    chunks and seed questions.
+    """
+    from db.migrations import migrate
+    from db.models import Lesson, session_scope, upsert_questions
+    from lesson_context import index_lesson
+    from lesson_index import lesson_index
+
+    migrate()
+    lessons, to_index, questions = [], [], []
+    with session_scope() as db:
+        for n in range(count):
+            lesson = Lesson(
+                title=f"Lesson {n + 1:03d}: The {rng.choice(WORDS).title()}",
+                content="\n\n".join(
+                    _paragraph(rng, rng.randint(4, 8))
+                    for _ in range(rng.randint(6, 20))
+                ),
+                grade_level=4 + n % 5,
+            )
+            db.add(lesson)
+            db.flush()
+            chunks = index_lesson(db, lesson, update_index=False)
+            to_index.append(
+                (lesson.id, [(c.id, c.text) for c in chunks if c.kind == "body"])
+            )
+            lessons.append(SeededLesson(lesson.id, lesson.title, lesson.grade_level))
+            for q in range(5):
+                word = rng.choice(WORDS)
+                questions.append(
+                    {
+                        "lesson_id": lesson.id,
+                        "question_text": f"What happened to the {word} in part {q + 1}?",
+                        "correct_answer": _paragraph(rng, 2),
+                    }
+                )
+        db.commit()
+        upsert_questions(db, questions)
+    lesson_index.add_lessons(to_index)
+    return lessons
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port: int, workers: int, env: Dict[str, str], log_path: str):
+    log = open(log_path, "w")
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "api:app",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+        ],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+
+async def wait_until_ready(base_url: str, server, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError("server exited during startup")
+            try:
+                if (
+                    await client.get("/lessons", params={"limit": 1})
+                ).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"server not ready after {timeout:.0f}s")
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, Counter] = defaultdict(Counter)
+
+    async def request(
+        self, client: httpx.AsyncClient, label: str, method: str, url: str, **kwargs
+    ) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self.latencies[label].append(time.perf_counter() - start)
+            self.errors[label][type(e).__name__] += 1
+            return None
+        self.latencies[label].append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            self.errors[label][f"http {response.status_code}"] += 1
+            return None
+        return response
+
+    def summary(self, elapsed: float) -> Dict[str, Dict[str, float]]:
+        from utils import percentile
+
+        endpoints = {}
+        for label in sorted(self.latencies):
+            latencies = self.latencies[label]
+            errors = sum(self.errors[label].values())
+            endpoints[label] = {
+                "requests": len(latencies),
+                "errors": errors,
+                "error_rate": errors / len(latencies),
+                "rps": len(latencies) / elapsed,
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+            }
+        return endpoints
+
+
+async def student(
+    client: httpx.AsyncClient,
+    recorder: Recorder,
+    lesson: SeededLesson,
+    rng: random.Random,
+    args,
+    deadline: float,
+):
+    def think(scale: float = 1.0):
+        return asyncio.sleep(rng.expovariate(1.0 / (args.think * scale)))
+
+    await asyncio.sleep(rng.uniform(0, args.ramp))
+    while time.monotonic() < deadline:
+        await recorder.request(
+            client,
+            "GET /lessons",
+            "GET",
+            "/lessons",
+            params={"grade_level": lesson.grade_level},
+        )
+        await think()
+        await recorder.request(
+            client,
+            "GET /lessons/{id}/questions",
+            "GET",
+            f"/lessons/{lesson.id}/questions",
+        )
+        response = await recorder.request(
+            client,
+            "POST /generate-questions",
+            "POST",
+            "/generate-questions",
+            json={"lesson_title": lesson.title},
+        )
+        if response is None:
+            await think()
+            continue
+        # Writing the answers takes the longest
+        await think(3.0)
+        qna = {
+            question: _paragraph(rng, rng.randint(1, 3)) for question in response.json()
+        }
+        await recorder.request(
+            client,
+            "POST /feedback",
+            "POST",
+            "/feedback",
+            json={"lesson_title": lesson.title, "qna": qna},
+        )
+        await think()
+
+
+async def drive(base_url: str, lessons: List[SeededLesson], args) -> Recorder:
+    rng = random.Random(args.seed)
+    recorder = Recorder()
+    by_grade = defaultdict(list)
+    for lesson in lessons:
+        by_grade[lesson.grade_level].append(lesson)
+    grades = sorted(by_grade)
+
+    limits = httpx.Limits(max_connections=args.classes * args.students)
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=120, limits=limits
+    ) as client:
+        deadline = time.monotonic() + args.duration
+        tasks = []
+        for n in range(args.classes):
+            # Each class is one grade working through one lesson together
+            lesson = rng.choice(by_grade[grades[n % len(grades)]])
+            for _ in range(args.students):
+                tasks.append(
+                    student(
+                        client,
+                        recorder,
+                        lesson,
+                        random.Random(rng.random()),
+                        args,
+                        deadline,
+                    )
+                )
+        await asyncio.gather(*tasks)
+    return recorder
+
+
+def compare(
+    current: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    tolerance: float,
+) -> List[str]:
+    """
+    Regressions of this run against the baseline, one message each.
+    """
+    regressions = []
+    for label, base in baseline.items():
+        now = current.get(label)
+        if now is None:
+            regressions.append(f"{label}: no requests in this run")
+            continue
+        if now["p95"] > base["p95"] * (1 + tolerance) + LATENCY_SLACK_SECONDS:
+            regressions.append(
+                f"{label}: p95 {now['p95'] * 1000:.0f}ms vs {base['p95'] * 1000:.0f}ms"
+            )
+        if now["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(
+                f"{label}: {now['rps']:.1f} req/s vs {base['rps']:.1f} req/s"
+            )
+        if now["error_rate"] > base["error_rate"] + ERROR_RATE_SLACK:
+            regressions.append(
+                f"{label}: error rate {now['error_rate']:.1%} "
+                f"vs {base['error_rate']:.1%}"
+            )
+    return regressions
+
+
+def print_report(endpoints: Dict[str, Dict[str, float]], recorder: Recorder):
+    print(
+        f"{'endpoint':<30} {'requests':>8} {'errors':>6} {'req/s':>7} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    for label, row in endpoints.items():
+        print(
+            f"{label:<30} {row['requests']:>8} {row['errors']:>6} "
+            f"{row['rps']:>7.1f} {row['p50'] * 1000:>8.0f} "
+            f"{row['p95'] * 1000:>8.0f} {row['p99'] * 1000:>8.0f}"
+        )
+    for label, errors in recorder.errors.items():
+        if errors:
+            print(f"  {label} errors: {dict(errors)}")
+
+
+def main(args) -> int:
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    env = dict(os.environ)
+    env.update(
+        DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'loadtest.db')}",
+        LESSON_INDEX_PATH=os.path.join(workdir, "lesson_index"),
+        LLM_CACHE_PATH=os.path.join(workdir, "llm_cache.db"),
+        LLM_FAKE="true",
+    )
+    # Realistic-looking model latency and no outbound quota unless overridden
+    for key, value in (
+        ("FAKE_LLM_LATENCY_DIST", "lognormal"),
+        ("FAKE_LLM_LATENCY_MS", "1000"),
+        ("LLM_RPM", "0"),
+        ("LLM_TPM", "0"),
+        ("GOOGLE_API_KEY", "unused"),
+    ):
+        env.setdefault(key, value)
+    # The seeding below imports config, which reads these
+    os.environ.update(env)
+
+    server = log_path = None
+    try:
+        lessons = seed_database(args.lessons, random.Random(args.seed))
+        port = _free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        log_path = os.path.join(workdir, "server.log")
+        server = start_server(port, args.workers, env, log_path)
+        asyncio.run(wait_until_ready(base_url, server))
+        print(
+            f"{args.classes} classes x {args.students} students for "
+            f"{args.duration:.0f}s against {args.lessons} lessons "
+            f"({args.workers} worker(s), fake LLM {env['FAKE_LLM_LATENCY_DIST']} "
+            f"{env['FAKE_LLM_LATENCY_MS']}ms)"
+        )
+        start = time.monotonic()
+        recorder = asyncio.run(drive(base_url, lessons, args))
+        endpoints = recorder.summary(time.monotonic() - start)
+    except Exception:
+        if log_path is not None and os.path.exists(log_path):
+            with open(log_path) as f:
+                print(f.read()[-3000:])
+        raise
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(endpoints, recorder)
+    run_config = {
+        key: getattr(args, key)
+        for key in ("classes", "students", "duration", "think", "lessons", "workers")
+    }
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"config": run_config, "endpoints": endpoints}, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(
+            f"No baseline at {args.baseline}; run with --save-baseline to create one."
+        )
+        return 0
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("config") != run_config:
+        print(f"Note: baseline was recorded with {baseline.get('config')}")
+    regressions = compare(endpoints, baseline["endpoints"], args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        return 1
+    print(f"No regressions against {args.baseline}.")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--classes", type=int, default=3)
+    parser.add_argument("--students", type=int, default=25, help="per class")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--ramp", type=float, default=5, help="seconds")
+    parser.add_argument("--think", type=float, default=1.0, help="mean seconds")
+    parser.add_argument("--lessons", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default="loadtest_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25, help="allowed fractional change"
+    )
+    sys.exit(main(parser.parse_args()))
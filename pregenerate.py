@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Pre-generate banked questions for every lesson before term starts.
+
+    python pregenerate.py [--grade 4] [--target 20] [--concurrency 8] [--rpm 60]
+                          [--checkpoint pregenerate.checkpoint.json] [--restart] [--fake]
+
+Each lesson's generated-question pool (the one /generate-questions samples
+from) is topped up to ``--target`` questions. Up to ``--concurrency`` lessons
+are worked on at once, and generation calls start no faster than ``--rpm``
+per minute (0 for no ceiling). Finished lessons are recorded in the
+checkpoint file as they complete, so an interrupted run picks up where it
+stopped; ``--restart`` ignores the checkpoint. ``--fake`` uses the local fake
+model (same as LLM_FAKE=true) instead of Gemini.
+
+At the end it prints throughput, generation latency percentiles and failures.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from config import (
+    pregenerate_checkpoint_path,
+    pregenerate_concurrency,
+    pregenerate_max_rpm,
+    question_bank_low_water,
+    question_bank_max_refill_rounds,
+    question_generation_max,
+)
+
+
+class RateCeiling:
+    """
+    Spaces call starts at least ``60 / rpm`` seconds apart.
+    """
+
+    def __init__(self, rpm: int):
+        self.interval = 60.0 / rpm if rpm > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class Checkpoint:
+    """
+    Lessons already finished, kept in a JSON file that is rewritten
+    atomically after every lesson.
+    """
+
+    def __init__(self, path: str, restart: bool = False):
+        self.path = path
+        self.done: Dict[str, int] = {}
+        if not restart and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.done = json.load(f).get("done", {})
+
+    def mark_done(self, lesson_id: str, available: int):
+        self.done[lesson_id] = available
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"done": self.done}, f)
+        os.replace(tmp_path, self.path)
+
+
+class RunStats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lessons = Counter()
+        self.calls = 0
+        self.questions_added = 0
+        self.latencies: List[float] = []
+        self.failures = Counter()
+
+    def report(self) -> str:
+        from utils import percentile
+
+        elapsed = time.perf_counter() - self.start
+        lines = [
+            "lessons: "
+            + ", ".join(f"{k}: {v}" for k, v in sorted(self.lessons.items())),
+            f"generation calls: {self.calls}, questions added: "
+            f"{self.questions_added} in {elapsed:.1f}s "
+            f"({self.calls / elapsed:.2f} calls/s, "
+            f"{self.questions_added / elapsed:.1f} questions/s)",
+            "generation latency: "
+            + ", ".join(
+                f"p{p} {percentile(self.latencies, p):.2f}s" for p in (50, 95, 99)
+            )
+            + (f", max {max(self.latencies):.2f}s" if self.latencies else ""),
+        ]
+        failed = sum(self.failures.values())
+        lines.append(
+            f"failures: {failed}"
+            + (
+                " (" + ", ".join(f"{k}: {v}" for k, v in self.failures.items()) + ")"
+                if failed
+                else ""
+            )
+        )
+        return "\n".join(lines)
+
+
+def load_lessons(grade: Optional[int]) -> List[Tuple[str, str]]:
+    from db.models import Lesson, lessons_by_grade_query, session_scope
+
+    with session_scope() as db:
+        if grade is None:
+            query = db.query(Lesson.id, Lesson.title)
+        else:
+            query = lessons_by_grade_query(db, grade, Lesson.id, Lesson.title)
+        return [(lesson_id, title) for lesson_id, title in query.order_by(Lesson.title)]
+
+
+def pool_size(lesson_id: str) -> int:
+    from db.models import count_generated_questions, session_scope
+
+    with session_scope() as db:
+        return count_generated_questions(db, lesson_id)
+
+
+async def fill_lesson(
+    bank, lesson_id: str, title: str, target: int, ceiling: RateCeiling, stats
+) -> int:
+    """
+    Generate until the lesson's pool holds ``target`` questions, as
+    QuestionBank.refill does, but pacing and timing every call. Returns the
+    final pool size.
+    """
+    from agent import agenerate_q
+
+    available = pool_size(lesson_id)
+    for _ in range(question_bank_max_refill_rounds):
+        if available >= target:
+            break
+        await ceiling.wait()
+        start = time.perf_counter()
+        qna_list = await agenerate_q(
+            title,
+            bypass_cache=available > 0,
+            num_questions=min(target - available, question_generation_max),
+        )
+        stats.latencies.append(time.perf_counter() - start)
+        stats.calls += 1
+
+        added = bank.store(lesson_id, qna_list)
+        stats.questions_added += added
+        available += added
+        if not added:
+            break
+    return available
+
+
+async def run(args) -> int:
+    from db.migrations import migrate
+    from question_bank import QuestionBank
+    from rate_limiter import BATCH, priority_scope
+
+    migrate()
+    lessons = load_lessons(args.grade)
+    checkpoint = Checkpoint(args.checkpoint, restart=args.restart)
+    pending = [(i, t) for i, t in lessons if i not in checkpoint.done]
+    print(
+        f"{len(lessons)} lessons, {len(lessons) - len(pending)} already done "
+        f"per {args.checkpoint}; filling {len(pending)} to {args.target} questions"
+    )
+
+    bank = QuestionBank()
+    ceiling = RateCeiling(args.rpm)
+    stats = RunStats()
+    stats.lessons["skipped"] = len(lessons) - len(pending)
+    queue: asyncio.Queue = asyncio.Queue()
+    for lesson in pending:
+        queue.put_nowait(lesson)
+
+    async def worker():
+        while not queue.empty():
+            lesson_id, title = queue.get_nowait()
+            try:
+                available = await fill_lesson(
+                    bank, lesson_id, title, args.target, ceiling, stats
+                )
+            except Exception as e:
+                stats.lessons["failed"] += 1
+                stats.failures[type(e).__name__] += 1
+                print(f"FAILED {title!r}: {type(e).__name__}: {e}")
+                continue
+            # Short of target only when generation stopped yielding new questions
+            stats.lessons["filled" if available >= args.target else "short"] += 1
+            checkpoint.mark_done(lesson_id, available)
+            print(f"{title!r}: {available} questions")
+
+    try:
+        # Interactive traffic on the same quota keeps precedence over this job
+        with priority_scope(BATCH):
+            await asyncio.gather(*(worker() for _ in range(max(1, args.concurrency))))
+    finally:
+        print(stats.report())
+    return 1 if stats.lessons["failed"] else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--grade", type=int, help="only lessons of this grade")
+    parser.add_argument(
+        "--target",
+        type=int,
+        default=question_bank_low_water,
+        help="questions to bank per lesson",
+    )
+    parser.add_argument("--concurrency", type=int, default=pregenerate_concurrency)
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=pregenerate_max_rpm,
+        help="max generation calls started per minute (0: no ceiling)",
+    )
+    parser.add_argument("--checkpoint", default=pregenerate_checkpoint_path)
+    parser.add_argument(
+        "--restart", action="store_true", help="ignore the existing checkpoint"
+    )
+    parser.add_argument(
+        "--fake", action="store_true", help="use the local fake model (LLM_FAKE)"
+    )
+    args = parser.parse_args()
+    if args.fake:
+        import config
+
+        # llm.py reads this when agent is first imported, below
+        config.llm_fake = True
+    try:
+        sys.exit(asyncio.run(run(args)))
+    except KeyboardInterrupt:
+        print("Interrupted; run again to resume from the checkpoint.")
+        sys.exit(130)
@@ -0,0 +1,181 @@
+"""
+Local fast-path grading of short answers.
+
+Each answer is compared with the stored correct answer using lexical overlap
+on the answer-bearing words (reference words the question doesn't already
+give away), key-entity and number matches, and a length check. Clear-cut
+cases get a score and template feedback straight away; anything below the
+confidence threshold is escalated to the LLM.
+"""
+
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from config import pregrade_confidence_threshold, pregrade_enabled
+from schemas import EvalResult
+from utils import content_words
+
+NUMBER_RE = re.compile(r"\b\d+(?:[.,]\d+)?\b")
+ENTITY_RE = re.compile(r"(?<![.!?]\s)(?<!^)\b[A-Z][a-z]+(?:[-\s][A-Z][a-z]+)*")
+NUMERIC_QUESTION_RE = re.compile(
+    r"^\s*(when|how many|how much|how old|how long|in (what|which) year|what year)\b",
+    re.IGNORECASE,
+)
+NON_ANSWERS = frozenset(
+    [
+        "",
+        "no answer provided",
+        "i don't know",
+        "i dont know",
+        "idk",
+        "don't know",
+        "n/a",
+        "na",
+        "-",
+    ]
+)
+
+FEEDBACK_TEMPLATES = {
+    5: "Excellent! Your answer is correct and covers the key point. Keep it up!",
+    4: "Great job! Your answer gets the main idea right. Try adding a little more detail from the lesson.",
+    0: "It looks like this answer is missing. Read that part of the lesson again and give it a try!",
+    1: "Good try, but this isn't quite right. Look back at the lesson to find the correct answer.",
+}
+
+
+def _entities(text: str) -> set:
+    return {e.lower() for e in ENTITY_RE.findall(text)}
+
+
+def _numbers(text: str) -> set:
+    return {n.replace(",", "") for n in NUMBER_RE.findall(text)}
+
+
+class PreGrader:
+    def __init__(
+        self,
+        threshold: float = pregrade_confidence_threshold,
+        enabled: bool = pregrade_enabled,
+    ):
+        self.threshold = threshold
+        self.enabled = enabled
+
+        self.graded = 0
+        self.escalated = 0
+
+    def features(self, items: Sequence[Tuple[str, str, str]]) -> Dict[str, np.ndarray]:
+        """
+        Per-item comparison features; NaN marks a feature that doesn't apply
+        (e.g. number match when the reference has no numbers).
+        """
+        n = len(items)
+        recall = np.zeros(n)
+        entity_match = np.full(n, np.nan)
+        number_match = np.full(n, np.nan)
+        length_ratio = np.zeros(n)
+        answer_words = np.zeros(n)
+        blank = np.zeros(n, dtype=bool)
+        numeric_question = np.zeros(n, dtype=bool)
+
+        for i, (question, answer, reference) in enumerate(items):
+            answer_terms = set(content_words(answer))
+            question_terms = set(content_words(question))
+            reference_words = content_words(reference)
+            key_terms = set(reference_words) - question_terms or set(reference_words)
+
+            blank[i] = answer.strip().lower().rstrip(".!") in NON_ANSWERS
+            numeric_question[i] = bool(NUMERIC_QUESTION_RE.match(question))
+            answer_words[i] = len(answer_terms)
+            length_ratio[i] = len(content_words(answer)) / max(1, len(reference_words))
+            if key_terms:
+                recall[i] = len(key_terms & answer_terms) / len(key_terms)
+
+            key_entities = _entities(reference) - _entities(question)
+            if key_entities:
+                answer_lower = answer.lower()
+                entity_match[i] = sum(e in answer_lower for e in key_entities) / len(
+                    key_entities
+                )
+            key_numbers = _numbers(reference) - _numbers(question)
+            if key_numbers:
+                number_match[i] = len(key_numbers & _numbers(answer)) / len(key_numbers)
+
+        return {
+            "recall": recall,
+            "entity_match": entity_match,
+            "number_match": number_match,
+            "length_ratio": length_ratio,
+            "answer_words": answer_words,
+            "blank": blank,
+            "numeric_question": numeric_question,
+        }
+
+    def score(
+        self, items: Sequence[Tuple[str, str, str]]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Vectorized 0-5 scores and 0-1 confidences for a batch of
+        (question, answer, reference) items.
+        """
+        f = self.features(items)
+        entity = np.where(np.isnan(f["entity_match"]), f["recall"], f["entity_match"])
+        overlap = 0.6 * f["recall"] + 0.4 * entity
+        scores = np.clip(np.rint(overlap * 5), 0, 5)
+
+        # High overlap is strong evidence; low overlap may just be a paraphrase,
+        # so it never counts as confident on its own
+        confidence = np.clip((overlap - 0.5) * 2, 0, 1)
+        confidence = np.where(f["length_ratio"] < 0.3, confidence * 0.5, confidence)
+
+        # "When was he born?" -> "1564": the number is the whole answer
+        numeric = f["numeric_question"] & ~np.isnan(f["number_match"])
+        right_number = numeric & (f["number_match"] == 1)
+        wrong_number = numeric & (f["number_match"] == 0) & (f["answer_words"] <= 3)
+        wrong_number &= np.array([bool(_numbers(a)) for _, a, _ in items], dtype=bool)
+        scores = np.where(right_number, 5, np.where(wrong_number, 1, scores))
+        confidence = np.where(right_number | wrong_number, 0.95, confidence)
+
+        scores = np.where(f["blank"], 0, scores)
+        confidence = np.where(f["blank"], 1.0, confidence)
+        return scores.astype(int), confidence
+
+    def grade(
+        self, items: Sequence[Tuple[str, str, str]], has_reference: Sequence[bool]
+    ) -> List[Optional[EvalResult]]:
+        """
+        Grade what can be graded locally. Returns one entry per item: an
+        EvalResult for confident cases, None for items to escalate.
+        """
+        if not self.enabled or not items:
+            self.escalated += len(items)
+            return [None] * len(items)
+
+        scores, confidence = self.score(items)
+        results: List[Optional[EvalResult]] = []
+        for i, (_, answer, _) in enumerate(items):
+            blank = answer.strip().lower().rstrip(".!") in NON_ANSWERS
+            if (has_reference[i] or blank) and confidence[i] >= self.threshold:
+                score = int(scores[i])
+                feedback = (
+                    FEEDBACK_TEMPLATES.get(score)
+                    or FEEDBACK_TEMPLATES[4 if score >= 3 else 1]
+                )
+                results.append(EvalResult(score=score, feedback=feedback))
+                self.graded += 1
+            else:
+                results.append(None)
+                self.escalated += 1
+        return results
+
+    def stats(self) -> Dict[str, float]:
+        total = self.graded + self.escalated
+        return {
+            "graded_locally": self.graded,
+            "escalated": self.escalated,
+            "escalation_rate": self.escalated / total if total else 0.0,
+        }
+
+
+pregrader = PreGrader()
@@ -0,0 +1,589 @@
+#!/usr/bin/env python3
+"""
+Opt-in sampling profiler for the API process and for single agent runs.
+
+A ``PROFILING_SAMPLE_RATE`` fraction of HTTP requests is profiled. While one
+is in flight, a background thread snapshots every thread's Python stack each
+``PROFILING_INTERVAL_MS`` and keeps the samples that belong to a profiled
+request, per endpoint: event-loop samples by the asyncio task that was
+running (tasks started by a request belong to it), worker-thread samples by
+the sync endpoint function on the stack. Threads parked on a lock, a queue
+or the selector are skipped, so the profile shows where time goes while code
+is running. Allocation tracing (tracemalloc) can be switched on too; it slows
+every allocation, so it is meant for short windows.
+
+The sampler thread only runs when the thread holding the GIL lets go, so
+samples bunch up where code releases it (I/O, sleeps) and can miss pure-Python
+hot spots. ``PROFILING_SWITCH_INTERVAL_US`` (off by default) shortens the GIL
+switch interval while sampling to even that out, at the cost of a GIL
+handoff that often in every thread of the process, sampled or not.
+
+Both are changed at runtime through the /admin/profile routes in api.py
+(``Authorization: Bearer $PROFILING_ADMIN_TOKEN``; without a token the routes
+are disabled), which also download the profiles as a top-functions table,
+collapsed stacks (flamegraph.pl, speedscope) or speedscope JSON. Each uvicorn
+worker profiles itself.
+
+    python profiling.py generate ["Lesson title"] [--repeat 200] [--allocations]
+                        [--format top|collapsed|speedscope] [--output FILE]
+    python profiling.py evaluate ["Lesson title"] [...]
+
+profiles generate_q, or the grading of one generated question set, against
+the fake model (no network, cache off), ``--repeat`` times in a row.
+"""
+
+import argparse
+import asyncio
+import json
+import linecache
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import weakref
+from collections import Counter
+from contextvars import ContextVar
+from types import CodeType
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import (
+    profiling_interval_ms,
+    profiling_max_stacks,
+    profiling_sample_rate,
+    profiling_switch_interval_us,
+)
+
+FORMATS = ("top", "collapsed", "speedscope")
+# Stands in for new stacks once a profile holds max_stacks distinct ones
+TRUNCATED = ("(truncated)", "", 0)
+
+# A stack is a tuple of frames, innermost first: code objects for CPU
+# samples, (name, file, line) for allocation sites. A profile maps each
+# label (endpoint) to a Counter of stacks.
+Profiles = Dict[str, Counter]
+
+_profiled_scope: ContextVar[Optional[dict]] = ContextVar("profiled_scope", default=None)
+
+
+def _idle_codes() -> set:
+    """
+    Innermost frames of a thread that is waiting rather than running code.
+    """
+    import concurrent.futures.thread
+    import selectors
+
+    codes = {threading.Condition.wait.__code__}
+    for name in ("SelectSelector", "PollSelector", "EpollSelector", "KqueueSelector"):
+        selector = getattr(selectors, name, None)
+        if selector is not None:
+            codes.add(selector.select.__code__)
+    # Idle executor threads block in C below these
+    codes.add(concurrent.futures.thread._worker.__code__)
+    # An event loop implemented in C (uvloop) idles below the runner
+    codes.add(asyncio.Runner.run.__code__)
+    return codes
+
+
+class SamplingProfiler:
+    """
+    Samples thread stacks every ``interval_ms`` while started (calls to
+    start and stop nest) and counts them per ``label``. A non-zero
+    ``switch_interval_us`` sets the process's GIL switch interval while
+    started (see the module docstring for its cost).
+    """
+
+    def __init__(
+        self,
+        interval_ms: float = profiling_interval_ms,
+        max_stacks: int = profiling_max_stacks,
+        switch_interval_us: float = profiling_switch_interval_us,
+    ):
+        self.interval_ms = interval_ms
+        self.max_stacks = max_stacks
+        self.switch_interval_us = switch_interval_us
+        self.profiles: Profiles = {}
+        self._lock = threading.Lock()
+        self._active = 0
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._switch_interval = sys.getswitchinterval()
+        self._idle = _idle_codes()
+
+        self.samples = 0
+        self.sampling_seconds = 0.0
+
+    def label(self, thread_id: int, stack: List[CodeType]) -> Optional[str]:
+        """
+        The profile a thread's sample belongs to, or None to drop it.
+        """
+        raise NotImplementedError
+
+    def start(self):
+        with self._lock:
+            self._active += 1
+            if self._active == 1 and self.switch_interval_us:
+                self._switch_interval = sys.getswitchinterval()
+                sys.setswitchinterval(
+                    min(self._switch_interval, self.switch_interval_us / 1e6)
+                )
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="sampling-profiler", daemon=True
+                )
+                self._thread.start()
+            self._wake.set()
+
+    def stop(self):
+        with self._lock:
+            self._active -= 1
+            if not self._active:
+                self._wake.clear()
+                if self.switch_interval_us:
+                    sys.setswitchinterval(self._switch_interval)
+
+    def reset(self):
+        with self._lock:
+            self.profiles = {}
+            self.samples = 0
+            self.sampling_seconds = 0.0
+
+    def snapshot(self) -> Profiles:
+        with self._lock:
+            return {label: Counter(stacks) for label, stacks in self.profiles.items()}
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            self._wake.wait()
+            started = time.perf_counter()
+            self._sample(own)
+            elapsed = time.perf_counter() - started
+            self.sampling_seconds += elapsed
+            time.sleep(max(0.0, self.interval_ms / 1000 - elapsed))
+
+    def _sample(self, own: int):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own or frame.f_code in self._idle:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            label = self.label(thread_id, stack)
+            if label is not None:
+                self._add(label, tuple(stack))
+
+    def _add(self, label: str, stack: tuple):
+        with self._lock:
+            stacks = self.profiles.setdefault(label, Counter())
+            if stack not in stacks and len(stacks) >= self.max_stacks:
+                stack = (TRUNCATED,)
+            stacks[stack] += 1
+            self.samples += 1
+
+
+class ThreadProfiler(SamplingProfiler):
+    """
+    Profiles one thread under a fixed label (the CLI's main thread).
+    """
+
+    def __init__(self, thread_id: int, name: str, **kwargs):
+        super().__init__(**kwargs)
+        self.thread_id = thread_id
+        self.name = name
+
+    def label(self, thread_id: int, stack: List[CodeType]) -> Optional[str]:
+        return self.name if thread_id == self.thread_id else None
+
+
+def _route_path(scope: dict) -> str:
+    # Set by the router once the request has been matched
+    return getattr(scope.get("route"), "path", None) or "unmatched"
+
+
+class RequestProfiler(SamplingProfiler):
+    """
+    Profiles a ``sample_rate`` fraction of HTTP requests, per endpoint (see
+    ProfilingMiddleware).
+    """
+
+    def __init__(self, sample_rate: float = profiling_sample_rate, **kwargs):
+        super().__init__(**kwargs)
+        self.sample_rate = sample_rate
+        self.requests: Counter = Counter()
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._endpoints: Dict[CodeType, str] = {}
+        # id(scope) -> scope of the profiled requests in flight
+        self._in_flight: Dict[int, dict] = {}
+        self._task_scopes: "weakref.WeakKeyDictionary[asyncio.Task, dict]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def _install(self, app, loop: asyncio.AbstractEventLoop):
+        """
+        On the first profiled request: learn the endpoint functions and make
+        the loop tag tasks created on behalf of a profiled request.
+        """
+        for route in getattr(app, "routes", []):
+            code = getattr(getattr(route, "endpoint", None), "__code__", None)
+            if code is not None and hasattr(route, "path"):
+                self._endpoints[code] = route.path
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+
+        previous = loop.get_task_factory()
+        task_scopes = self._task_scopes
+
+        def task_factory(loop, coro, **kwargs):
+            if previous is None:
+                task = asyncio.Task(coro, loop=loop, **kwargs)
+            else:
+                task = previous(loop, coro, **kwargs)
+            scope = _profiled_scope.get()
+            if scope is not None:
+                task_scopes[task] = scope
+            return task
+
+        loop.set_task_factory(task_factory)
+
+    def begin(self, scope: dict, app):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._install(app, loop)
+        self._task_scopes[asyncio.current_task()] = scope
+        self._in_flight[id(scope)] = scope
+        self.start()
+
+    def end(self, scope: dict):
+        self.stop()
+        self._in_flight.pop(id(scope), None)
+        self.requests[_route_path(scope)] += 1
+
+    def label(self, thread_id: int, stack: List[CodeType]) -> Optional[str]:
+        if thread_id == self._loop_thread:
+            task = asyncio.current_task(self._loop)
+            scope = self._task_scopes.get(task) if task is not None else None
+            if scope is None or id(scope) not in self._in_flight:
+                return None
+            return _route_path(scope)
+        # A worker thread running a sync endpoint
+        for code in stack:
+            endpoint = self._endpoints.get(code)
+            if endpoint is not None:
+                in_flight = [_route_path(s) for s in list(self._in_flight.values())]
+                return endpoint if endpoint in in_flight else None
+        return None
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            samples = {label: sum(s.values()) for label, s in self.profiles.items()}
+        traced = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else None
+        return {
+            "sample_rate": self.sample_rate,
+            "interval_ms": self.interval_ms,
+            "switch_interval_us": self.switch_interval_us,
+            "profiled_requests": dict(self.requests),
+            "in_flight": len(self._in_flight),
+            "samples": samples,
+            "sampling_seconds": round(self.sampling_seconds, 3),
+            "allocation_tracing": tracemalloc.is_tracing(),
+            "traced_bytes": traced[0] if traced else 0,
+        }
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware that profiles a sample of requests with request_profiler.
+    """
+
+    def __init__(self, app, profiler: Optional[RequestProfiler] = None):
+        self.app = app
+        self.profiler = profiler or request_profiler
+
+    async def __call__(self, scope, receive, send):
+        profiler = self.profiler
+        if (
+            scope["type"] != "http"
+            or not profiler.sample_rate
+            or random.random() >= profiler.sample_rate
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        token = _profiled_scope.set(scope)
+        profiler.begin(scope, scope.get("app"))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.end(scope)
+            _profiled_scope.reset(token)
+
+
+def set_allocation_tracing(enabled: bool, frames: int = 25):
+    if enabled and not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    elif not enabled and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def allocation_profiles(label: str = "allocations", limit: int = 500) -> Profiles:
+    """
+    Memory allocated since tracing started and still live, in bytes, by the
+    ``limit`` largest allocating stacks.
+    """
+    if not tracemalloc.is_tracing():
+        return {}
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        (tracemalloc.Filter(False, tracemalloc.__file__),)
+    )
+    stacks: Counter = Counter()
+    for stat in snapshot.statistics("traceback")[:limit]:
+        # tracemalloc lists frames outermost first
+        stack = tuple(
+            (_source_line(f.filename, f.lineno), f.filename, f.lineno)
+            for f in reversed(stat.traceback)
+        )
+        stacks[stack] += stat.size
+    return {label: stacks}
+
+
+def _source_line(filename: str, lineno: int) -> str:
+    # ";" separates frames in collapsed stacks
+    line = linecache.getline(filename, lineno).strip().replace(";", ",")
+    return line[:80] or "?"
+
+
+def _frame(entry) -> Tuple[str, str, int]:
+    if isinstance(entry, CodeType):
+        name = getattr(entry, "co_qualname", entry.co_name)
+        return (name, entry.co_filename, entry.co_firstlineno)
+    return entry
+
+
+def _short_path(filename: str) -> str:
+    if "site-packages" in filename:
+        return filename.split("site-packages" + os.sep, 1)[1]
+    if filename.startswith(os.getcwd() + os.sep):
+        return os.path.relpath(filename)
+    return os.path.basename(filename)
+
+
+def _frame_name(frame: Tuple[str, str, int]) -> str:
+    name, filename, line = frame
+    return f"{name} ({_short_path(filename)}:{line})" if filename else name
+
+
+def collapsed(profiles: Profiles) -> str:
+    """
+    One "label;outer;...;inner count" line per stack, as flamegraph.pl reads.
+    """
+    lines = []
+    for label, stacks in sorted(profiles.items()):
+        for stack, count in stacks.most_common():
+            frames = [label] + [_frame_name(_frame(e)) for e in reversed(stack)]
+            lines.append(f"{';'.join(frames)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def speedscope(
+    profiles: Profiles, unit: str, weight: float = 1.0, name: str = "tutor"
+) -> Dict[str, Any]:
+    """
+    Speedscope's file format, one sampled profile per label.
+    """
+    frames: List[Dict[str, Any]] = []
+    index: Dict[Tuple[str, str, int], int] = {}
+    out = []
+    for label, stacks in sorted(profiles.items(), key=lambda p: -sum(p[1].values())):
+        samples, weights = [], []
+        for stack, count in stacks.most_common():
+            ids = []
+            for entry in reversed(stack):
+                frame = _frame(entry)
+                if frame not in index:
+                    index[frame] = len(frames)
+                    frames.append(
+                        {"name": frame[0], "file": frame[1], "line": frame[2]}
+                    )
+                ids.append(index[frame])
+            samples.append(ids)
+            weights.append(count * weight)
+        out.append(
+            {
+                "type": "sampled",
+                "name": label,
+                "unit": unit,
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }
+        )
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": "profiling.py",
+        "activeProfileIndex": 0,
+        "shared": {"frames": frames},
+        "profiles": out,
+    }
+
+
+def top(profiles: Profiles, unit: str, weight: float = 1.0, limit: int = 25) -> str:
+    """
+    The functions (or allocation sites) with the most samples of their own,
+    with their inclusive share, per label.
+    """
+    lines = []
+    for label, stacks in sorted(profiles.items()):
+        total = sum(stacks.values())
+        own: Counter = Counter()
+        inclusive: Counter = Counter()
+        for stack, count in stacks.items():
+            own[_frame(stack[0])] += count
+            for frame in {_frame(e) for e in stack}:
+                inclusive[frame] += count
+        lines.append(f"{label}: {total * weight:,.0f} {unit}")
+        lines.append(f"  {'self':>6} {'total':>6}  function")
+        for frame, count in own.most_common(limit):
+            lines.append(
+                f"  {100 * count / total:5.1f}% {100 * inclusive[frame] / total:5.1f}%"
+                f"  {_frame_name(frame)}"
+            )
+    return "\n".join(lines) + "\n"
+
+
+def render(
+    profiles: Profiles,
+    fmt: str,
+    allocations: bool = False,
+    interval_ms: float = profiling_interval_ms,
+) -> Tuple[str, str]:
+    """
+    A profile in ``fmt`` (one of FORMATS) and its media type. CPU profiles
+    are weighted in milliseconds at the sampling interval, allocation
+    profiles in bytes.
+    """
+    if allocations:
+        unit, weight = "bytes", 1.0
+    else:
+        unit, weight = "milliseconds", interval_ms
+    if fmt == "speedscope":
+        return json.dumps(speedscope(profiles, unit, weight)), "application/json"
+    if fmt == "collapsed":
+        return collapsed(profiles), "text/plain"
+    return top(profiles, unit, weight), "text/plain"
+
+
+request_profiler = RequestProfiler()
+
+
+def _first_lesson_title() -> Optional[str]:
+    from db.models import Lesson, session_scope
+
+    with session_scope() as db:
+        return db.query(Lesson.title).order_by(Lesson.title).limit(1).scalar()
+
+
+def run_cli(args) -> int:
+    import config
+
+    # Read when agent (and with it llm.py and llm_cache.py) is imported below
+    config.llm_fake = True
+    config.fake_llm_latency_ms = args.latency_ms
+    config.llm_cache_enabled = False
+
+    from agent import aevaluate_qna, generate_q
+    from db.migrations import migrate
+
+    migrate()
+    title = args.lesson_title or _first_lesson_title()
+    if not title:
+        print("No lessons in the database")
+        return 1
+
+    if args.target == "generate":
+        label = "generate_q"
+
+        def workload():
+            for _ in range(args.repeat):
+                generate_q(title, bypass_cache=True)
+
+    else:
+        label = "evaluation"
+        qna = {i.question: i.answer for i in generate_q(title, bypass_cache=True).items}
+        if not qna:
+            print(f"No questions could be generated for {title!r}")
+            return 1
+
+        async def evaluate_all():
+            for _ in range(args.repeat):
+                await aevaluate_qna(title, qna)
+
+        def workload():
+            asyncio.run(evaluate_all())
+
+    start = time.perf_counter()
+    if args.allocations:
+        set_allocation_tracing(True)
+        try:
+            workload()
+            profiles = allocation_profiles(label)
+        finally:
+            set_allocation_tracing(False)
+    else:
+        profiler = ThreadProfiler(
+            threading.get_ident(),
+            label,
+            interval_ms=args.interval_ms,
+            switch_interval_us=args.switch_interval_us,
+        )
+        profiler.start()
+        try:
+            workload()
+        finally:
+            profiler.stop()
+        profiles = profiler.snapshot()
+    elapsed = time.perf_counter() - start
+
+    body, _ = render(profiles, args.format, args.allocations, args.interval_ms)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(body)
+        print(f"Wrote {args.output}")
+    else:
+        print(body, end="")
+    print(f"{args.repeat} x {label} on {title!r} in {elapsed:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("target", choices=("generate", "evaluate"))
+    parser.add_argument("lesson_title", nargs="?", help="default: the first lesson")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--interval-ms", type=float, default=1.0)
+    parser.add_argument(
+        "--switch-interval-us",
+        type=float,
+        default=profiling_switch_interval_us,
+        help="GIL switch interval while sampling (0: unchanged); evens out samples",
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=0.0,
+        help="fake model latency (0 keeps the profile on our own code)",
+    )
+    parser.add_argument(
+        "--allocations",
+        action="store_true",
+        help="profile live allocated memory (tracemalloc) instead of CPU",
+    )
+    parser.add_argument("--format", choices=FORMATS, default="top")
+    parser.add_argument("--output", help="write the profile here instead of stdout")
+    sys.exit(run_cli(parser.parse_args()))
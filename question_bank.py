@@ -0,0 +1,201 @@
+"""
+Per-lesson pool of LLM-generated questions.
+
+/generate-questions samples from the pool instead of running a generation on
+every click. When a lesson's pool drops below the low-water mark a background
+task tops it up with ``agenerate_q``; only a cold, empty pool makes the request
+wait for the LLM. Each refill round asks only for the number of questions
+still missing, and generated questions that paraphrase a seed or banked
+question are dropped before they are stored.
+"""
+
+import asyncio
+from typing import Dict, List, Optional, Set, Tuple
+
+from agent import agenerate_q
+from config import (
+    question_bank_low_water,
+    question_bank_max_refill_rounds,
+    question_bank_sample_size,
+    question_generation_max,
+)
+from db.models import (
+    SessionLocal,
+    add_generated_questions,
+    count_generated_questions,
+    count_question_texts,
+    get_question_texts,
+    sample_generated_questions,
+)
+from lesson_cache import lesson_cache
+from rate_limiter import BATCH, priority_scope
+from question_dedupe import question_dedupe
+from schemas import QnAList, QuestionAnswer
+from tracing import set_grade
+
+
+class QuestionBank:
+    def __init__(
+        self,
+        sample_size: int = question_bank_sample_size,
+        low_water: int = question_bank_low_water,
+        max_refill_rounds: int = question_bank_max_refill_rounds,
+    ):
+        self.sample_size = sample_size
+        self.low_water = low_water
+        self.max_refill_rounds = max_refill_rounds
+
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._refilling: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+        self.served = 0
+        self.generation_calls = 0
+        self.generated = 0
+        self.duplicates = 0
+
+    def _lock_for(self, lesson_id: str) -> asyncio.Lock:
+        if lesson_id not in self._locks:
+            self._locks[lesson_id] = asyncio.Lock()
+        return self._locks[lesson_id]
+
+    async def sample(self, lesson_title: str) -> QnAList:
+        """
+        Serve ``sample_size`` banked questions for a lesson, generating first
+        only if the pool cannot fill a single sample. The DB work runs in a
+        worker thread: sampling commits the served counts, and under SQLite a
+        commit can wait on the database lock.
+        """
+        found = await asyncio.to_thread(self._find_lesson, lesson_title)
+        if found is None:
+            return QnAList(items=[])
+        lesson_id, available = found
+
+        if available < self.sample_size:
+            await self.refill(lesson_id, lesson_title, target=self.sample_size)
+        if available < self.low_water:
+            self.schedule_refill(lesson_id, lesson_title)
+
+        items = await asyncio.to_thread(self._sample_items, lesson_id)
+        self.served += 1
+        return QnAList(items=items)
+
+    def _find_lesson(self, lesson_title: str) -> Optional[Tuple[str, int]]:
+        db = SessionLocal()
+        try:
+            lesson = lesson_cache.get_lesson(db, title=lesson_title)
+            if not lesson:
+                return None
+            set_grade(lesson.grade_level)
+            return lesson.id, count_generated_questions(db, lesson.id)
+        finally:
+            db.close()
+
+    def _sample_items(self, lesson_id: str) -> List[QuestionAnswer]:
+        db = SessionLocal()
+        try:
+            questions = sample_generated_questions(db, lesson_id, self.sample_size)
+            return [
+                QuestionAnswer(question=q.question_text, answer=q.correct_answer or "")
+                for q in questions
+            ]
+        finally:
+            db.close()
+
+    def schedule_refill(self, lesson_id: str, lesson_title: str):
+        """
+        Top the pool up in the background unless a refill is already running.
+        """
+        if lesson_id in self._refilling:
+            return
+        # Nobody is waiting on a top-up, so it yields quota to students
+        with priority_scope(BATCH):
+            task = asyncio.get_running_loop().create_task(
+                self.refill(lesson_id, lesson_title)
+            )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def refill(
+        self, lesson_id: str, lesson_title: str, target: Optional[int] = None
+    ) -> int:
+        """
+        Generate until the pool holds ``target`` questions (the low-water mark by
+        default), bounded by ``max_refill_rounds``. Concurrent callers for the same lesson wait on
+        the same lock and re-check the pool instead of generating again.
+        """
+        added_total = 0
+        async with self._lock_for(lesson_id):
+            self._refilling.add(lesson_id)
+            try:
+                if target is None:
+                    target = max(self.low_water, self.sample_size)
+                for _ in range(self.max_refill_rounds):
+                    available = await asyncio.to_thread(self._count, lesson_id)
+                    if available >= target:
+                        break
+
+                    # Once the pool has anything in it, a cached response would
+                    # only hand back questions we already stored.
+                    qna_list = await agenerate_q(
+                        lesson_title,
+                        bypass_cache=available > 0,
+                        num_questions=min(target - available, question_generation_max),
+                    )
+                    self.generation_calls += 1
+
+                    added = await asyncio.to_thread(self.store, lesson_id, qna_list)
+                    added_total += added
+                    if not added:
+                        break
+            except Exception as e:
+                print(f"Question bank refill failed for '{lesson_title}': {e}")
+            finally:
+                self._refilling.discard(lesson_id)
+        return added_total
+
+    def _count(self, lesson_id: str) -> int:
+        db = SessionLocal()
+        try:
+            return count_generated_questions(db, lesson_id)
+        finally:
+            db.close()
+
+    def store(self, lesson_id: str, qna_list: QnAList) -> int:
+        """
+        Bank generated questions for a lesson, dropping near-duplicates of
+        anything it already has. Returns the number of rows added.
+        """
+        if not qna_list.items:
+            return 0
+        db = SessionLocal()
+        try:
+            stored = count_question_texts(db, lesson_id)
+            if not question_dedupe.is_current(lesson_id, stored):
+                # First use, or another worker, pregenerate.py or a seed
+                # import changed the lesson's questions since
+                texts = get_question_texts(db, lesson_id)
+                question_dedupe.load(lesson_id, texts)
+                stored = len(texts)
+            qna_dict = {item.question: item.answer for item in qna_list.items}
+            fresh = question_dedupe.screen(lesson_id, list(qna_dict))
+            self.generated += len(qna_dict)
+            self.duplicates += len(qna_dict) - len(fresh)
+            added = add_generated_questions(
+                db, lesson_id, {question: qna_dict[question] for question in fresh}
+            )
+            # Only after the commit, so a failed write leaves nothing behind
+            # that would block these questions later
+            question_dedupe.record(lesson_id, fresh, stored + added)
+            return added
+        finally:
+            db.close()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "served": self.served,
+            "generation_calls": self.generation_calls,
+            "generated": self.generated,
+            "duplicates": self.duplicates,
+            "refills_running": len(self._refilling),
+        }
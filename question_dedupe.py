@@ -0,0 +1,207 @@
+"""
+Near-duplicate detection for question texts.
+
+Each question is reduced to its set of content words (lightly stemmed) and a
+MinHash signature of that set. Signatures are split into bands and bucketed
+per lesson (LSH), so a lookup only compares a new question against the few
+stored questions that share a band with it, not the whole bank. Candidates are
+confirmed with the exact Jaccard similarity of the word sets.
+"""
+
+import threading
+import zlib
+from typing import Dict, FrozenSet, List, Sequence, Tuple
+
+import numpy as np
+
+from config import dedupe_bands, dedupe_num_perm, dedupe_threshold
+from utils import content_words
+
+# Mersenne prime for the (a * x + b) mod p permutation family
+PRIME = (1 << 31) - 1
+
+
+def shingles(text: str) -> FrozenSet[str]:
+    """
+    Content words of a question, with plural/verb "s" endings folded so
+    "letters" and "letter" count as the same word.
+    """
+    words = set()
+    for word in content_words(text):
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        words.add(word)
+    return frozenset(words)
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = dedupe_num_perm, seed: int = 1):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.a = rng.randint(1, PRIME, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, PRIME, size=num_perm).astype(np.uint64)
+
+    def signature(self, words: FrozenSet[str]) -> np.ndarray:
+        if not words:
+            return np.full(self.num_perm, PRIME, dtype=np.uint64)
+        x = np.array(
+            [zlib.crc32(w.encode("utf-8")) % PRIME for w in words], dtype=np.uint64
+        )
+        hashes = (self.a[:, None] * x[None, :] + self.b[:, None]) % PRIME
+        return hashes.min(axis=1)
+
+
+class _LessonBucket:
+    """LSH buckets and word sets for one lesson's questions."""
+
+    def __init__(self, bands: int):
+        self.buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+        self.words: List[FrozenSet[str]] = []
+        self.texts: List[str] = []
+        # How many stored questions the lesson had when this was last in sync
+        self.stored_count = 0
+
+
+class NearDuplicateIndex:
+    """
+    Per-lesson MinHash/LSH index. ``screen`` filters a batch of new questions
+    down to the ones that are not near-duplicates of anything already known
+    (or of each other); ``record`` adds them once they are stored. Each lesson
+    remembers its stored question count, so a caller can tell when other
+    writers changed the lesson and ``load`` it again.
+    """
+
+    def __init__(
+        self,
+        num_perm: int = dedupe_num_perm,
+        bands: int = dedupe_bands,
+        threshold: float = dedupe_threshold,
+    ):
+        if num_perm % bands:
+            raise ValueError("DEDUPE_NUM_PERM must be a multiple of DEDUPE_BANDS")
+        self.hasher = MinHasher(num_perm)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self._lessons: Dict[str, _LessonBucket] = {}
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.candidates = 0
+        self.rejected = 0
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [
+            signature[i * self.rows : (i + 1) * self.rows].tobytes()
+            for i in range(self.bands)
+        ]
+
+    def _insert(self, bucket: _LessonBucket, text: str, words, keys: List[bytes]):
+        position = len(bucket.texts)
+        bucket.texts.append(text)
+        bucket.words.append(words)
+        for band, key in zip(bucket.buckets, keys):
+            band.setdefault(key, []).append(position)
+
+    def _find(
+        self, bucket: _LessonBucket, words, keys: List[bytes]
+    ) -> Tuple[int, float]:
+        candidates = set()
+        for band, key in zip(bucket.buckets, keys):
+            candidates.update(band.get(key, ()))
+        self.lookups += 1
+        self.candidates += len(candidates)
+
+        best, best_score = -1, 0.0
+        for position in candidates:
+            score = jaccard(words, bucket.words[position])
+            if score > best_score:
+                best, best_score = position, score
+        return best, best_score
+
+    def is_current(self, lesson_id: str, stored_count: int) -> bool:
+        """
+        Whether the lesson is loaded and nothing was stored or removed since,
+        judging by its stored question count.
+        """
+        bucket = self._lessons.get(lesson_id)
+        return bucket is not None and bucket.stored_count == stored_count
+
+    def load(self, lesson_id: str, texts: Sequence[str]):
+        """
+        (Re)build a lesson's buckets from its stored question texts.
+        """
+        bucket = _LessonBucket(self.bands)
+        for text in texts:
+            words = shingles(text)
+            self._insert(
+                bucket, text, words, self._band_keys(self.hasher.signature(words))
+            )
+        bucket.stored_count = len(texts)
+        with self._lock:
+            self._lessons[lesson_id] = bucket
+
+    def nearest(self, lesson_id: str, text: str) -> Tuple[str, float]:
+        """
+        The most similar known question for a lesson and its Jaccard
+        similarity; ``("", 0.0)`` if no bucket candidate was found.
+        """
+        bucket = self._lessons.get(lesson_id)
+        if bucket is None:
+            return "", 0.0
+        words = shingles(text)
+        position, score = self._find(
+            bucket, words, self._band_keys(self.hasher.signature(words))
+        )
+        return (bucket.texts[position], score) if position >= 0 else ("", 0.0)
+
+    def screen(self, lesson_id: str, texts: Sequence[str]) -> List[str]:
+        """
+        Return the texts that are not near-duplicates of the lesson's known
+        questions or of an earlier text in the batch. Nothing is recorded.
+        """
+        accepted: List[Tuple[str, FrozenSet[str]]] = []
+        with self._lock:
+            bucket = self._lessons.get(lesson_id) or _LessonBucket(self.bands)
+            for text in texts:
+                words = shingles(text)
+                keys = self._band_keys(self.hasher.signature(words))
+                _, score = self._find(bucket, words, keys)
+                score = max([score] + [jaccard(words, w) for _, w in accepted])
+                if score >= self.threshold:
+                    self.rejected += 1
+                    continue
+                accepted.append((text, words))
+        return [text for text, _ in accepted]
+
+    def record(self, lesson_id: str, texts: Sequence[str], stored_count: int):
+        """
+        Add texts that were just stored; ``stored_count`` is the lesson's
+        stored question count including them.
+        """
+        with self._lock:
+            bucket = self._lessons.setdefault(lesson_id, _LessonBucket(self.bands))
+            for text in texts:
+                words = shingles(text)
+                self._insert(
+                    bucket, text, words, self._band_keys(self.hasher.signature(words))
+                )
+            bucket.stored_count = stored_count
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "lessons": len(self._lessons),
+            "questions": sum(len(b.texts) for b in self._lessons.values()),
+            "lookups": self.lookups,
+            "rejected": self.rejected,
+            "mean_candidates": self.candidates / self.lookups if self.lookups else 0.0,
+        }
+
+
+question_dedupe = NearDuplicateIndex()
@@ -0,0 +1,271 @@
+"""
+Outbound Gemini quota shared by every chain.
+
+Two token buckets hold the requests-per-minute and tokens-per-minute budgets
+(``LLM_RPM`` / ``LLM_TPM``; 0 turns a budget off). A call takes one request
+and its estimated tokens before it goes out, and the estimate is corrected
+from the reported usage afterwards. Waiting calls are served strictly by
+priority (feedback, then interactive generation, then batch), and batch calls
+may not dip into the last ``LLM_RATE_BATCH_RESERVE`` of either bucket, so a
+student's request finds headroom even while a batch job saturates the quota.
+
+A 429 pauses all traffic for the server's retry-after (or an exponential
+backoff when none is given) and the call is retried up to
+``LLM_RATE_MAX_RETRIES`` times.
+"""
+
+import asyncio
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from config import (
+    llm_rate_batch_reserve,
+    llm_rate_completion_tokens,
+    llm_rate_max_retries,
+    llm_rpm,
+    llm_tpm,
+)
+from llm_limiter import is_rate_limit_error
+from utils import estimate_tokens, percentile
+
+FEEDBACK = 0
+GENERATION = 1
+BATCH = 2
+PRIORITY_NAMES = ("feedback", "generation", "batch")
+
+# Shortest sleep while a higher-priority call is ahead in the queue
+MIN_WAIT_SECONDS = 0.005
+RETRY_AFTER_RE = re.compile(
+    r"retry[\s_-]*(?:after|delay|in)?\D{0,20}?(\d+(?:\.\d+)?)", re.IGNORECASE
+)
+
+_priority: ContextVar[Optional[int]] = ContextVar("llm_priority", default=None)
+
+
+@contextmanager
+def priority_scope(priority: int) -> Iterator[None]:
+    """
+    Run the LLM calls made inside the block (including tasks started from
+    it) at ``priority``. The outermost scope wins, so a batch job that calls
+    the interactive code paths stays at batch priority.
+    """
+    if _priority.get() is not None:
+        yield
+        return
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority(default: int = GENERATION) -> int:
+    override = _priority.get()
+    return default if override is None else override
+
+
+def retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """
+    The server's requested delay from a 429: a Retry-After header (seconds or
+    HTTP date) or Gemini's "retry in 12.3s" / ``retry_delay { seconds: 12 }``.
+    """
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    value = headers.get("retry-after") if headers else None
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    match = RETRY_AFTER_RE.search(str(exc))
+    return float(match.group(1)) if match else None
+
+
+def usage_tokens(response: Any, prompt: str) -> int:
+    """
+    Tokens a call actually used, from the response's usage metadata when the
+    client reports it.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage and usage.get("total_tokens"):
+        return int(usage["total_tokens"])
+    return estimate_tokens(prompt) + estimate_tokens(getattr(response, "content", ""))
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_for(self, amount: float, floor: float = 0.0) -> float:
+        """
+        Seconds until ``amount`` can be taken without going below ``floor``.
+        """
+        if not self.capacity:
+            return 0.0
+        deficit = min(amount, self.capacity - floor) + floor - self.level
+        return deficit / self.rate if deficit > 0 else 0.0
+
+    def take(self, amount: float):
+        if self.capacity:
+            self.level -= min(amount, self.capacity)
+
+
+class PriorityRateLimiter:
+    def __init__(
+        self,
+        rpm: int = llm_rpm,
+        tpm: int = llm_tpm,
+        batch_reserve: float = llm_rate_batch_reserve,
+        max_retries: int = llm_rate_max_retries,
+        completion_tokens: int = llm_rate_completion_tokens,
+    ):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.batch_reserve = batch_reserve
+        self.max_retries = max_retries
+        self.completion_tokens = completion_tokens
+
+        self._lock = threading.Lock()
+        self._waiting = [0] * len(PRIORITY_NAMES)
+        self._paused_until = 0.0
+
+        self.granted = [0] * len(PRIORITY_NAMES)
+        self.queued = [0] * len(PRIORITY_NAMES)
+        self._waits: List[Deque[float]] = [deque(maxlen=1000) for _ in PRIORITY_NAMES]
+        self.max_wait = [0.0] * len(PRIORITY_NAMES)
+        self.rate_limited = 0
+        self.retries = 0
+
+    def estimate(self, prompt: str) -> int:
+        return estimate_tokens(prompt) + self.completion_tokens
+
+    def _try_acquire(self, priority: int, tokens: int) -> float:
+        """
+        Take one request and ``tokens`` if this call is next in line; else
+        return how long to sleep before asking again.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            reserve = self.batch_reserve if priority >= BATCH else 0.0
+            wait = max(
+                self.requests.wait_for(1, self.requests.capacity * reserve),
+                self.tokens.wait_for(tokens, self.tokens.capacity * reserve),
+            )
+            if wait > 0 or any(self._waiting[:priority]):
+                return max(wait, MIN_WAIT_SECONDS)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            return 0.0
+
+    def _record(self, priority: int, waited: float, queued: bool):
+        self.granted[priority] += 1
+        if queued:
+            self.queued[priority] += 1
+        self._waits[priority].append(waited)
+        self.max_wait[priority] = max(self.max_wait[priority], waited)
+
+    async def acquire(self, priority: int, tokens: int):
+        start = time.monotonic()
+        wait = wait_first = self._try_acquire(priority, tokens)
+        if wait:
+            with self._lock:
+                self._waiting[priority] += 1
+            try:
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = self._try_acquire(priority, tokens)
+            finally:
+                with self._lock:
+                    self._waiting[priority] -= 1
+        self._record(priority, time.monotonic() - start, bool(wait_first))
+
+    def acquire_sync(self, priority: int, tokens: int):
+        """
+        Blocking acquire for the synchronous chain calls.
+        """
+        start = time.monotonic()
+        wait = wait_first = self._try_acquire(priority, tokens)
+        if wait:
+            with self._lock:
+                self._waiting[priority] += 1
+            try:
+                while wait:
+                    time.sleep(wait)
+                    wait = self._try_acquire(priority, tokens)
+            finally:
+                with self._lock:
+                    self._waiting[priority] -= 1
+        self._record(priority, time.monotonic() - start, bool(wait_first))
+
+    def settle(self, estimated: int, actual: int):
+        """
+        Correct the token bucket once the call's real usage is known.
+        """
+        with self._lock:
+            if self.tokens.capacity:
+                self.tokens.level = min(
+                    self.tokens.capacity, self.tokens.level + estimated - actual
+                )
+
+    def retry_delay(self, exc: BaseException, attempt: int) -> Optional[float]:
+        """
+        For a 429 with retries left, pause all traffic for the retry-after
+        and return it; otherwise None, and the error should be raised.
+        """
+        if not is_rate_limit_error(exc):
+            return None
+        self.rate_limited += 1
+        if attempt >= self.max_retries:
+            return None
+        delay = retry_after_seconds(exc)
+        if delay is None:
+            delay = float(2**attempt)
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        self.retries += 1
+        return delay
+
+    def stats(self) -> Dict[str, Any]:
+        queue_wait = {}
+        for priority, name in enumerate(PRIORITY_NAMES):
+            waits = list(self._waits[priority])
+            queue_wait[name] = {
+                "granted": self.granted[priority],
+                "queued": self.queued[priority],
+                "waiting": self._waiting[priority],
+                "p50": percentile(waits, 50),
+                "p95": percentile(waits, 95),
+                "p99": percentile(waits, 99),
+                "max": self.max_wait[priority],
+            }
+        return {
+            "requests_available": self.requests.level,
+            "tokens_available": self.tokens.level,
+            "paused_for": max(0.0, self._paused_until - time.monotonic()),
+            "rate_limited": self.rate_limited,
+            "retries": self.retries,
+            "queue_wait": queue_wait,
+        }
+
+
+llm_rate_limiter = PriorityRateLimiter()
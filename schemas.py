@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 
 class LessonIn(BaseModel):
@@ -27,4 +27,6 @@ class EvalResult(BaseModel):
 
 
 class EvalResultList(BaseModel):
-    results: List[EvalResult]
+    # One per graded answer, in order; None where that answer's grade
+    # could not be read from the model's output
+    results: List[Optional[EvalResult]]
@@ -0,0 +1,55 @@
+"""
+Single-flight coalescing of concurrent identical async calls.
+
+While a call for a key is in flight, later callers with the same key await the
+same task instead of starting their own, so a burst of N identical requests
+costs one LLM round trip.
+"""
+
+import asyncio
+import re
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Tuple
+
+
+def normalize_text(text: str) -> str:
+    """
+    Collapse runs of whitespace so trivially different payloads share a key.
+    """
+    return re.sub(r"\s+", " ", text or "").strip()
+
+
+def normalize_pairs(pairs: Iterable[Tuple[str, str]]) -> Tuple[Tuple[str, str], ...]:
+    return tuple((normalize_text(a), normalize_text(b)) for a, b in pairs)
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+
+        self.calls = 0
+        self.collapsed = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run ``fn()`` unless an identical call is already in flight, in which
+        case wait for and share its result (or exception).
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.collapsed += 1
+
+        # Shield so one caller disconnecting doesn't cancel the call for everyone else
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "calls": self.calls,
+            "collapsed": self.collapsed,
+            "in_flight": len(self._in_flight),
+        }
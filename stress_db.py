@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Concurrency stress check for the database layer.
+
+Fires ``--readers`` concurrent requests at the read endpoints, /feedback and
+/generate-questions (through the ASGI app, no server needed) while
+``--writers`` threads keep inserting and deleting banked questions. The async
+LLM routes use the fake model unless LLM_FAKE is set, so what they measure is
+their DB work: done on the event loop it would serialize the whole burst.
+Fails if any request errors, if SQLite reports "database is locked", or if a
+pooled connection is still checked out at the end.
+
+    python stress_db.py --readers 200 --writers 4 --rounds 3
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import httpx
+from sqlalchemy.exc import OperationalError
+
+# Read by config at import, so before the app is imported
+os.environ.setdefault("LLM_FAKE", "true")
+
+from api import app
+from db.migrations import migrate
+from db.models import GeneratedQuestion, Lesson, engine, session_scope
+
+
+def writer(lesson_id: str, stop: threading.Event, errors: Counter, writes: Counter):
+    n = 0
+    while not stop.is_set():
+        try:
+            with session_scope() as db:
+                row = GeneratedQuestion(
+                    lesson_id=lesson_id,
+                    question_text=f"stress-{threading.get_ident()}-{n}",
+                    correct_answer="stress",
+                )
+                db.add(row)
+                db.commit()
+                db.delete(row)
+                db.commit()
+            writes["ok"] += 1
+        except OperationalError as e:
+            errors["locked" if "locked" in str(e) else "operational"] += 1
+        n += 1
+
+
+async def read_burst(client: httpx.AsyncClient, lessons, readers: int, errors):
+    requests = [("GET", "/lessons", None)]
+    for lesson_id, title in lessons:
+        requests += [
+            ("GET", f"/lessons/{lesson_id}", None),
+            ("GET", f"/lessons/{lesson_id}/questions", None),
+            ("POST", "/generate-questions", {"lesson_title": title}),
+            (
+                "POST",
+                "/feedback",
+                {
+                    "lesson_title": title,
+                    "qna": {f"What happens in {title}?": "Stress."},
+                },
+            ),
+        ]
+
+    async def one(i: int):
+        method, path, body = requests[i % len(requests)]
+        response = await client.request(method, path, json=body)
+        if response.status_code != 200:
+            errors[f"http {response.status_code}"] += 1
+            if "locked" in response.text:
+                errors["locked"] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(readers)))
+    return time.perf_counter() - start
+
+
+async def main(args) -> int:
+    migrate(engine)
+    with session_scope() as db:
+        lessons = [tuple(row) for row in db.query(Lesson.id, Lesson.title).limit(5)]
+    if not lessons:
+        print("No lessons in the database; run init_sqlite.py or add_lessons.py first.")
+        return 1
+
+    errors, writes = Counter(), Counter()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=writer, args=(lessons[0][0], stop, errors, writes))
+        for _ in range(args.writers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://stress"
+        ) as client:
+            for round_no in range(1, args.rounds + 1):
+                elapsed = await read_burst(client, lessons, args.readers, errors)
+                print(
+                    f"round {round_no}: {args.readers} concurrent requests in {elapsed:.2f}s"
+                )
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    checked_out = engine.pool.checkedout() if hasattr(engine.pool, "checkedout") else 0
+    print(f"writes: {writes['ok']}, errors: {dict(errors) or 'none'}")
+    print(f"pool: {engine.pool.status()}")
+    if errors or checked_out:
+        print(f"FAILED ({checked_out} connections still checked out)")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--readers", type=int, default=200)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=3)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,5 @@
+import os
+
+# db.models builds its engine from DATABASE_URL at import; tests that need a
+# database create their own engine on a temporary file
+os.environ.setdefault("DATABASE_URL", "sqlite://")
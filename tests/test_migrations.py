@@ -0,0 +1,70 @@
+"""
+Migrations on a temporary SQLite file: every version applies once, and the
+hot lookups use the indexes they add (EXPLAIN QUERY PLAN).
+"""
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import IntegrityError
+
+from db.migrations import MIGRATIONS, PLAN_CHECKS, migrate, query_plan
+
+# lessons and questions as the app first created them, with no indexes
+BASELINE_SCHEMA = [
+    "CREATE TABLE lessons (id VARCHAR(36) PRIMARY KEY, title VARCHAR(200) NOT NULL, "
+    "content TEXT NOT NULL, grade_level INTEGER NOT NULL)",
+    "CREATE TABLE questions (id VARCHAR(36) PRIMARY KEY, "
+    "lesson_id VARCHAR(36) NOT NULL REFERENCES lessons (id), "
+    "question_type VARCHAR(20) NOT NULL, question_text TEXT NOT NULL, "
+    "options TEXT, correct_answer TEXT)",
+]
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'tutor.db'}")
+    yield engine
+    engine.dispose()
+
+
+def _plan(engine, sql: str) -> str:
+    with engine.connect() as conn:
+        return query_plan(conn, sql)
+
+
+def test_migrate_applies_each_version_once(engine):
+    assert migrate(engine) == [version for version, _, _ in MIGRATIONS]
+    assert migrate(engine) == []
+
+
+@pytest.mark.parametrize(
+    "sql, index", [check[1:] for check in PLAN_CHECKS], ids=[c[0] for c in PLAN_CHECKS]
+)
+def test_fresh_database_queries_use_their_index(engine, sql, index):
+    migrate(engine)
+    assert index in _plan(engine, sql)
+
+
+@pytest.mark.parametrize(
+    "sql, index", [check[1:] for check in PLAN_CHECKS], ids=[c[0] for c in PLAN_CHECKS]
+)
+def test_upgraded_database_queries_use_their_index(engine, sql, index):
+    with engine.begin() as conn:
+        for statement in BASELINE_SCHEMA:
+            conn.execute(text(statement))
+    assert index not in _plan(engine, sql)
+
+    migrate(engine)
+    assert index in _plan(engine, sql)
+
+
+def test_lesson_titles_are_unique(engine):
+    migrate(engine)
+    insert = text(
+        "INSERT INTO lessons (id, title, content, grade_level) "
+        "VALUES (:id, 'Same title', '', 4)"
+    )
+    with engine.begin() as conn:
+        conn.execute(insert, {"id": "1"})
+    with pytest.raises(IntegrityError), engine.begin() as conn:
+        conn.execute(insert, {"id": "2"})
@@ -0,0 +1,536 @@
+"""
+Per-request stage timings and LLM usage, exposed in Prometheus text format
+on /metrics.
+
+TracingMiddleware opens a trace for every HTTP request. While it is open,
+the code it runs reports:
+
+- ``db``: SQL statement time (SQLAlchemy events in db/models.py);
+- ``queue``: time an LLM call waits for the rate limiter and a concurrency
+  slot (llm_cache.CachedChain);
+- ``render``: prompt formatting;
+- ``llm``: the model call itself;
+- ``parse``: turning model output into results, including any repair call.
+
+plus the prompt and completion tokens and estimated cost of each LLM call.
+When the request finishes its totals are observed once, labelled by
+endpoint (the route template), chain and lesson grade, so the histograms
+show where a slow request's time went. Work outside a request (batch
+scripts, refills that outlive the request) is recorded as it happens with
+endpoint "none". With ``TRACING_SERVER_TIMING`` the totals so far are also
+sent in a Server-Timing header, which browser devtools show per request.
+
+Components that keep their own counters (caches, limiters, the parsers)
+expose their ``stats()`` through a StatsCollector; register_collectors()
+sets these up once, when the API starts, so importing a component has no
+effect on /metrics. They are read at scrape time and rendered alongside the
+above.
+
+Metrics are per process; scrape each worker.
+"""
+
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from config import (
+    llm_input_price_per_mtok,
+    llm_output_price_per_mtok,
+    tracing_enabled,
+    tracing_server_timing,
+)
+from utils import estimate_tokens
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STAGES = ("db", "queue", "render", "llm", "parse")
+NONE = "none"
+
+_lock = threading.Lock()
+_metrics: List["_Metric"] = []
+_collectors: List["StatsCollector"] = []
+_collectors_registered = False
+_trace: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra="") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        _metrics.append(self)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self._samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...]):
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple[str, ...], float] = defaultdict(float)
+
+    def inc(self, labels: Tuple[str, ...], amount: float = 1.0):
+        with _lock:
+            self.values[labels] += amount
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, labels)} {value:g}"
+            for labels, value in sorted(self.values.items())
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Tuple[str, ...],
+        buckets: Tuple[float, ...] = BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # Per label set: count in each bucket (not cumulative), then sum
+        self.values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, labels: Tuple[str, ...], value: float):
+        with _lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for labels, series in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                bucket = _format_labels(self.labels, labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+            suffix = _format_labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{suffix} {series[-1]:g}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    "tutor_request_duration_seconds",
+    "HTTP request latency.",
+    ("endpoint", "method", "status", "grade"),
+)
+STAGE_SECONDS = Histogram(
+    "tutor_stage_duration_seconds",
+    "Time per request spent in each stage (db, queue, render, llm, parse).",
+    ("endpoint", "stage", "chain", "grade"),
+)
+LLM_CALLS = Counter(
+    "tutor_llm_calls_total",
+    "LLM chain calls by outcome (ok, error, cached).",
+    ("endpoint", "chain", "grade", "outcome"),
+)
+LLM_TOKENS = Counter(
+    "tutor_llm_tokens_total",
+    "LLM tokens used, by type (prompt, completion).",
+    ("endpoint", "chain", "grade", "type"),
+)
+LLM_COST = Counter(
+    "tutor_llm_cost_dollars_total",
+    "Estimated LLM spend at LLM_INPUT/OUTPUT_PRICE_PER_MTOK.",
+    ("endpoint", "chain", "grade"),
+)
+
+
+class StatsCollector:
+    """
+    Exposes a component's ``stats()`` dict on /metrics. Each numeric entry
+    becomes ``<prefix>_<key>``: a counter (``_total``) if the key is in
+    ``counters``, a gauge otherwise. With ``label``, ``stats()`` returns
+    ``{label value: {key: number}}`` instead. ``labels`` are added to every
+    sample, so several instances can share one prefix.
+    """
+
+    def __init__(
+        self,
+        prefix: str,
+        help: str,
+        stats: Callable[[], Dict[str, Any]],
+        counters: Iterable[str] = (),
+        label: Optional[str] = None,
+        labels: Optional[Dict[str, str]] = None,
+    ):
+        self.prefix = prefix
+        self.help = help
+        self.stats = stats
+        self.counters = frozenset(counters)
+        self.label = label
+        self.labels = labels or {}
+        _collectors.append(self)
+
+    def samples(self) -> Iterator[Tuple[str, str, str, str]]:
+        """
+        ``(metric name, type, help, sample line)`` for each numeric entry.
+        """
+        stats = self.stats()
+        groups = stats.items() if self.label else [(None, stats)]
+        for label_value, values in groups:
+            labels = dict(self.labels)
+            if label_value is not None:
+                labels[self.label] = str(label_value)
+            names, label_values = tuple(labels), tuple(labels.values())
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                counter = key in self.counters
+                name = f"{self.prefix}_{key}" + ("_total" if counter else "")
+                number = str(value) if isinstance(value, int) else repr(float(value))
+                yield (
+                    name,
+                    "counter" if counter else "gauge",
+                    f"{self.help}: {key.replace('_', ' ')}.",
+                    f"{name}{_format_labels(names, label_values)} {number}",
+                )
+
+
+def register_collectors(question_bank=None):
+    """
+    Expose the component singletons' stats on /metrics, plus the API's
+    ``question_bank`` if given. Safe to call more than once.
+    """
+    global _collectors_registered
+    with _lock:
+        if _collectors_registered:
+            return
+        _collectors_registered = True
+
+    # Imported here: these modules import tracing themselves
+    from agent import eval_batcher, evaluation_flight, generation_flight
+    from lesson_cache import lesson_cache
+    from lesson_context import context_stats
+    from llm_cache import llm_cache
+    from llm_limiter import llm_limiter
+    from llm_output import ParseStats, parse_stats
+    from pregrader import pregrader
+    from question_dedupe import question_dedupe
+    from rate_limiter import llm_rate_limiter
+
+    for flight in (generation_flight, evaluation_flight):
+        StatsCollector(
+            "tutor_singleflight",
+            "Coalesced identical LLM requests",
+            flight.stats,
+            counters=("calls", "collapsed"),
+            labels={"flight": flight.name},
+        )
+    StatsCollector(
+        "tutor_eval_batcher",
+        "Cross-request evaluation micro-batching",
+        eval_batcher.stats,
+        counters=("requests", "batches", "items", "fallbacks"),
+    )
+    StatsCollector(
+        "tutor_lesson_cache",
+        "In-process lesson cache",
+        lesson_cache.stats,
+        counters=("hits", "misses", "invalidations"),
+    )
+    StatsCollector(
+        "tutor_lesson_context",
+        "Generation prompts, full vs token-budgeted",
+        context_stats.stats,
+        counters=("prompts", "full_prompt_tokens", "budgeted_prompt_tokens"),
+    )
+    StatsCollector(
+        "tutor_llm_cache",
+        "LLM response cache",
+        llm_cache.stats,
+        counters=("hits", "memory_hits", "disk_hits", "misses", "bypasses", "rejected"),
+    )
+    StatsCollector(
+        "tutor_llm_concurrency",
+        "Adaptive LLM concurrency limiter",
+        llm_limiter.stats,
+        counters=("successes", "errors", "rate_limited"),
+    )
+    StatsCollector(
+        "tutor_llm_parse",
+        "LLM responses by how they were parsed",
+        parse_stats.stats,
+        counters=ParseStats.OUTCOMES,
+        label="kind",
+    )
+    StatsCollector(
+        "tutor_pregrader",
+        "Answers graded locally vs escalated to the LLM",
+        pregrader.stats,
+        counters=("graded_locally", "escalated"),
+    )
+    StatsCollector(
+        "tutor_question_dedupe",
+        "Near-duplicate question index",
+        question_dedupe.stats,
+        counters=("lookups", "rejected"),
+    )
+    StatsCollector(
+        "tutor_llm_quota",
+        "Shared LLM RPM/TPM quota",
+        llm_rate_limiter.stats,
+        counters=("rate_limited", "retries"),
+    )
+    StatsCollector(
+        "tutor_llm_quota_queue",
+        "LLM quota queue by priority (waits in seconds, over the last 1000 grants)",
+        lambda: llm_rate_limiter.stats()["queue_wait"],
+        counters=("granted", "queued"),
+        label="priority",
+    )
+    if question_bank is not None:
+        StatsCollector(
+            "tutor_question_bank",
+            "Generated question bank",
+            question_bank.stats,
+            counters=("served", "generation_calls", "generated", "duplicates"),
+        )
+
+
+def _render_collectors() -> List[str]:
+    # Families keyed by name, so instances sharing a prefix get one HELP/TYPE
+    families: Dict[str, Tuple[str, str, List[str]]] = {}
+    for collector in list(_collectors):
+        try:
+            samples = list(collector.samples())
+        except Exception as e:
+            print(f"Could not collect {collector.prefix} stats: {e}")
+            continue
+        for name, kind, help, line in samples:
+            families.setdefault(name, (kind, help, []))[2].append(line)
+    return [
+        "\n".join([f"# HELP {name} {help}", f"# TYPE {name} {kind}"] + lines)
+        for name, (kind, help, lines) in families.items()
+    ]
+
+
+def render_metrics() -> str:
+    with _lock:
+        rendered = [metric.render() for metric in _metrics]
+    # Outside _lock: stats() takes the components' own locks
+    return "\n".join(rendered + _render_collectors()) + "\n"
+
+
+def llm_usage(response: Any, prompt: str) -> Tuple[int, int]:
+    """
+    Prompt and completion tokens of a call, from the response's usage
+    metadata when the client reports it, else estimated from the text.
+    """
+    usage = getattr(response, "usage_metadata", None) or {}
+    text = getattr(response, "content", "") or ""
+    return (
+        usage.get("input_tokens") or estimate_tokens(prompt),
+        usage.get("output_tokens") or estimate_tokens(text),
+    )
+
+
+def llm_cost(prompt_tokens: int, completion_tokens: int) -> float:
+    return (
+        prompt_tokens * llm_input_price_per_mtok
+        + completion_tokens * llm_output_price_per_mtok
+    ) / 1_000_000
+
+
+class Trace:
+    """
+    Stage totals and LLM usage of one request, observed when it finishes.
+    """
+
+    def __init__(self, scope: dict):
+        self.scope = scope
+        self.start = time.perf_counter()
+        self.grade = NONE
+        self.finished = False
+        self.stages: Dict[Tuple[str, str], float] = defaultdict(float)
+        # (chain, outcome) -> [calls, prompt tokens, completion tokens, cost]
+        self.llm: Dict[Tuple[str, str], List[float]] = {}
+
+    @property
+    def endpoint(self) -> str:
+        # Set by the router once the request has been matched
+        route = self.scope.get("route")
+        return getattr(route, "path", None) or "unmatched"
+
+    def _snapshot(self):
+        with _lock:
+            return list(self.stages.items()), list(self.llm.items())
+
+    def server_timing(self) -> str:
+        stages, llm = self._snapshot()
+        entries = []
+        for (stage, chain), seconds in stages:
+            name = stage if chain == NONE else f"{stage}.{chain}"
+            entries.append(f"{name};dur={seconds * 1000:.1f}")
+        prompt = sum(totals[1] for _, totals in llm)
+        completion = sum(totals[2] for _, totals in llm)
+        if prompt or completion:
+            entries.append(
+                f'tokens;desc="{prompt:.0f} prompt, {completion:.0f} completion"'
+            )
+        entries.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.1f}")
+        return ", ".join(entries)
+
+    def finish(self, method: str, status: int):
+        # Anything reported after this (a refill outliving the request) is
+        # recorded on its own
+        self.finished = True
+        stages, llm = self._snapshot()
+        endpoint, grade = self.endpoint, self.grade
+        REQUEST_SECONDS.observe(
+            (endpoint, method, str(status), grade), time.perf_counter() - self.start
+        )
+        for (stage, chain), seconds in stages:
+            STAGE_SECONDS.observe((endpoint, stage, chain, grade), seconds)
+        for (chain, outcome), (calls, prompt, completion, cost) in llm:
+            _observe_llm(
+                endpoint, grade, chain, outcome, calls, prompt, completion, cost
+            )
+
+
+def _observe_llm(
+    endpoint: str,
+    grade: str,
+    chain: str,
+    outcome: str,
+    calls: float,
+    prompt: float,
+    completion: float,
+    cost: float,
+):
+    LLM_CALLS.inc((endpoint, chain, grade, outcome), calls)
+    if prompt or completion:
+        LLM_TOKENS.inc((endpoint, chain, grade, "prompt"), prompt)
+        LLM_TOKENS.inc((endpoint, chain, grade, "completion"), completion)
+        LLM_COST.inc((endpoint, chain, grade), cost)
+
+
+def _open_trace() -> Optional[Trace]:
+    trace = _trace.get()
+    return trace if trace is not None and not trace.finished else None
+
+
+def set_grade(grade: Optional[int]):
+    """
+    Label the current request with the grade of the lesson it is about.
+    """
+    trace = _open_trace()
+    if trace is not None and grade is not None:
+        trace.grade = str(grade)
+
+
+def record_stage(stage: str, seconds: float, chain: Optional[str] = None):
+    if not tracing_enabled:
+        return
+    trace = _open_trace()
+    if trace is None:
+        STAGE_SECONDS.observe((NONE, stage, chain or NONE, NONE), seconds)
+        return
+    with _lock:
+        trace.stages[(stage, chain or NONE)] += seconds
+
+
+@contextmanager
+def stage(name: str, chain: Optional[str] = None) -> Iterator[None]:
+    """
+    Time the block as ``name`` (one of STAGES) for the current request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start, chain)
+
+
+def record_llm_call(
+    chain: str, outcome: str, prompt_tokens: int = 0, completion_tokens: int = 0
+):
+    """
+    Count one chain call; ``outcome`` is "ok", "error" or "cached".
+    """
+    if not tracing_enabled:
+        return
+    cost = llm_cost(prompt_tokens, completion_tokens)
+    trace = _open_trace()
+    if trace is None:
+        _observe_llm(
+            NONE, NONE, chain, outcome, 1, prompt_tokens, completion_tokens, cost
+        )
+        return
+    with _lock:
+        totals = trace.llm.setdefault((chain, outcome), [0, 0, 0, 0.0])
+        totals[0] += 1
+        totals[1] += prompt_tokens
+        totals[2] += completion_tokens
+        totals[3] += cost
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware that traces each HTTP request (see module docstring).
+    """
+
+    def __init__(self, app, server_timing: bool = tracing_server_timing):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(scope)
+        token = _trace.set(trace)
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.server_timing:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", trace.server_timing().encode()))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            trace.finish(scope["method"], status)
+            _trace.reset(token)
@@ -1,3 +1,21 @@
+import re
+from typing import List
+
+WORD_RE = re.compile(r"[a-z0-9']+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by did do does for from had has have he her his how i "
+    "in is it its me my of on or she so that the their them then there they this to "
+    "was we were what when where which who why with you your".split()
+)
+
+
+def content_words(text: str) -> List[str]:
+    """
+    Lower-cased words of ``text`` with common English stopwords removed.
+    """
+    return [w for w in WORD_RE.findall(text.lower()) if w not in STOPWORDS]
+
+
 def qna_dict_to_string(qna: dict) -> str:
     """
     Converts a dictionary of Q&A pairs into a readable string format:
@@ -9,3 +27,22 @@ def qna_dict_to_string(qna: dict) -> str:
     for question, answer in qna.items():
         lines.append(f"Q: {question}\nA: {answer}\n")
     return "\n".join(lines)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count for budgeting prompts (about 4 characters per token for
+    English text with Gemini's tokenizer).
+    """
+    return max(1, len(text) // 4) if text else 0
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    Nearest-rank percentile (``p`` in 0-100) of ``values``; 0.0 when empty.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[min(int(rank), len(ordered)) - 1]